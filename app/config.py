@@ -0,0 +1,201 @@
+import os
+
+# Settings are read from the environment so each deployment can tune them
+# without code changes.
+
+# Micro-batching scheduler for /generate/
+SCHEDULER_MAX_BATCH_SIZE = int(os.getenv("SCHEDULER_MAX_BATCH_SIZE", "4"))
+SCHEDULER_MAX_WAIT_MS = float(os.getenv("SCHEDULER_MAX_WAIT_MS", "50"))
+# Requests whose strengths round to the same multiple of this value share a batch
+SCHEDULER_STRENGTH_BUCKET = float(os.getenv("SCHEDULER_STRENGTH_BUCKET", "0.025"))
+
+# Admission control: requests beyond SCHEDULER_MAX_QUEUE waiting generations
+# get 429 with Retry-After (0 = unbounded). REQUEST_TIMEOUT caps how long a
+# generation request may take (0 = no limit); clients can ask for less with
+# X-Request-Timeout. Abandoned requests are cancelled between denoising steps.
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "32"))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+DISCONNECT_POLL_SECONDS = float(os.getenv("DISCONNECT_POLL_SECONDS", "0.5"))
+
+# Cached CLIP embeddings for (area, units) prompts; negative prompts are always kept
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "256"))
+
+# Uploads are resized so the long side falls within this range
+RESIZE_MIN_SIZE = int(os.getenv("RESIZE_MIN_SIZE", "512"))
+RESIZE_MAX_SIZE = int(os.getenv("RESIZE_MAX_SIZE", "1024"))
+
+# "exact" keeps each upload's aspect ratio. "bucket" then snaps it to the
+# nearest-aspect resolution in RESIZE_BUCKETS (multiples of 64), padding or
+# cropping per RESIZE_BUCKET_FIT, so requests share a few shapes and batch
+# together; outputs are mapped back to the upload's framing. Buckets come in
+# classes by long side (512, 768, 1024); an upload uses the largest class
+# that doesn't upscale it.
+RESIZE_MODE = os.getenv("RESIZE_MODE", "exact")
+RESIZE_BUCKET_FIT = os.getenv("RESIZE_BUCKET_FIT", "pad")
+RESIZE_BUCKETS = [
+    tuple(int(side) for side in bucket.split("x"))
+    for bucket in os.getenv(
+        "RESIZE_BUCKETS",
+        "1024x1024,1024x832,832x1024,1024x768,768x1024,1024x704,704x1024,1024x640,640x1024,1024x576,576x1024,"
+        "768x768,768x640,640x768,768x576,576x768,768x512,512x768,768x448,448x768,"
+        "512x512,512x448,448x512,512x384,384x512,512x320,320x512"
+    ).split(",")
+]
+
+# Upload guards: files above UPLOAD_MAX_MB and images above UPLOAD_MAX_PIXELS
+# (checked from the header, before decoding) are rejected
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "30"))
+UPLOAD_MAX_PIXELS = int(os.getenv("UPLOAD_MAX_PIXELS", "50000000"))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+
+# Memory budget for decoded uploads and their VAE init latents
+LATENT_CACHE_BUDGET_MB = float(os.getenv("LATENT_CACHE_BUDGET_MB", "512"))
+
+# Model loading. MODEL_PATH points at a local diffusers snapshot (safetensors
+# weights); when unset the weights come from the hub by MODEL_ID.
+MODEL_ID = os.getenv("MODEL_ID", "runwayml/stable-diffusion-v1-5")
+MODEL_PATH = os.getenv("MODEL_PATH", "")
+# "background" starts loading once the server is up, "lazy" on the first request
+MODEL_LOAD_MODE = os.getenv("MODEL_LOAD_MODE", "background")
+MODEL_LOAD_TIMEOUT = float(os.getenv("MODEL_LOAD_TIMEOUT", "600"))
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "1") == "1"
+MODEL_WARMUP_SIZE = int(os.getenv("MODEL_WARMUP_SIZE", "256"))
+# Memory policy. MEMORY_POLICY "auto" keeps the weights resident on the
+# device when they fit in MEMORY_BUDGET_MB (0 = free device memory, split
+# between WORKER_REPLICAS, or all available RAM on CPU), else falls back to
+# "model_offload" and then "sequential_offload". Attention slicing and VAE
+# tiling ("auto", "on", "off") are enabled per call only when that call's
+# activations wouldn't fit.
+MEMORY_POLICY = os.getenv("MEMORY_POLICY", "auto")
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+MEMORY_ATTENTION_SLICING = os.getenv("MEMORY_ATTENTION_SLICING", "auto")
+MEMORY_VAE_TILING = os.getenv("MEMORY_VAE_TILING", "auto")
+
+# Inference backend (see model/backends.py): "pytorch", "cpu" (bfloat16
+# autocast, channels_last, torch.compile) or "openvino" (needs the openvino
+# package). Compiled and converted models are cached in BACKEND_CACHE_DIR.
+# Compilation is per input shape, so the CPU backends pair well with
+# RESIZE_MODE=bucket.
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "pytorch")
+BACKEND_BF16 = os.getenv("BACKEND_BF16", "1") == "1"
+BACKEND_CHANNELS_LAST = os.getenv("BACKEND_CHANNELS_LAST", "1") == "1"
+BACKEND_COMPILE = os.getenv("BACKEND_COMPILE", "1") == "1"
+BACKEND_CACHE_DIR = os.getenv("BACKEND_CACHE_DIR", os.path.expanduser("~/.cache/sdig/backends"))
+OPENVINO_DEVICE = os.getenv("OPENVINO_DEVICE", "CPU")
+
+# Memory-map the safetensors of a local snapshot instead of reading them into
+# each process, so worker replicas share the weights through the page cache.
+# With more than one replica, BACKEND_CHANNELS_LAST is skipped for mapped
+# components: converting would give each replica a private copy of the UNet
+# and VAE conv weights. Set MODEL_MMAP=0 to trade that memory for channels_last.
+MODEL_MMAP = os.getenv("MODEL_MMAP", "1") == "1"
+
+# Inference worker processes. 0 runs the pipeline inside the API process;
+# N > 0 starts N replicas with WORKER_THREADS torch threads each (0 = an even
+# share of the cores), optionally pinned to their own cores, and sends each
+# batch to the replica with the fewest calls in flight
+WORKER_REPLICAS = int(os.getenv("WORKER_REPLICAS", "0"))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "0"))
+WORKER_PIN_CPUS = os.getenv("WORKER_PIN_CPUS", "0") == "1"
+
+# Region-cropped generation: padding around the area's landmarks (fraction of
+# the landmark box), the square working size the crop is diffused at, and the
+# blur radius used to feather the blend back into the photo
+REGION_PADDING = float(os.getenv("REGION_PADDING", "0.6"))
+REGION_MIN_SIZE = int(os.getenv("REGION_MIN_SIZE", "128"))
+REGION_WORKING_SIZE = int(os.getenv("REGION_WORKING_SIZE", "512"))
+REGION_FEATHER = int(os.getenv("REGION_FEATHER", "15"))
+
+# Low-resolution generation: long side the photo is diffused at, and the blur
+# (sigma, in low-res pixels) applied to the edit before it is upsampled onto
+# the full-resolution photo
+LOWRES_SIZE = int(os.getenv("LOWRES_SIZE", "512"))
+LOWRES_DELTA_BLUR = float(os.getenv("LOWRES_DELTA_BLUR", "1.0"))
+
+# Step previews streamed by /generate/stream/: every how many denoising steps,
+# long side in pixels and JPEG quality
+PREVIEW_EVERY_STEPS = int(os.getenv("PREVIEW_EVERY_STEPS", "2"))
+PREVIEW_SIZE = int(os.getenv("PREVIEW_SIZE", "256"))
+PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "60"))
+
+# /ws landmark stream: FaceMesh worker threads shared by all connections and
+# the weight given to the previous position when smoothing landmarks
+WS_WORKERS = int(os.getenv("WS_WORKERS", str(os.cpu_count() or 4)))
+LANDMARK_SMOOTHING = float(os.getenv("LANDMARK_SMOOTHING", "0.7"))
+
+# Annotated frames sent back on /ws: JPEG quality and downscale factor
+WS_JPEG_QUALITY = int(os.getenv("WS_JPEG_QUALITY", "95"))
+WS_FRAME_SCALE = float(os.getenv("WS_FRAME_SCALE", "1.0"))
+
+# /ws backpressure: "latest" processes only the newest frame and drops stale
+# ones, "ordered" processes every frame. WS_MAX_FPS caps processed frames per
+# connection (0 = uncapped); WS_DETECT_EVERY runs full FaceMesh detection every
+# N frames and tracks landmarks with optical flow in between.
+WS_INGEST_MODE = os.getenv("WS_INGEST_MODE", "latest")
+WS_MAX_FPS = float(os.getenv("WS_MAX_FPS", "0"))
+WS_DETECT_EVERY = int(os.getenv("WS_DETECT_EVERY", "1"))
+
+# Default encoding quality of generated images, per output format
+OUTPUT_QUALITY = {
+    "jpeg": int(os.getenv("OUTPUT_JPEG_QUALITY", "75")),
+    "webp": int(os.getenv("OUTPUT_WEBP_QUALITY", "80")),
+}
+
+# Quality tiers selectable per /generate/ request. Each picks a scheduler
+# ("default" keeps the one shipped with the model), a step count and the
+# classifier-free guidance scale. Img2img only runs steps * strength of them.
+QUALITY_TIERS = {
+    "preview": {
+        "scheduler": os.getenv("QUALITY_PREVIEW_SCHEDULER", "dpmsolver++"),
+        "steps": int(os.getenv("QUALITY_PREVIEW_STEPS", "12")),
+        "guidance_scale": float(os.getenv("QUALITY_PREVIEW_GUIDANCE", "7.0")),
+    },
+    "standard": {
+        "scheduler": os.getenv("QUALITY_STANDARD_SCHEDULER", "dpmsolver++"),
+        "steps": int(os.getenv("QUALITY_STANDARD_STEPS", "25")),
+        "guidance_scale": float(os.getenv("QUALITY_STANDARD_GUIDANCE", "8.5")),
+    },
+    "final": {
+        "scheduler": os.getenv("QUALITY_FINAL_SCHEDULER", "default"),
+        "steps": int(os.getenv("QUALITY_FINAL_STEPS", "50")),
+        "guidance_scale": float(os.getenv("QUALITY_FINAL_GUIDANCE", "8.5")),
+    },
+}
+QUALITY_DEFAULT = os.getenv("QUALITY_DEFAULT", "final")
+
+# Identifies the weights in result-cache keys; change it when the model changes
+MODEL_REVISION = os.getenv("MODEL_REVISION", "")
+
+# Seeded results are cached on disk (size-bounded LRU) with a small in-memory hot tier
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") == "1"
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.expanduser("~/.cache/sdig/results"))
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+RESULT_CACHE_HOT_ENTRIES = int(os.getenv("RESULT_CACHE_HOT_ENTRIES", "32"))
+# Eviction removes the oldest results until the cache is back under this
+# fraction of RESULT_CACHE_MAX_MB, so it doesn't run again on the next write
+RESULT_CACHE_LOW_WATER = float(os.getenv("RESULT_CACHE_LOW_WATER", "0.9"))
+
+# Upper bounds on distinct frames rendered by one /generate/sweep/ request and
+# on the unit values it may list, checked before any of them is planned
+SWEEP_MAX_FRAMES = int(os.getenv("SWEEP_MAX_FRAMES", "32"))
+SWEEP_MAX_UNITS = int(os.getenv("SWEEP_MAX_UNITS", "1000"))
+
+# /generate/bulk/: most photos per request, and photos rendered at once (so
+# the scheduler can batch them while later photos are still compressed)
+BULK_MAX_IMAGES = int(os.getenv("BULK_MAX_IMAGES", "500"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", str(SCHEDULER_MAX_BATCH_SIZE * 2)))
+
+# Asynchronous /jobs/ API: SQLite job store and the directory for job inputs
+# and results, jobs rendered at once, how long finished jobs are kept (swept
+# every JOB_EXPIRE_INTERVAL seconds), and the keep-alive interval of the
+# /jobs/{id}/events stream
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.expanduser("~/.cache/sdig/jobs.sqlite3"))
+JOB_DIR = os.getenv("JOB_DIR", os.path.expanduser("~/.cache/sdig/jobs"))
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", str(SCHEDULER_MAX_BATCH_SIZE * 2)))
+JOB_TTL_HOURS = float(os.getenv("JOB_TTL_HOURS", "24"))
+JOB_EXPIRE_INTERVAL = float(os.getenv("JOB_EXPIRE_INTERVAL", "600"))
+JOB_EVENT_KEEPALIVE = float(os.getenv("JOB_EVENT_KEEPALIVE", "15"))
+
+# Add a Server-Timing header with per-stage durations to every response
+# (clients can also ask for it per request with "X-Timing: 1")
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "0") == "1"
@@ -1,18 +1,33 @@
 import os
 import torch
-from fastapi import FastAPI, File, UploadFile, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, File, UploadFile, Form, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict
-import cv2
-import numpy as np
-import mediapipe as mp
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
 import json
 import asyncio
-from services.image_generator2 import generate_images
-from PIL import Image
-from io import BytesIO
-import zipfile
+import random
+import time
+import config
+from services.image_generator2 import build_prompt, image_to_bytes, prompt_cache
+from services.batch_scheduler import scheduler
+from model.model_manager import model_manager
+from services.latent_cache import latent_cache, resolve_image
+from services.landmark_stream import (
+    FrameSlot, LandmarkStream, StreamOptions, executor as landmark_executor,
+    pack_landmarks, stream_stats, to_landmark_list
+)
+from services.generation import GENERATION_MODES, generate, generate_dose_sweep, plan_dose_sweep
+from services.bulk import BulkPlan, archive_sources, generate_bulk, stream_bulk_zip, upload_sources
+from services.jobs import job_manager
+from services.previews import current_preview_listener
+from services.result_cache import result_cache
+from services.responses import image_response, negotiate_output
+from services.admission import admission_response, guard_request
+from services.metrics import TimingMiddleware, render_metrics, timed
+from model.schedulers import get_tier
+from schemas.request_schema import ImageGenRequest
 import base64
 
 # Set the CUDA environment variable to manage memory fragmentation
@@ -29,41 +44,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-request stage timings for /metrics and the optional Server-Timing header
+app.add_middleware(TimingMiddleware)
+
+@app.on_event("startup")
+async def start_scheduler():
+    scheduler.start()
+    # With worker replicas the model lives in the workers, not in this process
+    if scheduler.pool is None:
+        model_manager.start()
+    # Resumes /jobs/ that were queued or running when the server stopped
+    job_manager.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+
 # Check if CUDA is available
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 print(f"Using device: {device}")
 
-# Initialize MediaPipe with GPU support
-mp_face_mesh = mp.solutions.face_mesh
-face_mesh = mp_face_mesh.FaceMesh(
-    static_image_mode=False,
-    max_num_faces=1,
-    min_detection_confidence=0.5,
-    min_tracking_confidence=0.5
-)
-
-# Injection points configuration
-INJECTION_POINTS = {
-    "forehead_lines_botox": [10, 151, 338, 67, 107, 336],
-    "frown_lines_glabella_botox": [9, 8, 168, 6, 197, 195, 5],
-    "crows_feet_botox": [263, 362, 386, 133, 173, 156],
-    "nasalis_lines_botox": [98, 327],
-    "vertical_lip_lines_botox": [61, 0, 267, 17, 84, 37],
-    "lip_flip_botox": [0, 267, 37, 17, 287, 84],
-    "smile_lift_botox": [61, 76, 91, 305, 290, 409],
-    "masseter_reduction_botox": [172, 58],
-    "dimpled_chin_botox": [18, 83, 14],
-    "platysmal_bands_botox": [131, 50, 205, 280, 425],
-    "cheek_filler": [50, 205, 429, 280, 425, 449],
-    "smile_line_filler": [61, 91, 76, 290, 305, 409],
-    "lip_filler": [0, 267, 37, 17, 287, 84],
-    "temple_filler": [26, 54, 226, 247, 110],
-    "nose_filler": [4, 5, 6, 248]
-}
-
-# Cache for smoothing landmark positions
-landmark_cache: Dict[str, tuple] = {}
-
 # Store active connections
 active_connections: List[WebSocket] = []
 
@@ -72,53 +72,84 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     active_connections.append(websocket)
     
+    # Smoothing and tracking state belong to this connection only
+    stream = LandmarkStream()
+    loop = asyncio.get_running_loop()
+    reader = None
+    stream_stats.connections += 1
+    
     try:
+        # An optional first text message negotiates the protocol; legacy
+        # clients start sending frames straight away
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        data = None
+        if message.get("text") is not None:
+            options = StreamOptions.from_message(json.loads(message["text"]))
+            await websocket.send_json(options.handshake())
+        else:
+            # Legacy clients never see a handshake, so their frames come back
+            # at full size to match the landmark coordinates
+            options = StreamOptions(scale=1.0)
+            data = message["bytes"]
+
+        # Receive frames on a separate task so stale frames can be dropped
+        # while the newest one is being processed
+        slot = FrameSlot(latest_only=options.ingest == "latest")
+        if data is not None:
+            slot.put(data)
+
+        async def receive_frames():
+            try:
+                while True:
+                    # Receive binary data (image)
+                    slot.put(await websocket.receive_bytes())
+            except WebSocketDisconnect:
+                pass
+            except Exception as e:
+                print(f"Error receiving websocket frame: {str(e)}")
+            finally:
+                slot.close()
+
+        reader = asyncio.create_task(receive_frames())
+        sequence = 0
+        next_frame_at = 0.0
         while True:
-            # Receive binary data (image)
-            data = await websocket.receive_bytes()
-            
-            # Convert bytes to numpy array
-            nparr = np.frombuffer(data, np.uint8)
-            frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            # Process frame with MediaPipe
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            result = face_mesh.process(frame_rgb)
-            
-            landmark_pixel_list = []
+            # Respect the connection's frame-rate cap; newer frames keep replacing
+            # the pending one while we wait
+            if options.max_fps > 0:
+                delay = next_frame_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_frame_at = loop.time() + 1.0 / options.max_fps
+
+            frame = await slot.get()
+            if frame is None:
+                raise WebSocketDisconnect()
+            data, received_at = frame
             
-            if result.multi_face_landmarks:
-                for face_landmarks in result.multi_face_landmarks:
-                    h, w, _ = frame.shape
-                    for name, indices in INJECTION_POINTS.items():
-                        for idx in indices:
-                            if idx < len(face_landmarks.landmark):
-                                lm = face_landmarks.landmark[idx]
-                                x, y = int(lm.x * w), int(lm.y * h)
-                                
-                                # Smooth using cache
-                                prev = landmark_cache.get(f"{name}_{idx}")
-                                if prev:
-                                    x = int(prev[0] * 0.7 + x * 0.3)
-                                    y = int(prev[1] * 0.7 + y * 0.3)
-                                
-                                landmark_cache[f"{name}_{idx}"] = (x, y)
-                                landmark_pixel_list.append({
-                                    "name": name,
-                                    "index": idx,
-                                    "x": x,
-                                    "y": y
-                                })
-                                
-                                # Draw point
-                                cv2.circle(frame, (x, y), 3, (0, 255, 0), -1)
+            # Decode, run MediaPipe and re-encode on a worker thread
+            points, frame_bytes, processing_ms = await loop.run_in_executor(
+                landmark_executor, stream.process, data, options
+            )
+            sequence += 1
             
-            # Send landmarks as JSON
-            await websocket.send_json({"landmarks": landmark_pixel_list})
+            if options.protocol == "binary":
+                await websocket.send_bytes(pack_landmarks(sequence, processing_ms, points))
+            else:
+                # Send landmarks as JSON
+                await websocket.send_json({
+                    "landmarks": to_landmark_list(points) if points is not None else [],
+                    "processing_ms": round(processing_ms, 2),
+                    "dropped_frames": slot.dropped
+                })
             
             # Send processed frame as binary
-            _, buffer = cv2.imencode('.jpg', frame)
-            await websocket.send_bytes(buffer.tobytes())
+            if frame_bytes is not None:
+                await websocket.send_bytes(frame_bytes)
+
+            stream_stats.record((time.perf_counter() - received_at) * 1000, stream.last_tracked)
             
     except WebSocketDisconnect:
         active_connections.remove(websocket)
@@ -126,42 +157,375 @@ async def websocket_endpoint(websocket: WebSocket):
         print(f"Error in websocket_endpoint: {str(e)}")
         if websocket in active_connections:
             active_connections.remove(websocket)
+    finally:
+        if reader is not None:
+            reader.cancel()
+        stream_stats.connections -= 1
+        stream.close()
+
+@app.get("/ws/stats")
+async def websocket_stats():
+    return stream_stats.snapshot()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {"prompt_embeddings": prompt_cache.stats(), "init_latents": latent_cache.stats(),
+            "results": result_cache.stats()}
+
+@app.post("/images/")
+async def upload_image_api(file: UploadFile = File(...)):
+    """Uploads a photo once; later requests can pass the returned image_id instead of the file."""
+    try:
+        entry = await resolve_image(file)
+        width, height = entry.original.size
+        return {"image_id": entry.image_id, "width": width, "height": height}
+    except Exception as e:
+        print(f"Error during image upload: {e}")
+        return {"error": str(e)}
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    engine = scheduler.pool or model_manager
+    return JSONResponse(engine.status(), status_code=200 if engine.ready else 503)
 
 @app.post("/generate/")
 async def generate_images_api(
+    request: Request,
     injection_number: int = Form(...),
     selected_area: str = Form(...),
-    file: UploadFile = File(...)
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    accept: Optional[str] = Header(None)
 ):
     try:
-        # Load image from the uploaded file
-        image = Image.open(BytesIO(await file.read())).convert("RGB")
-        
-        # Monitor initial memory usage
-        print(f"Initial Allocated Memory: {torch.cuda.memory_allocated()} bytes")
-        print(f"Initial Reserved Memory: {torch.cuda.memory_reserved()} bytes")
-        
-        # Generate the image with the provided function
-        result_image = generate_images(image, selected_area, injection_number)[0]
+        # Accept: image/jpeg or image/webp returns the raw image instead of base64 JSON
+        fmt, raw = negotiate_output(accept, output_format)
+
+        # Load the image (and its init latents) from the upload or the cache
+        init_image = await resolve_image(file, image_id)
+
+        # Queue the request; the scheduler batches it with compatible requests
+        # and runs the pipeline off the event loop
+        output_image = await guard_request(
+            request, generate(init_image, selected_area, injection_number, mode, seed, tier)
+        )
 
         # If no image is returned, raise an error
-        if not result_image:
+        if not output_image:
             return {"error": "No generated image found"}
 
-        result_image_bytes = result_image["image_bytes"]
+        result_image_bytes = await run_in_threadpool(image_to_bytes, output_image, fmt, quality)
+        if raw:
+            return image_response(result_image_bytes, fmt, f"{selected_area}-inj{injection_number}")
 
         # Base64 encode the image bytes for returning as a response
-        encoded_image = base64.b64encode(result_image_bytes).decode('utf-8')
-
-        # Clean up and clear the GPU cache
-        torch.cuda.empty_cache()
-        
-        # Monitor memory usage after generation and cleanup
-        print(f"Allocated Memory after: {torch.cuda.memory_allocated()} bytes")
-        print(f"Reserved Memory after: {torch.cuda.memory_reserved()} bytes")
+        with timed("base64"):
+            encoded_image = base64.b64encode(result_image_bytes).decode('utf-8')
 
         return {"image": encoded_image}
 
     except Exception as e:
+        response = admission_response(e)
+        if response is not None:
+            return response
         print(f"Error during image generation: {e}")
         return {"error": str(e)}
+
+
+@app.post("/generate/stream/")
+async def generate_stream_api(
+    request: Request,
+    injection_number: int = Form(...),
+    selected_area: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None)
+):
+    """Server-sent events for one generation: low-quality step previews, then the result.
+
+    Every PREVIEW_EVERY_STEPS denoising steps a "preview" event carries a
+    small JPEG (base64) projected straight from the latents; the "result"
+    event carries the final image like /generate/ does. Closing the stream
+    cancels the generation.
+    """
+    try:
+        fmt, _ = negotiate_output(None, output_format)
+        # The upload is closed once the response starts streaming, so read it first
+        init_image = await resolve_image(file, image_id)
+    except Exception as e:
+        print(f"Error during streamed generation: {e}")
+        return {"error": str(e)}
+
+    def sse(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    async def stream_events():
+        previews: asyncio.Queue = asyncio.Queue()
+
+        def on_preview(step, steps, image):
+            previews.put_nowait({"step": step, "steps": steps,
+                                 "image": base64.b64encode(image).decode('utf-8')})
+
+        # The scheduler picks the listener up from the generation task's context
+        token = current_preview_listener.set(on_preview)
+        task = asyncio.ensure_future(guard_request(
+            request, generate(init_image, selected_area, injection_number, mode, seed, tier)
+        ))
+        current_preview_listener.reset(token)
+
+        try:
+            while not task.done():
+                preview = asyncio.ensure_future(previews.get())
+                await asyncio.wait({task, preview}, return_when=asyncio.FIRST_COMPLETED)
+                if preview.done():
+                    yield sse("preview", preview.result())
+                else:
+                    preview.cancel()
+
+            output_image = task.result()
+            result_image_bytes = await run_in_threadpool(image_to_bytes, output_image, fmt, quality)
+            yield sse("result", {"image": base64.b64encode(result_image_bytes).decode('utf-8'),
+                                 "format": fmt})
+        except Exception as e:
+            print(f"Error during streamed generation: {e}")
+            yield sse("error", {"error": str(e)})
+        finally:
+            task.cancel()
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/generate/multi/")
+async def generate_multi_images_api(
+    http_request: Request,
+    injection_number: int = Form(...),
+    selected_areas: List[str] = Form(...),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None)
+):
+    try:
+        fmt, _ = negotiate_output(None, output_format)
+
+        # Accept repeated form fields as well as a single comma-separated value
+        areas = [area.strip() for value in selected_areas for area in value.split(",") if area.strip()]
+        request = ImageGenRequest(injection_number=injection_number, selected_areas=areas)
+
+        # Encode the photo once and share its latents across every area
+        init_image = await resolve_image(file, image_id)
+        output_images = await guard_request(http_request, asyncio.gather(*(
+            generate(init_image, area, request.injection_number, mode, seed, tier)
+            for area in request.selected_areas
+        )))
+
+        results = []
+        for area, output_image in zip(request.selected_areas, output_images):
+            result_image_bytes = await run_in_threadpool(image_to_bytes, output_image, fmt, quality)
+            results.append({
+                "area": build_prompt(area, request.injection_number)[2],
+                "image": base64.b64encode(result_image_bytes).decode('utf-8')
+            })
+
+        return {"images": results}
+
+    except Exception as e:
+        response = admission_response(e)
+        if response is not None:
+            return response
+        print(f"Error during multi-area image generation: {e}")
+        return {"error": str(e)}
+
+
+def parse_units(units: Optional[str], start: Optional[int], stop: Optional[int], step: int) -> List[int]:
+    """Reads sweep unit values from a comma-separated list or an inclusive range.
+
+    The count is checked against SWEEP_MAX_UNITS before any list is built.
+    """
+    if units:
+        values = [value for value in units.split(",") if value.strip()]
+        count = len(values)
+    elif start is None or stop is None or step <= 0:
+        raise ValueError("Provide units or start, stop and a positive step")
+    else:
+        count = max((stop - start) // step + 1, 0)
+    if count > config.SWEEP_MAX_UNITS:
+        raise ValueError(f"Sweep lists {count} unit values, the limit is {config.SWEEP_MAX_UNITS}")
+    if units:
+        return [int(value) for value in values]
+    return list(range(start, stop + 1, step))
+
+
+@app.post("/generate/sweep/")
+async def generate_sweep_api(
+    selected_area: str = Form(...),
+    units: Optional[str] = Form(None),
+    start: Optional[int] = Form(None),
+    stop: Optional[int] = Form(None),
+    step: int = Form(1),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None)
+):
+    """Renders a series of doses for one area, streaming one NDJSON line per frame as it finishes."""
+    try:
+        fmt, _ = negotiate_output(None, output_format)
+        frames = plan_dose_sweep(selected_area, parse_units(units, start, stop, step))
+        scheduler.admit(len(frames))
+        init_image = await resolve_image(file, image_id)
+        # One noise seed for the whole series so frames differ only by dose
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+    except Exception as e:
+        response = admission_response(e)
+        if response is not None:
+            return response
+        print(f"Error during dose sweep: {e}")
+        return {"error": str(e)}
+
+    async def stream_frames():
+        yield json.dumps({
+            "area": selected_area,
+            "seed": seed,
+            "frames": [{"units": frame["units"], "strength": frame["strength"]} for frame in frames]
+        }) + "\n"
+        try:
+            async for frame, output_image in generate_dose_sweep(init_image, selected_area, frames, seed, tier):
+                result_image_bytes = await run_in_threadpool(image_to_bytes, output_image, fmt, quality)
+                yield json.dumps({
+                    "units": frame["units"],
+                    "strength": frame["strength"],
+                    "image": base64.b64encode(result_image_bytes).decode('utf-8')
+                }) + "\n"
+        except Exception as e:
+            print(f"Error during dose sweep: {e}")
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return StreamingResponse(stream_frames(), media_type="application/x-ndjson")
+
+
+@app.post("/generate/bulk/")
+async def generate_bulk_api(
+    archive: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+    selected_area: Optional[str] = Form(None),
+    injection_number: Optional[int] = Form(None),
+    spec: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None)
+):
+    """Renders a zip (archive) or a list (files) of photos, streaming a zip of results as they finish.
+
+    Results are named originalname-inj{N}.jpg; spec (JSON) can set the area
+    and dose per photo, and a manifest.json at the end lists every render.
+    """
+    try:
+        fmt, _ = negotiate_output(None, output_format)
+        plan = BulkPlan(selected_area, injection_number, spec)
+        if archive is not None:
+            sources = await archive_sources(archive)
+        elif files:
+            sources = await upload_sources(files)
+        else:
+            raise ValueError("Upload a zip as archive or photos as files")
+    except Exception as e:
+        print(f"Error during bulk generation: {e}")
+        return {"error": str(e)}
+
+    results = generate_bulk(sources, plan, mode, seed, tier, fmt, quality)
+    return StreamingResponse(stream_bulk_zip(results), media_type="application/zip",
+                             headers={"Content-Disposition": "attachment; filename=results.zip"})
+
+
+@app.post("/jobs/")
+async def submit_job_api(
+    injection_number: int = Form(...),
+    selected_area: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None)
+):
+    """Queues a render and returns its job_id at once; poll /jobs/{id} or follow /jobs/{id}/events.
+
+    Takes the same fields as /generate/. Submitting the same photo and
+    parameters again returns the existing job instead of rendering twice.
+    """
+    try:
+        # Reject bad parameters now rather than as a failed job later
+        fmt, _ = negotiate_output(None, output_format)
+        build_prompt(selected_area, injection_number)
+        get_tier(tier)
+        if mode not in GENERATION_MODES:
+            raise ValueError(f"Unknown generation mode: {mode}")
+
+        params = {"selected_area": selected_area, "injection_number": injection_number, "mode": mode,
+                  "seed": seed, "tier": tier, "output_format": fmt, "quality": quality}
+        job, deduplicated = await job_manager.submit(params, file, image_id)
+        return {"job_id": job["id"], "status": job["status"], "deduplicated": deduplicated}
+    except Exception as e:
+        print(f"Error during job submission: {e}")
+        return {"error": str(e)}
+
+@app.get("/jobs/{job_id}")
+async def job_status_api(job_id: str):
+    status = job_manager.status(job_id)
+    if status is None:
+        return JSONResponse({"error": f"Unknown or expired job {job_id}"}, status_code=404)
+    return status
+
+@app.get("/jobs/{job_id}/result")
+async def job_result_api(job_id: str):
+    job = job_manager.store.get(job_id)
+    if job is None or job["status"] != "done" or not os.path.exists(job["result_path"] or ""):
+        status = job["status"] if job is not None else "unknown"
+        return JSONResponse({"error": f"No result for job {job_id}", "status": status}, status_code=404)
+
+    params = job["params"]
+    with open(job["result_path"], "rb") as f:
+        result_image_bytes = await run_in_threadpool(f.read)
+    return image_response(result_image_bytes, params["output_format"],
+                          f"{params['selected_area']}-inj{params['injection_number']}")
+
+@app.get("/jobs/{job_id}/events")
+async def job_events_api(job_id: str):
+    """Server-sent events: a status event now and on every change until the job finishes."""
+    if job_manager.status(job_id) is None:
+        return JSONResponse({"error": f"Unknown or expired job {job_id}"}, status_code=404)
+
+    async def stream_events():
+        async for status in job_manager.events(job_id):
+            yield f"event: status\ndata: {json.dumps(status)}\n\n"
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
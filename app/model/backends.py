@@ -0,0 +1,103 @@
+import functools
+import os
+
+import torch
+
+import config
+from model.memory_manager import memory_manager
+from model.shared_weights import is_mmap_loaded
+
+# pytorch:  the pipeline as loaded (fp16 on CUDA, eager fp32 on CPU)
+# cpu:      bfloat16 autocast, channels_last weights and torch.compile (inductor)
+# openvino: torch.compile with the OpenVINO backend; the converted models are
+#           cached in BACKEND_CACHE_DIR, so only the first start pays for it
+BACKENDS = ("pytorch", "cpu", "openvino")
+
+# The calls that carry the cost of a generation. Backends wrap these and keep
+# the diffusers modules themselves, since the service relies on prompt_embeds,
+# init latents, step callbacks and scheduler views of the same components.
+HEAVY_CALLS = (("unet", "forward"), ("vae", "encode"), ("vae", "decode"), ("text_encoder", "forward"))
+# The VAE encode keeps float32: its latents are cached and reused as init latents
+AUTOCAST_CALLS = (("unet", "forward"), ("vae", "decode"), ("text_encoder", "forward"))
+
+
+def get_backend(backend: str = None) -> str:
+    backend = backend or config.INFERENCE_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    return backend
+
+
+def backend_device(backend: str = None) -> str:
+    """The torch device a backend loads the pipeline on; the CPU backends never use CUDA."""
+    if get_backend(backend) == "pytorch" and torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+
+def apply_backend(pipeline, backend: str = None):
+    """Prepares a loaded (and placed) pipeline for a backend, in place."""
+    backend = get_backend(backend)
+    if backend == "pytorch":
+        return pipeline
+
+    if config.BACKEND_CHANNELS_LAST:
+        for name in ("unet", "vae"):
+            module = getattr(pipeline, name)
+            # Converting copies the conv weights out of the mapped file, so every
+            # replica would hold its own copy instead of sharing the page cache
+            if config.WORKER_REPLICAS > 1 and is_mmap_loaded(module):
+                print(f"Keeping {name} weights memory-mapped: no channels_last with {config.WORKER_REPLICAS} replicas")
+                continue
+            module.to(memory_format=torch.channels_last)
+
+    if backend == "cpu":
+        # Keeps compiled kernels across restarts (needs a torch with the FX graph cache)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(config.BACKEND_CACHE_DIR, "inductor"))
+        import torch._inductor.config as inductor_config
+        if hasattr(inductor_config, "fx_graph_cache"):
+            inductor_config.fx_graph_cache = True
+        compile_options = {"backend": "inductor"}
+    else:
+        try:
+            import openvino.torch  # noqa: F401  (registers the "openvino" torch.compile backend)
+        except ImportError:
+            raise RuntimeError("INFERENCE_BACKEND=openvino needs the openvino package")
+        compile_options = {"backend": "openvino", "options": {
+            "device": config.OPENVINO_DEVICE,
+            "model_caching": True,
+            "cache_dir": os.path.join(config.BACKEND_CACHE_DIR, "openvino"),
+        }}
+
+    if config.BACKEND_COMPILE:
+        memory_manager.freeze(pipeline)
+
+    for component, method in HEAVY_CALLS:
+        module = getattr(pipeline, component)
+        call = getattr(module, method)
+        if backend == "cpu" and config.BACKEND_BF16 and (component, method) in AUTOCAST_CALLS:
+            call = autocast(call, torch.bfloat16)
+        if config.BACKEND_COMPILE:
+            call = torch.compile(call, **compile_options)
+        # An instance attribute shadows the class method, so views of the
+        # pipeline built from its components run the same wrapped calls
+        setattr(module, method, call)
+
+    print(f"Inference backend: {backend} (bf16={backend == 'cpu' and config.BACKEND_BF16}, "
+          f"channels_last={config.BACKEND_CHANNELS_LAST}, compile={config.BACKEND_COMPILE})")
+    return pipeline
+
+
+def autocast(call, dtype: torch.dtype):
+    @functools.wraps(call)
+    def autocast_call(*args, **kwargs):
+        with torch.autocast("cpu", dtype=dtype):
+            output = call(*args, **kwargs)
+        # Hand back float32 so guidance and the scheduler step keep full precision
+        if isinstance(output, torch.Tensor):
+            return output.float()
+        if isinstance(output, tuple):
+            return tuple(item.float() if isinstance(item, torch.Tensor) else item for item in output)
+        return output
+    return autocast_call
+
@@ -0,0 +1,244 @@
+import threading
+from typing import Dict, Optional
+
+import torch
+
+import config
+from services.metrics import current_rss_bytes
+
+# How the pipeline's weights are placed: all on the device, moved there one
+# component per call, or streamed in one submodule at a time
+PLACEMENTS = ("resident", "model_offload", "sequential_offload")
+
+# SD-1.5 geometry used by the activation estimates below
+LATENT_SCALE = 8
+ATTENTION_HEADS = 8
+UNET_CHANNELS = 320
+VAE_CHANNELS = 128
+
+
+def module_bytes(module: Optional[torch.nn.Module]) -> int:
+    if module is None:
+        return 0
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def available_bytes(device: str) -> int:
+    """Memory this process can plan for: free device memory on CUDA, available RAM plus our RSS on CPU.
+
+    On CUDA, memory other processes hold is not ours to plan with, but what our
+    caching allocator has reserved is. Worker replicas all load onto the same
+    device, each with its own copy of the weights, so they split it evenly. On
+    the CPU they share one mmap-ed copy of the weights instead (see
+    model/shared_weights.py), and RAM is not split.
+    """
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return (free + torch.cuda.memory_reserved()) // max(config.WORKER_REPLICAS, 1)
+    try:
+        with open("/proc/meminfo") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        available = int(fields["MemAvailable"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return 0
+    return available + (current_rss_bytes() or 0)
+
+
+class MemoryManager:
+    """Places the pipeline within a memory budget and picks per-call memory savers.
+
+    At load time the weights stay resident on the device when they fit next to
+    the activations of a minimal call, otherwise they fall back to model
+    offload and then sequential offload. Before every call, attention slicing
+    and VAE tiling are switched on only if that call's estimated activations
+    don't fit in what the weights leave free; both cost speed, so they are
+    switched off again for calls that fit; compiled backends fix them once
+    instead (see freeze). Peak memory is tracked per policy.
+    """
+
+    def __init__(self):
+        self.device = None
+        self.dtype_size = 4
+        self.budget_bytes = 0
+        self.placement = None
+        self.weights_bytes = 0
+        self.largest_component_bytes = 0
+        self.resident_bytes = None
+        self._flags: Dict[int, dict] = {}
+        # Policy labels of pipelines whose memory savers are fixed (see freeze), by UNet
+        self._frozen: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._policies: Dict[str, dict] = {}
+
+    def place(self, pipeline, device: str):
+        """Moves a freshly loaded pipeline onto the device according to MEMORY_POLICY."""
+        self.device = device
+        self.dtype_size = torch.empty((), dtype=pipeline.unet.dtype).element_size()
+        self.budget_bytes = int(config.MEMORY_BUDGET_MB * 1024 * 1024) or available_bytes(device)
+        sizes = [module_bytes(getattr(pipeline, name, None)) for name in ("unet", "vae", "text_encoder")]
+        self.weights_bytes = sum(sizes)
+        self.largest_component_bytes = max(sizes)
+
+        if device == "cuda" and config.MEMORY_BUDGET_MB:
+            # Make the budget binding for the caching allocator too
+            _, total = torch.cuda.mem_get_info()
+            torch.cuda.set_per_process_memory_fraction(min(self.budget_bytes / total, 1.0))
+
+        placement = config.MEMORY_POLICY
+        if placement == "auto":
+            placement = self._choose_placement()
+        if placement not in PLACEMENTS:
+            raise ValueError(f"Unknown memory policy: {placement}")
+
+        # Offloading installs its own device hooks, so the pipeline must not be moved first
+        if placement == "resident" or device != "cuda":
+            pipeline.to(device)
+        elif placement == "model_offload":
+            pipeline.enable_model_cpu_offload()
+        else:
+            pipeline.enable_sequential_cpu_offload()
+
+        self.placement = placement
+        self.resident_bytes = self.current_bytes()
+        print(f"Model placement: {placement} ({self.weights_bytes / 2 ** 20:.0f} MB of weights, "
+              f"{self.budget_bytes / 2 ** 20:.0f} MB budget on {device})")
+        return pipeline
+
+    def _choose_placement(self) -> str:
+        # Offloading only moves weights between CPU RAM and an accelerator
+        if self.device != "cuda":
+            return "resident"
+        minimal_call = self.call_bytes(config.RESIZE_MIN_SIZE, config.RESIZE_MIN_SIZE, 1, True, True)
+        if self.weights_bytes + minimal_call <= self.budget_bytes:
+            return "resident"
+        if self.largest_component_bytes + minimal_call <= self.budget_bytes:
+            return "model_offload"
+        return "sequential_offload"
+
+    def attention_bytes(self, width: int, height: int, batch: int, sliced: bool = False) -> int:
+        """Rough size of the largest self-attention score matrix (with CFG doubling the batch)."""
+        tokens = (width // LATENT_SCALE) * (height // LATENT_SCALE)
+        heads = 1 if sliced else ATTENTION_HEADS
+        return 2 * batch * heads * tokens * tokens * self.dtype_size
+
+    def decode_bytes(self, width: int, height: int, batch: int, tiled: bool = False) -> int:
+        """Rough size of the VAE decoder's full-resolution feature maps."""
+        if tiled:
+            width = height = min(width, height, 512)
+        return 4 * batch * width * height * VAE_CHANNELS * self.dtype_size
+
+    def call_bytes(self, width: int, height: int, batch: int,
+                   slicing: bool = False, tiling: bool = False) -> int:
+        tokens = (width // LATENT_SCALE) * (height // LATENT_SCALE)
+        unet = 2 * batch * tokens * UNET_CHANNELS * self.dtype_size * 16
+        return unet + max(self.attention_bytes(width, height, batch, slicing),
+                          self.decode_bytes(width, height, batch, tiling))
+
+    def headroom_bytes(self) -> int:
+        """Budget left for activations after the weights that stay on the device."""
+        on_device = {
+            "resident": self.weights_bytes,
+            "model_offload": self.largest_component_bytes,
+            "sequential_offload": 0,
+        }.get(self.placement, self.weights_bytes)
+        return self.budget_bytes - on_device
+
+    def prepare(self, pipeline, width: int, height: int, batch: int) -> str:
+        """Switches attention slicing and VAE tiling for one call; returns the policy label."""
+        if self.placement is None:
+            # Not placed by us, so there is no budget to plan against
+            return "unmanaged"
+        frozen = self._frozen.get(id(pipeline.unet))
+        if frozen is not None:
+            return frozen
+        headroom = self.headroom_bytes()
+        slicing = self._decide(config.MEMORY_ATTENTION_SLICING,
+                               self.call_bytes(width, height, batch) > headroom)
+        tiling = self._decide(config.MEMORY_VAE_TILING,
+                              self.call_bytes(width, height, batch, slicing) > headroom)
+
+        with self._lock:
+            # Quality-tier views share these components, so track state per module
+            unet_flags = self._flags.setdefault(id(pipeline.unet), {})
+            if unet_flags.get("slicing") != slicing:
+                if slicing:
+                    pipeline.enable_attention_slicing()
+                else:
+                    pipeline.disable_attention_slicing()
+                unet_flags["slicing"] = slicing
+            vae_flags = self._flags.setdefault(id(pipeline.vae), {})
+            if vae_flags.get("tiling") != tiling:
+                if tiling:
+                    pipeline.vae.enable_tiling()
+                else:
+                    pipeline.vae.disable_tiling()
+                vae_flags["tiling"] = tiling
+
+        return "+".join([self.placement or "resident"] + ["attention_slicing"] * slicing + ["vae_tiling"] * tiling)
+
+    def freeze(self, pipeline) -> str:
+        """Sets attention slicing and VAE tiling once, for the largest expected call.
+
+        Compiled backends trace through the attention processors and the VAE
+        decode, so switching them per call would force a recompile; after this
+        prepare() leaves them as they are.
+        """
+        size = config.RESIZE_MAX_SIZE
+        policy = self.prepare(pipeline, size, size, config.SCHEDULER_MAX_BATCH_SIZE)
+        with self._lock:
+            self._frozen[id(pipeline.unet)] = policy
+        return policy
+
+    @staticmethod
+    def _decide(setting: str, needed: bool) -> bool:
+        if setting == "on":
+            return True
+        if setting == "off":
+            return False
+        return needed
+
+    def recover(self, pipeline) -> str:
+        """After an out-of-memory error: release cached blocks and force every memory saver on.
+
+        This is the only place the allocator cache is emptied; doing it after
+        every request would just make the next one allocate from scratch.
+        """
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        with self._lock:
+            pipeline.enable_attention_slicing()
+            pipeline.vae.enable_tiling()
+            self._flags[id(pipeline.unet)] = {"slicing": True}
+            self._flags[id(pipeline.vae)] = {"tiling": True}
+            policy = f"{self.placement or 'resident'}+attention_slicing+vae_tiling"
+            if id(pipeline.unet) in self._frozen:
+                self._frozen[id(pipeline.unet)] = policy
+        return policy
+
+    def current_bytes(self) -> Optional[int]:
+        if self.device == "cuda":
+            return torch.cuda.memory_allocated()
+        return current_rss_bytes()
+
+    def record(self, policy: str, peak_bytes: Optional[int]):
+        with self._lock:
+            stats = self._policies.setdefault(policy, {"calls": 0, "peak_bytes": 0})
+            stats["calls"] += 1
+            if peak_bytes is not None:
+                stats["peak_bytes"] = max(stats["peak_bytes"], peak_bytes)
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "device": self.device,
+                "placement": self.placement,
+                "budget_bytes": self.budget_bytes,
+                "weights_bytes": self.weights_bytes,
+                "resident_bytes": self.resident_bytes,
+                "current_bytes": self.current_bytes() if self.device else None,
+                "policies": {policy: dict(stats) for policy, stats in self._policies.items()},
+            }
+
+
+memory_manager = MemoryManager()
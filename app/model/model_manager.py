@@ -0,0 +1,138 @@
+import threading
+import time
+from typing import Callable, List
+
+from PIL import Image
+
+import config
+from model.backends import apply_backend, get_backend
+from model.memory_manager import memory_manager
+from model.sd_model1 import load_model
+
+
+class ModelManager:
+    """Owns the single diffusion pipeline shared by every app and service.
+
+    Loading happens either in a background thread once the server is up or
+    lazily on first use. After loading, a warmup inference and any registered
+    warmup hooks run before the model reports ready. If warmup fails the
+    pipeline still serves requests, but the state is "degraded" and the model
+    does not report ready.
+    """
+
+    def __init__(self, loader: Callable = load_model):
+        self._loader = loader
+        self._warmups: List[Callable] = []
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._loader_thread = None
+        self.pipeline = None
+        self.backend = get_backend()
+        self.state = "not_loaded"
+        self.error = None
+        self.load_seconds = None
+
+    @property
+    def source(self) -> str:
+        return config.MODEL_PATH or config.MODEL_ID
+
+    @property
+    def revision(self) -> str:
+        """Identifies the loaded weights (and backend, which changes numerics) for caches keyed on model output."""
+        revision = config.MODEL_REVISION or self.source
+        return revision if self.backend == "pytorch" else f"{revision}+{self.backend}"
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def add_warmup(self, fn: Callable):
+        """Registers a hook to run on the loader thread before the model reports ready."""
+        self._warmups.append(fn)
+
+    def start(self):
+        """Called on app startup; begins loading unless configured to load lazily."""
+        if config.MODEL_LOAD_MODE == "background":
+            self.start_background_load()
+
+    def start_background_load(self):
+        if self._claim_load():
+            threading.Thread(target=self._load, name="model-loader", daemon=True).start()
+
+    def get_pipeline(self, timeout: float = None):
+        """Returns the loaded pipeline, loading it now or waiting for the loader if needed."""
+        # Warmup hooks run on the loader thread and may use the pipeline before it is ready
+        if self.pipeline is not None and self._loader_thread == threading.get_ident():
+            return self.pipeline
+
+        if not self._loaded.is_set():
+            if self._claim_load():
+                self._load()
+            elif not self._loaded.wait(timeout or config.MODEL_LOAD_TIMEOUT):
+                raise RuntimeError("Model is still loading, try again shortly")
+
+        if self.pipeline is None:
+            raise RuntimeError(f"Model failed to load: {self.error}")
+        return self.pipeline
+
+    def set_pipeline(self, pipeline, backend: str = None):
+        """Installs an already-built pipeline (e.g. a stand-in for benchmarks)."""
+        self.backend = get_backend(backend)
+        self.pipeline = apply_backend(memory_manager.place(pipeline, pipeline.device.type), self.backend)
+        self.state = "ready"
+        self.error = None
+        self._loaded.set()
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "model": self.source,
+            "revision": self.revision,
+            "backend": self.backend,
+            "load_seconds": self.load_seconds,
+            "error": self.error,
+            "memory": memory_manager.status(),
+        }
+
+    def _claim_load(self) -> bool:
+        with self._lock:
+            if self.state != "not_loaded":
+                return False
+            self.state = "loading"
+            return True
+
+    def _load(self):
+        started = time.monotonic()
+        self._loader_thread = threading.get_ident()
+        try:
+            print(f"Loading model from {self.source}...")
+            self.pipeline = self._loader(config.MODEL_PATH or None)
+            self.state = "warming_up"
+            self._warmup()
+            self.state = "ready"
+        except Exception as e:
+            print(f"Error while loading model: {e}")
+            self.error = str(e)
+            self.state = "failed" if self.pipeline is None else "degraded"
+        finally:
+            self.load_seconds = time.monotonic() - started
+            self._loader_thread = None
+            self._loaded.set()
+        print(f"Model {self.state} after {self.load_seconds:.1f}s")
+
+    def _warmup(self):
+        if not config.MODEL_WARMUP:
+            return
+        # A tiny img2img pass compiles kernels and allocates buffers ahead of the first request
+        size = config.MODEL_WARMUP_SIZE
+        self.pipeline(
+            prompt="warmup",
+            image=Image.new("RGB", (size, size)),
+            strength=0.5,
+            num_inference_steps=2,
+        )
+        for fn in self._warmups:
+            fn()
+
+
+model_manager = ModelManager()
@@ -0,0 +1,66 @@
+import threading
+from typing import Dict, Tuple
+
+from diffusers import (
+    DDIMScheduler,
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    LCMScheduler,
+)
+
+import config
+
+# Scheduler classes selectable by name in config.QUALITY_TIERS, with the
+# extra config each one is built with
+SCHEDULERS = {
+    "dpmsolver++": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}),
+    "euler": (EulerDiscreteScheduler, {}),
+    "euler_a": (EulerAncestralDiscreteScheduler, {}),
+    "ddim": (DDIMScheduler, {}),
+    # Only useful with LCM-distilled weights (e.g. an LCM-LoRA fused into the UNet)
+    "lcm": (LCMScheduler, {}),
+}
+
+# Set on a pipeline by enable_model_cpu_offload; the view needs them too, or it
+# never offloads the models again after a call (maybe_free_model_hooks)
+OFFLOAD_STATE = ("_all_hooks", "_offload_gpu_id", "_offload_device")
+
+# Scheduler name -> (base pipeline, view sharing its components)
+_views: Dict[str, Tuple[object, object]] = {}
+_lock = threading.Lock()
+
+
+def get_tier(tier: str = None) -> dict:
+    tier = tier or config.QUALITY_DEFAULT
+    if tier not in config.QUALITY_TIERS:
+        raise ValueError(f"Unknown quality tier: {tier}")
+    return config.QUALITY_TIERS[tier]
+
+
+def pipeline_for_tier(pipeline, tier: str = None):
+    """Returns a view of pipeline that samples with the tier's scheduler.
+
+    The view is built from the pipeline's components, so it shares the
+    already-loaded UNet, VAE and text encoder; only the scheduler differs.
+    Views are built once per scheduler and reused.
+    """
+    name = get_tier(tier)["scheduler"]
+    if name == "default":
+        return pipeline
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler: {name}")
+
+    with _lock:
+        base, view = _views.get(name, (None, None))
+        if base is not pipeline:
+            scheduler_class, overrides = SCHEDULERS[name]
+            scheduler = scheduler_class.from_config(pipeline.scheduler.config, **overrides)
+            view = pipeline.__class__(**{**pipeline.components, "scheduler": scheduler})
+            view.set_progress_bar_config(**getattr(pipeline, "_progress_bar_config", {}))
+            _views[name] = (pipeline, view)
+        # Copied on every call: the base may have been placed again since
+        for attribute in OFFLOAD_STATE:
+            if hasattr(pipeline, attribute):
+                setattr(view, attribute, getattr(pipeline, attribute))
+        return view
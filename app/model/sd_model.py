@@ -1,13 +1,22 @@
 from diffusers import StableDiffusionImg2ImgPipeline
 import torch
 
-def load_model():
+import config
+from model.memory_manager import memory_manager
+
+def load_model(model_path: str = None):
+    local_kwargs = {"local_files_only": True, "use_safetensors": True} if model_path else {}
     pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-        "runwayml/stable-diffusion-v1-5",
-        torch_dtype=torch.float16
-    ).to("cuda")
-    pipe.enable_model_cpu_offload()
+        model_path or config.MODEL_ID,
+        torch_dtype=torch.float16,
+        **local_kwargs
+    )
     pipe.safety_checker = None
-    return pipe
+    return memory_manager.place(pipe, "cuda")
 
-pipeline = load_model()
+def __getattr__(name):
+    # Share the one pipeline owned by the model manager instead of loading a second copy
+    if name == "pipeline":
+        from model.model_manager import model_manager
+        return model_manager.get_pipeline()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
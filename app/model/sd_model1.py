@@ -1,20 +1,68 @@
-from diffusers import StableDiffusionImg2ImgPipeline
+import os
+
+from diffusers import AutoencoderKL, StableDiffusionImg2ImgPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel
 import torch
 
-def load_model():
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Loading model on: {device}")
+import config
+from model.backends import apply_backend, backend_device
+from model.memory_manager import memory_manager
+from model.shared_weights import load_mmap_component
 
-    pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-        "runwayml/stable-diffusion-v1-5",
-        torch_dtype=torch.float16 if device == "cuda" else torch.float32
-    ).to(device)
+def load_mmap_components(model_path: str, dtype: torch.dtype) -> dict:
+    """Loads the UNet, VAE and text encoder of a local snapshot from memory-mapped safetensors.
 
-    if device == "cuda":
-        pipe.enable_attention_slicing()
-        pipe.enable_model_cpu_offload()
+    Components that can't be mapped are left out and load the regular way.
+    """
+    components = {
+        "unet": (
+            lambda: UNet2DConditionModel.from_config(UNet2DConditionModel.load_config(model_path, subfolder="unet")),
+            "diffusion_pytorch_model.safetensors",
+        ),
+        "vae": (
+            lambda: AutoencoderKL.from_config(AutoencoderKL.load_config(model_path, subfolder="vae")),
+            "diffusion_pytorch_model.safetensors",
+        ),
+        "text_encoder": (
+            lambda: CLIPTextModel(CLIPTextConfig.from_pretrained(model_path, subfolder="text_encoder")),
+            "model.safetensors",
+        ),
+    }
 
+    loaded = {}
+    for name, (build, filename) in components.items():
+        try:
+            loaded[name] = load_mmap_component(build, os.path.join(model_path, name, filename), dtype)
+        except (OSError, ValueError) as e:
+            print(f"Loading {name} without mmap: {e}")
+    return loaded
+
+def load_model(model_path: str = None):
+    device = backend_device()
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    print(f"Loading model on: {device}")
+
+    # A local snapshot never touches the network. Its weights are memory-mapped,
+    # so every worker process on the machine shares one copy of them.
+    source = model_path or config.MODEL_ID
+    local_kwargs = {"local_files_only": True, "use_safetensors": True} if model_path else {}
+    if model_path and config.MODEL_MMAP:
+        local_kwargs.update(load_mmap_components(model_path, dtype))
+
+    pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
+        source,
+        torch_dtype=dtype,
+        **local_kwargs
+    )
     pipe.safety_checker = None
-    return pipe
 
-pipeline = load_model()
+    # Resident, offloaded or sequentially offloaded depending on the memory budget,
+    # then prepared for the configured inference backend
+    return apply_backend(memory_manager.place(pipe, device))
+
+def __getattr__(name):
+    # The pipeline is no longer loaded at import time; it is owned by the shared model manager
+    if name == "pipeline":
+        from model.model_manager import model_manager
+        return model_manager.get_pipeline()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
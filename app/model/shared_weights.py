@@ -0,0 +1,85 @@
+import json
+import mmap
+import os
+import struct
+from typing import Callable, Dict
+
+import torch
+from accelerate import init_empty_weights
+
+# safetensors dtype names -> (torch dtype, bytes per element)
+SAFETENSORS_DTYPES = {
+    "F64": (torch.float64, 8),
+    "F32": (torch.float32, 4),
+    "F16": (torch.float16, 2),
+    "BF16": (torch.bfloat16, 2),
+    "I64": (torch.int64, 8),
+    "I32": (torch.int32, 4),
+    "I16": (torch.int16, 2),
+    "I8": (torch.int8, 1),
+    "U8": (torch.uint8, 1),
+    "BOOL": (torch.bool, 1),
+}
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """Maps a .safetensors file and returns tensors that view the mapping directly.
+
+    The file is mapped copy-on-write (ACCESS_COPY): pages stay shared with the
+    page cache, and so with every other process mapping the same file, until
+    something writes to them. Nothing is read until a tensor is touched.
+    """
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    header_size = struct.unpack("<Q", mapped[:8])[0]
+    header = json.loads(mapped[8:8 + header_size])
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        dtype, itemsize = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        count = (end - start) // itemsize
+        if count:
+            tensor = torch.frombuffer(mapped, dtype=dtype, count=count, offset=data_start + start)
+        else:
+            tensor = torch.empty(0, dtype=dtype)
+        tensors[name] = tensor.reshape(info["shape"])
+    return tensors
+
+
+def load_mmap_component(build: Callable[[], torch.nn.Module], weights_path: str,
+                        dtype: torch.dtype) -> torch.nn.Module:
+    """Builds a model without allocating weights and points its parameters at a mapped file.
+
+    build() constructs the module from its config; it runs under
+    init_empty_weights so parameters start on the meta device. Buffers are
+    allocated normally. Raises ValueError when the file doesn't cover every
+    parameter (e.g. legacy key names), so the caller can fall back to a
+    regular load.
+    """
+    with init_empty_weights():
+        model = build()
+
+    state_dict = mmap_safetensors(weights_path)
+    expected = model.state_dict()
+    missing = [key for key in expected if key not in state_dict and expected[key].is_meta]
+    if missing:
+        raise ValueError(f"{os.path.basename(weights_path)} is missing {len(missing)} weights, e.g. {missing[0]}")
+
+    # A dtype change copies the tensor out of the mapping; keep snapshots in the serving dtype
+    state_dict = {
+        key: tensor if tensor.dtype == dtype or not tensor.is_floating_point() else tensor.to(dtype)
+        for key, tensor in state_dict.items()
+        if key in expected
+    }
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model._mmap_weights = weights_path
+    return model.eval()
+
+
+def is_mmap_loaded(module: torch.nn.Module) -> bool:
+    """Whether the module's weights view a mapped file (see load_mmap_component)."""
+    return getattr(module, "_mmap_weights", None) is not None
@@ -0,0 +1,93 @@
+import asyncio
+import contextvars
+from typing import Awaitable, Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+import config
+
+
+class Overloaded(Exception):
+    """The generation queue is full; the client should retry after retry_after seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+# Set around a pipeline call; returns True once nobody is waiting for the result
+current_cancel_check: contextvars.ContextVar = contextvars.ContextVar("current_cancel_check", default=None)
+
+
+def raise_if_cancelled():
+    """Called between denoising steps to abandon work whose requests are gone."""
+    check = current_cancel_check.get()
+    if check is not None and check():
+        raise GenerationCancelled("Every request in the batch was cancelled")
+
+
+def request_timeout(request: Request) -> Optional[float]:
+    """The request's deadline in seconds: X-Request-Timeout, capped by REQUEST_TIMEOUT."""
+    timeout = config.REQUEST_TIMEOUT or None
+    header = request.headers.get("x-request-timeout")
+    if header:
+        try:
+            requested = float(header)
+        except ValueError:
+            raise ValueError(f"Invalid X-Request-Timeout: {header}")
+        if requested > 0:
+            timeout = min(requested, timeout) if timeout else requested
+    return timeout
+
+
+async def guard_request(request: Request, awaitable: Awaitable):
+    """Awaits a generation on behalf of an HTTP request.
+
+    The work is cancelled when the client disconnects or the request's deadline
+    passes; cancelling frees its place in the queue and, once every request in
+    a running batch is gone, stops the batch between denoising steps.
+    """
+    loop = asyncio.get_running_loop()
+    timeout = request_timeout(request)
+    deadline = loop.time() + timeout if timeout else None
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            wait = config.DISCONNECT_POLL_SECONDS
+            if deadline is not None:
+                wait = min(wait, max(deadline - loop.time(), 0))
+            done, _ = await asyncio.wait({task}, timeout=wait)
+            if done:
+                return task.result()
+            if deadline is not None and loop.time() >= deadline:
+                raise DeadlineExceeded(f"Generation did not finish within {timeout:g}s")
+            if await request.is_disconnected():
+                raise ClientDisconnected("Client disconnected")
+    finally:
+        task.cancel()
+
+
+def admission_response(error: Exception) -> Optional[JSONResponse]:
+    """Maps admission errors to HTTP responses; None for any other error."""
+    if isinstance(error, Overloaded):
+        return JSONResponse({"error": str(error)}, status_code=429,
+                            headers={"Retry-After": str(error.retry_after)})
+    if isinstance(error, DeadlineExceeded):
+        return JSONResponse({"error": str(error)}, status_code=504)
+    if isinstance(error, ClientDisconnected):
+        # Nobody reads it; 499 marks the request in access logs
+        return JSONResponse({"error": str(error)}, status_code=499)
+    return None
@@ -0,0 +1,264 @@
+import asyncio
+import contextvars
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+import config
+from model.schedulers import get_tier
+from services.admission import GenerationCancelled, Overloaded, current_cancel_check
+from services.image_generator2 import build_prompt, generate_images_batch
+from services.metrics import RequestTimings, current_timings, stage_seconds
+from services.previews import current_preview_listener, current_preview_sink
+from services.worker_pool import WorkerPool
+
+
+class GenerationJob:
+    """A single /generate/ request waiting to be batched."""
+
+    def __init__(self, image: Image.Image, area: str, injection_number: int, strength: float,
+                 init_latents: torch.Tensor = None, seed: Optional[int] = None,
+                 tier: Optional[str] = None):
+        self.image = image
+        self.init_latents = init_latents
+        self.seed = seed
+        self.area = area
+        self.injection_number = injection_number
+        self.strength = strength
+        self.tier = tier
+        self.enqueued_at = time.monotonic()
+        self.timings = current_timings.get()
+        self.on_preview = current_preview_listener.get()
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def abandoned(self) -> bool:
+        # The future is cancelled when the waiting request is cancelled (disconnect or deadline)
+        return self.future.done()
+
+    @property
+    def key(self) -> Tuple:
+        # Only requests with the same resolution, strength and quality tier can share a pipeline call
+        return (self.image.size, self.strength, self.tier)
+
+
+class BatchScheduler:
+    """Collects concurrent generation requests and runs compatible ones as one batch.
+
+    The pipeline runs on a single background thread so the event loop (and the
+    /ws landmark stream) stays responsive while a batch is denoising. With
+    worker replicas configured, batches go to the worker pool instead, one
+    batch in flight per replica.
+    """
+
+    def __init__(self, max_batch_size: int = config.SCHEDULER_MAX_BATCH_SIZE,
+                 max_wait_ms: float = config.SCHEDULER_MAX_WAIT_MS,
+                 strength_bucket: float = config.SCHEDULER_STRENGTH_BUCKET,
+                 replicas: int = config.WORKER_REPLICAS,
+                 max_queue: int = config.SCHEDULER_MAX_QUEUE):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self.strength_bucket = strength_bucket
+        self.max_queue = max_queue
+        # Moving average of batch duration, for Retry-After estimates
+        self.batch_seconds = 1.0
+        self.pool = WorkerPool(replicas, config.WORKER_THREADS, config.WORKER_PIN_CPUS) if replicas > 0 else None
+        self._queue: asyncio.Queue = None
+        self._slots: asyncio.Semaphore = None
+        self._groups: Dict[Tuple, List[GenerationJob]] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+        self._task: asyncio.Task = None
+        self._dispatching = set()
+
+    def start(self):
+        # Also restart when the previous loop is gone (e.g. a second asyncio.run
+        # in tests or benchmarks): its queue and task can't be used from this one
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._groups.clear()
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.pool.replicas if self.pool else 1)
+            if self.pool is not None:
+                self.pool.start()
+            self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for jobs in self._groups.values():
+            for job in jobs:
+                job.future.cancel()
+        self._groups.clear()
+        if self.pool is not None:
+            self.pool.stop()
+
+    def bucket_strength(self, strength: float) -> float:
+        if self.strength_bucket <= 0:
+            return strength
+        return round(round(strength / self.strength_bucket) * self.strength_bucket, 4)
+
+    @property
+    def pending(self) -> int:
+        """Requests queued but not yet dispatched."""
+        waiting = sum(not job.abandoned for jobs in self._groups.values() for job in jobs)
+        return waiting + (self._queue.qsize() if self._queue is not None else 0)
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog should have been worked off."""
+        parallel = self.max_batch_size * (self.pool.replicas if self.pool else 1)
+        return max(1, math.ceil(self.pending / parallel * self.batch_seconds))
+
+    def admit(self, count: int = 1):
+        """Raises Overloaded unless count more requests fit in the queue."""
+        if self.max_queue > 0 and self.pending + count > self.max_queue:
+            raise Overloaded(self.retry_after())
+
+    async def run(self, fn, *args):
+        """Runs a one-off model call (e.g. a VAE encode) on the pipeline thread or a worker."""
+        if self.pool is not None:
+            return await self.pool.run(fn, *args)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, context.run, fn, *args)
+
+    async def submit(self, image: Image.Image, area: str, injection_number: int,
+                     init_latents: torch.Tensor = None, seed: Optional[int] = None,
+                     tier: Optional[str] = None) -> Image.Image:
+        """Queues a request and waits for its generated image.
+
+        Passing init_latents (from encode_image) lets several requests for the
+        same photo share one VAE encode; a seed makes the result reproducible.
+        Raises Overloaded when max_queue requests are already waiting.
+        """
+        self.start()
+        self.admit()
+        # Unknown areas and tiers raise ValueError before anything is queued
+        _, strength, _ = build_prompt(area, injection_number)
+        tier = tier or config.QUALITY_DEFAULT
+        get_tier(tier)
+        job = GenerationJob(image, area, injection_number, self.bucket_strength(strength), init_latents, seed, tier)
+        self._queue.put_nowait(job)
+        return await job.future
+
+    def _add(self, job: GenerationJob):
+        self._groups.setdefault(job.key, []).append(job)
+
+    def _drain(self):
+        while not self._queue.empty():
+            self._add(self._queue.get_nowait())
+
+    async def _run(self):
+        while True:
+            if not self._groups:
+                self._add(await self._queue.get())
+            # Wait for a free pipeline before picking a batch, so requests
+            # arriving meanwhile can still join it
+            await self._slots.acquire()
+            self._drain()
+
+            # Serve the group whose oldest request has waited the longest
+            key = min(self._groups, key=lambda k: self._groups[k][0].enqueued_at)
+            jobs = self._groups[key]
+            wait = jobs[0].enqueued_at + self.max_wait - time.monotonic()
+            if len(jobs) < self.max_batch_size and wait > 0:
+                self._slots.release()
+                try:
+                    self._add(await asyncio.wait_for(self._queue.get(), wait))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = jobs[:self.max_batch_size]
+            if len(jobs) > self.max_batch_size:
+                self._groups[key] = jobs[self.max_batch_size:]
+            else:
+                del self._groups[key]
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatched)
+
+    def _dispatched(self, task: asyncio.Task):
+        self._dispatching.discard(task)
+        self._slots.release()
+
+    async def _dispatch(self, batch: List[GenerationJob]):
+        # Skip requests whose client went away or whose deadline passed while queued
+        batch = [job for job in batch if not job.abandoned]
+        if not batch:
+            return
+
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        for job in batch:
+            stage_seconds.observe(now - job.enqueued_at, "queue_wait")
+            if job.timings is not None:
+                job.timings.add("queue_wait", now - job.enqueued_at)
+
+        # Stages measured inside the batch are shared by every request in it
+        batch_timings = RequestTimings()
+        args = (
+            [job.image for job in batch],
+            [job.area for job in batch],
+            [job.injection_number for job in batch],
+            batch[0].strength,
+            [job.init_latents for job in batch],
+            [job.seed for job in batch],
+            batch[0].tier,
+        )
+
+        # Stop denoising once nobody is waiting for any image in the batch
+        def cancelled():
+            return all(job.abandoned for job in batch)
+
+        # Route step previews to the requests that stream them
+        previews = None
+        wanted = [job.on_preview is not None for job in batch]
+        if any(wanted):
+            def previews(step, steps, images):
+                for job, image in zip(batch, images):
+                    if image is not None and not job.abandoned:
+                        loop.call_soon_threadsafe(job.on_preview, step, steps, image)
+
+        started = time.monotonic()
+        try:
+            if self.pool is not None:
+                images = await self.pool.run(
+                    generate_images_batch, *args, timings=batch_timings, cancel_check=cancelled,
+                    on_preview=previews, preview_mask=wanted
+                )
+            else:
+                context = contextvars.Context()
+                context.run(current_timings.set, batch_timings)
+                context.run(current_cancel_check.set, cancelled)
+                context.run(current_preview_sink.set, (previews, wanted) if previews else None)
+                images = await loop.run_in_executor(self._executor, context.run, generate_images_batch, *args)
+        except Exception as e:
+            if isinstance(e, GenerationCancelled) or cancelled():
+                print(f"Cancelled batch of {len(batch)} after {time.monotonic() - started:.1f}s")
+            else:
+                print(f"Error during batched generation: {e}")
+            self._merge(batch, batch_timings)
+            for job in batch:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+
+        self.batch_seconds = 0.8 * self.batch_seconds + 0.2 * (time.monotonic() - started)
+        self._merge(batch, batch_timings)
+        for job, image in zip(batch, images):
+            # The client may have gone away while the batch was running
+            if not job.future.done():
+                job.future.set_result(image)
+
+    @staticmethod
+    def _merge(batch: List[GenerationJob], batch_timings: RequestTimings):
+        for job in batch:
+            if job.timings is not None:
+                job.timings.merge(batch_timings)
+
+
+scheduler = BatchScheduler()
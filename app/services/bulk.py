@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import json
+import posixpath
+import tempfile
+import zipfile
+from io import BytesIO
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+import config
+from services.generation import generate_when_admitted
+from services.image_generator2 import image_to_bytes
+from services.latent_cache import CachedImage, encode_upload
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+# (photo name, loader returning the photo's cached init image)
+BulkSource = Tuple[str, Callable[[], Awaitable[CachedImage]]]
+
+
+class BulkPlan:
+    """Which (area, units) renders each photo of a bulk request gets.
+
+    The global area and dose apply to every photo; spec (JSON) overrides them
+    per photo, keyed by file name or path, with an object or a list of objects
+    holding selected_area and/or injection_number.
+    """
+
+    def __init__(self, selected_area: Optional[str], injection_number: Optional[int], spec: Optional[str]):
+        self.default = {"selected_area": selected_area, "injection_number": injection_number}
+        self.overrides: Dict[str, List[dict]] = {}
+        if spec:
+            parsed = json.loads(spec)
+            if not isinstance(parsed, dict):
+                raise ValueError("spec must map file names to {selected_area, injection_number}")
+            for name, value in parsed.items():
+                self.overrides[name] = value if isinstance(value, list) else [value]
+
+    @property
+    def multiple(self) -> bool:
+        return any(len(renders) > 1 for renders in self.overrides.values())
+
+    def renders(self, name: str) -> List[Tuple[str, int]]:
+        entries = self.overrides.get(name) or self.overrides.get(posixpath.basename(name)) or [{}]
+        renders = []
+        for entry in entries:
+            area = entry.get("selected_area", self.default["selected_area"])
+            units = entry.get("injection_number", self.default["injection_number"])
+            if area is None or units is None:
+                raise ValueError(f"No selected_area/injection_number for {name}")
+            renders.append((area, int(units)))
+        return renders
+
+
+def output_name(name: str, area: str, units: int, fmt: str, with_area: bool) -> str:
+    """originalname-inj{N}.jpg, with the area added when a photo gets several renders."""
+    directory, filename = posixpath.split(name.replace("\\", "/"))
+    stem = posixpath.splitext(filename)[0]
+    extension = ".jpg" if fmt == "jpeg" else f".{fmt}"
+    label = f"{stem}-{area}-inj{units}" if with_area else f"{stem}-inj{units}"
+    return posixpath.join(directory, label + extension)
+
+
+def unique_name(name: str, used: Set[str]) -> str:
+    """name, or name-2, name-3... if it is already in used (e.g. same-named photos from different folders)."""
+    stem, extension = posixpath.splitext(name)
+    candidate, index = name, 1
+    while candidate in used:
+        index += 1
+        candidate = f"{stem}-{index}{extension}"
+    used.add(candidate)
+    return candidate
+
+
+async def detach_upload(file, max_bytes: int):
+    """Copies an upload into a temporary file this module owns.
+
+    FastAPI closes form uploads as soon as the endpoint returns, which is
+    before a streamed response has been sent. The copy is chunked, so the
+    photos never sit in memory together, and stops at max_bytes.
+    """
+    copy = tempfile.TemporaryFile()
+    size = 0
+    try:
+        await file.seek(0)
+        while True:
+            chunk = await file.read(config.UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise ValueError(f"{file.filename} is larger than the {max_bytes / 2 ** 20:g} MB limit")
+            await run_in_threadpool(copy.write, chunk)
+    except Exception:
+        copy.close()
+        raise
+    copy.seek(0)
+    return copy
+
+
+async def archive_sources(archive) -> AsyncIterator[BulkSource]:
+    """Detaches an uploaded zip (up to BULK_MAX_IMAGES photos of UPLOAD_MAX_MB) and lists its photos."""
+    limit = int(config.BULK_MAX_IMAGES * config.UPLOAD_MAX_MB * 1024 * 1024)
+    file = await detach_upload(archive, limit)
+    try:
+        return zip_sources(file)
+    except Exception:
+        file.close()
+        raise
+
+
+def zip_sources(file) -> AsyncIterator[BulkSource]:
+    """Lists the photos of a zip; each is decompressed only when the iterator reaches it."""
+    archive = zipfile.ZipFile(file)
+    entries = [
+        info for info in archive.infolist()
+        if not info.is_dir()
+        and not posixpath.basename(info.filename).startswith(".")
+        and "__MACOSX" not in info.filename
+        and info.filename.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+    if not entries:
+        raise ValueError("Archive contains no photos")
+    if len(entries) > config.BULK_MAX_IMAGES:
+        raise ValueError(f"Archive has {len(entries)} photos, the limit is {config.BULK_MAX_IMAGES}")
+    return _read_entries(file, archive, entries)
+
+
+async def _read_entries(file, archive: zipfile.ZipFile, entries: List[zipfile.ZipInfo]) -> AsyncIterator[BulkSource]:
+    limit = int(config.UPLOAD_MAX_MB * 1024 * 1024)
+    try:
+        for info in entries:
+            if info.file_size > limit:
+                yield info.filename, _fail(ValueError(f"Photo is larger than the {config.UPLOAD_MAX_MB:g} MB limit"))
+                continue
+            data = await run_in_threadpool(archive.read, info)
+            yield info.filename, _loader(data)
+    finally:
+        archive.close()
+        file.close()
+
+
+async def upload_sources(uploads: list) -> AsyncIterator[BulkSource]:
+    """Detaches photos sent as a multipart list, after checking their count, each up to UPLOAD_MAX_MB."""
+    if len(uploads) > config.BULK_MAX_IMAGES:
+        raise ValueError(f"Got {len(uploads)} photos, the limit is {config.BULK_MAX_IMAGES}")
+    limit = int(config.UPLOAD_MAX_MB * 1024 * 1024)
+    files = []
+    try:
+        for upload in uploads:
+            files.append((upload.filename, await detach_upload(upload, limit)))
+    except Exception:
+        for _, file in files:
+            file.close()
+        raise
+    return _read_uploads(files)
+
+
+async def _read_uploads(files: List[Tuple[str, object]]) -> AsyncIterator[BulkSource]:
+    try:
+        for name, file in files:
+            data = await run_in_threadpool(file.read)
+            file.close()
+            yield name, _loader(data)
+    finally:
+        for _, file in files:
+            file.close()
+
+
+def _loader(data: bytes):
+    image_id = hashlib.sha256(data).hexdigest()
+    return lambda: encode_upload(image_id, BytesIO(data))
+
+
+def _fail(error: Exception):
+    async def load():
+        raise error
+    return load
+
+
+async def generate_bulk(sources: AsyncIterator[BulkSource], plan: BulkPlan, mode: str,
+                        seed: Optional[int], tier: Optional[str], fmt: str,
+                        quality: Optional[int]) -> AsyncIterator[dict]:
+    """Renders every photo from sources, yielding one result dict per render as it finishes.
+
+    At most BULK_CONCURRENCY photos are in flight, so photos are read and
+    decompressed only as earlier ones complete, while the scheduler still has
+    enough concurrent requests to fill its batches.
+    """
+    slots = asyncio.Semaphore(config.BULK_CONCURRENCY)
+    results: asyncio.Queue = asyncio.Queue()
+    tasks = set()
+
+    async def render_photo(name: str, load):
+        try:
+            renders = plan.renders(name)
+            init_image = await load()
+
+            async def render(area: str, units: int):
+                result = {"source": name, "selected_area": area, "injection_number": units,
+                          "name": output_name(name, area, units, fmt, plan.multiple)}
+                try:
+                    image = await generate_when_admitted(init_image, area, units, mode, seed, tier)
+                    result["data"] = await run_in_threadpool(image_to_bytes, image, fmt, quality)
+                except Exception as e:
+                    result["error"] = str(e)
+                await results.put(result)
+
+            await asyncio.gather(*(render(area, units) for area, units in renders))
+        except Exception as e:
+            await results.put({"source": name, "error": str(e)})
+        finally:
+            slots.release()
+
+    async def produce():
+        try:
+            async for name, load in sources:
+                await slots.acquire()
+                task = asyncio.ensure_future(render_photo(name, load))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*list(tasks))
+        except Exception as e:
+            await results.put({"error": str(e)})
+        finally:
+            await sources.aclose()
+            await results.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            result = await results.get()
+            if result is None:
+                break
+            yield result
+    finally:
+        # Stop decompressing and generating if the client stops reading
+        producer.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+
+class ZipStream:
+    """Write-only file object that hands out what zipfile has written so far.
+
+    zipfile falls back to data descriptors on unseekable output, so the
+    archive can be sent while it is being built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def stream_bulk_zip(results: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    """Streams results as a zip, one entry per finished render, plus a manifest.json at the end."""
+    stream = ZipStream()
+    manifest = []
+    names = {"manifest.json"}
+    with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for result in results:
+            data = result.pop("data", None)
+            if data is not None:
+                result["name"] = unique_name(result["name"], names)
+                # JPEG/WebP don't compress further, so entries are stored as-is
+                archive.writestr(result["name"], data)
+            else:
+                result.pop("name", None)
+            manifest.append(result)
+            yield stream.take()
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+    yield stream.take()
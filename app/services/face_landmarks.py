@@ -0,0 +1,55 @@
+import threading
+from typing import Optional
+
+import mediapipe as mp
+import numpy as np
+from PIL import Image
+
+# Injection points configuration
+INJECTION_POINTS = {
+    "forehead_lines_botox": [10, 151, 338, 67, 107, 336],
+    "frown_lines_glabella_botox": [9, 8, 168, 6, 197, 195, 5],
+    "crows_feet_botox": [263, 362, 386, 133, 173, 156],
+    "nasalis_lines_botox": [98, 327],
+    "vertical_lip_lines_botox": [61, 0, 267, 17, 84, 37],
+    "lip_flip_botox": [0, 267, 37, 17, 287, 84],
+    "smile_lift_botox": [61, 76, 91, 305, 290, 409],
+    "masseter_reduction_botox": [172, 58],
+    "dimpled_chin_botox": [18, 83, 14],
+    "platysmal_bands_botox": [131, 50, 205, 280, 425],
+    "cheek_filler": [50, 205, 429, 280, 425, 449],
+    "smile_line_filler": [61, 91, 76, 290, 305, 409],
+    "lip_filler": [0, 267, 37, 17, 287, 84],
+    "temple_filler": [26, 54, 226, 247, 110],
+    "nose_filler": [4, 5, 6, 248]
+}
+
+# Still-image detector for uploaded photos; MediaPipe graphs are not thread-safe
+_still_face_mesh = None
+_still_lock = threading.Lock()
+
+
+def detect_landmarks(image: Image.Image) -> Optional[np.ndarray]:
+    """Returns FaceMesh landmarks of the first face as an (N, 2) array of pixel coordinates."""
+    global _still_face_mesh
+    with _still_lock:
+        if _still_face_mesh is None:
+            _still_face_mesh = mp.solutions.face_mesh.FaceMesh(
+                static_image_mode=True,
+                max_num_faces=1,
+                min_detection_confidence=0.5
+            )
+        result = _still_face_mesh.process(np.asarray(image.convert("RGB")))
+
+    if not result.multi_face_landmarks:
+        return None
+
+    width, height = image.size
+    landmarks = result.multi_face_landmarks[0].landmark
+    return np.array([(lm.x * width, lm.y * height) for lm in landmarks], dtype=np.float32)
+
+
+def area_points(landmarks: np.ndarray, area: str) -> np.ndarray:
+    """Selects the landmarks of one treatment area."""
+    indices = [idx for idx in INJECTION_POINTS[area] if idx < len(landmarks)]
+    return landmarks[indices]
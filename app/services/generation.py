@@ -0,0 +1,174 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+import config
+from model.model_manager import model_manager
+from model.schedulers import get_tier
+from services.admission import Overloaded
+from services.batch_scheduler import scheduler
+from services.image_generator2 import build_prompt, encode_image
+from services.face_landmarks import INJECTION_POINTS, area_points, detect_landmarks
+from services.image_utils import restore_framing
+from services.latent_cache import CachedImage, latent_cache, resize_settings
+from services.region import blend_region, crop_region, region_settings
+from services.residual import downsample, lowres_settings, transfer_residual
+from services.result_cache import result_cache
+
+# full: diffuse the whole photo
+# region: diffuse only a padded crop around the area's landmarks and blend it back
+# lowres: diffuse a LOWRES_SIZE copy and add its upsampled edit to the full-size photo
+GENERATION_MODES = ("full", "region", "lowres")
+
+
+async def get_landmarks(init_image: CachedImage) -> Optional[np.ndarray]:
+    """Detects (once per cached upload) the face landmarks of an init image."""
+    if not init_image.landmarks_detected:
+        init_image.landmarks = await run_in_threadpool(detect_landmarks, init_image.image)
+        init_image.landmarks_detected = True
+    return init_image.landmarks
+
+
+async def get_lowres(init_image: CachedImage):
+    """Downsamples and encodes (once per cached upload) the low-resolution copy of an init image."""
+    if init_image.lowres is None:
+        small = await run_in_threadpool(downsample, init_image.image)
+        latents = init_image.latents if small is init_image.image else await scheduler.run(encode_image, small)
+        # Count the copy against the cache budget like the rest of the entry
+        latent_cache.attach_lowres(init_image, small, latents)
+    return init_image.lowres
+
+
+def mode_settings(mode: str) -> Tuple:
+    """Settings beyond the working image that change a mode's results."""
+    if mode == "region":
+        return region_settings()
+    if mode == "lowres":
+        return lowres_settings()
+    return ()
+
+
+def result_key(init_image: CachedImage, area: str, injection_number: int, mode: str,
+               seed: int, tier: str) -> str:
+    """Result-cache key covering every input that changes a seeded generation."""
+    _, strength, _ = build_prompt(area, injection_number)
+    return result_cache.key(
+        image_id=init_image.image_id,
+        resize=resize_settings(),
+        area=area,
+        injection_number=injection_number,
+        strength=scheduler.bucket_strength(strength),
+        sampling=get_tier(tier),
+        mode=mode,
+        mode_settings=mode_settings(mode),
+        seed=seed,
+        model_revision=model_manager.revision,
+    )
+
+
+async def generate(init_image: CachedImage, area: str, injection_number: int,
+                   mode: str = "full", seed: Optional[int] = None,
+                   tier: Optional[str] = None) -> Image.Image:
+    """Generates one treatment result for an init image in the requested mode and quality tier.
+
+    Seeded requests are deterministic, so their results are served from and
+    stored in the result cache.
+    """
+    if mode not in GENERATION_MODES:
+        raise ValueError(f"Unknown generation mode: {mode}")
+    tier = tier or config.QUALITY_DEFAULT
+
+    key = None
+    if seed is not None and config.RESULT_CACHE_ENABLED:
+        key = result_key(init_image, area, injection_number, mode, seed, tier)
+        cached = await run_in_threadpool(result_cache.get, key)
+        if cached is not None:
+            return cached
+
+    output_image = await _generate(init_image, area, injection_number, mode, seed, tier)
+    if init_image.framing is not None:
+        output_image = await run_in_threadpool(
+            restore_framing, output_image, init_image.original, init_image.framing
+        )
+    if key is not None:
+        await run_in_threadpool(result_cache.put, key, output_image)
+    return output_image
+
+
+async def generate_when_admitted(init_image: CachedImage, area: str, injection_number: int,
+                                 mode: str = "full", seed: Optional[int] = None,
+                                 tier: Optional[str] = None) -> Image.Image:
+    """generate() for background work (bulk, jobs): waits out a full queue instead of failing with 429."""
+    while True:
+        try:
+            return await generate(init_image, area, injection_number, mode, seed, tier)
+        except Overloaded as e:
+            await asyncio.sleep(e.retry_after)
+
+
+async def _generate(init_image: CachedImage, area: str, injection_number: int,
+                    mode: str, seed: Optional[int], tier: str) -> Image.Image:
+    if mode == "region":
+        if area not in INJECTION_POINTS:
+            raise ValueError(f"Unknown treatment area: {area}")
+        landmarks = await get_landmarks(init_image)
+        if landmarks is not None:
+            crop, box, mask = await run_in_threadpool(
+                crop_region, init_image.image, area_points(landmarks, area)
+            )
+            generated_crop = await scheduler.submit(crop, area, injection_number, seed=seed, tier=tier)
+            return await run_in_threadpool(blend_region, init_image.image, generated_crop, box, mask)
+        print("No face detected, falling back to full-image generation")
+
+    if mode == "lowres":
+        small, latents = await get_lowres(init_image)
+        generated = await scheduler.submit(small, area, injection_number, init_latents=latents, seed=seed, tier=tier)
+        if small is init_image.image:
+            return generated
+        return await run_in_threadpool(transfer_residual, init_image.image, small, generated)
+
+    return await scheduler.submit(
+        init_image.image, area, injection_number, init_latents=init_image.latents, seed=seed, tier=tier
+    )
+
+
+def plan_dose_sweep(area: str, units: List[int]) -> List[dict]:
+    """Collapses a list of unit values into the distinct renders they need.
+
+    Unit values whose prompt and effective (bucketed) strength are identical
+    produce the same image for a fixed seed, so they share one frame.
+    """
+    frames = {}
+    for injection_number in units:
+        prompt, strength, _ = build_prompt(area, injection_number)
+        key = (scheduler.bucket_strength(strength), prompt)
+        if key not in frames:
+            frames[key] = {"injection_number": injection_number, "strength": key[0], "units": []}
+        frames[key]["units"].append(injection_number)
+
+    if len(frames) > config.SWEEP_MAX_FRAMES:
+        raise ValueError(f"Sweep needs {len(frames)} frames, the limit is {config.SWEEP_MAX_FRAMES}")
+    return list(frames.values())
+
+
+async def generate_dose_sweep(init_image: CachedImage, area: str, frames: List[dict], seed: int,
+                              tier: Optional[str] = None):
+    """Renders planned sweep frames, yielding (frame, image) as each one finishes.
+
+    Every frame shares the init latents and the noise seed, and the scheduler
+    batches them together, so the series differs only by dose.
+    """
+    async def render(frame: dict):
+        return frame, await generate(init_image, area, frame["injection_number"], "full", seed, tier)
+
+    tasks = [asyncio.ensure_future(render(frame)) for frame in frames]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Stop queued renders if the client stops reading the stream
+        for task in tasks:
+            task.cancel()
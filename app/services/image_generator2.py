@@ -1,7 +1,18 @@
 from PIL import Image
 from io import BytesIO
-from model.sd_model1 import pipeline
+from typing import List, Optional
+from model.memory_manager import memory_manager
+from model.model_manager import model_manager
+from model.schedulers import get_tier, pipeline_for_tier
 import torch
+import config
+from services.admission import raise_if_cancelled
+from services.previews import publish_previews
+from services.prompt_cache import PromptEmbeddingCache
+from services.metrics import (
+    batch_size, record_peak_memory, record_stage, reset_peak_memory, sample_peak_memory, timed
+)
+import time
 
 
 
@@ -42,6 +53,9 @@ max_units = {
     "platysmal_bands_botox": 30
 }
 
+# Seed for sampling VAE init latents
+ENCODE_SEED = 0
+
 # Define areas
 BOTOX_AREAS = set(max_units.keys())
 FILLER_AREAS = set(area for area in base_prompts if area not in BOTOX_AREAS)
@@ -149,42 +163,174 @@ def build_prompt(area: str, injection_number: int) -> (str, float):
     return prompt, strength, treatment_name
 
 
+def build_negative_prompt(area: str) -> str:
+    """Builds the negative prompt protecting every area except the target."""
+    return f"{common_negative_prompt}, {get_protective_negative_prompt(area)}"
+
+
+def image_to_bytes(image: Image.Image, fmt: str = "jpeg", quality: Optional[int] = None) -> bytes:
+    """Encodes a generated image (JPEG by default) at the configured or requested quality."""
+    with timed("image_encode"):
+        buffer = BytesIO()
+        image.save(buffer, format=fmt.upper(), quality=quality or config.OUTPUT_QUALITY[fmt])
+        return buffer.getvalue()
+
+
+def encode_image(image: Image.Image) -> torch.Tensor:
+    """VAE-encodes an image into init latents the pipeline can reuse across prompts."""
+    pipeline = model_manager.get_pipeline()
+    tensor = pipeline.image_processor.preprocess(image).to(
+        device=pipeline._execution_device, dtype=pipeline.vae.dtype
+    )
+    # A fixed generator makes the encode reproducible, so seeded generations
+    # match whether or not the init latents came from the cache
+    generator = make_generator(ENCODE_SEED)
+    with timed("vae_encode"), torch.no_grad():
+        latents = pipeline.vae.encode(tensor).latent_dist.sample(generator)
+    return latents * pipeline.vae.config.scaling_factor
+
+
+def encode_text(text: str) -> torch.Tensor:
+    """Runs a single prompt through the CLIP text encoder."""
+    pipeline = model_manager.get_pipeline()
+    with timed("text_encode"), torch.no_grad():
+        embeds, _ = pipeline.encode_prompt(text, pipeline._execution_device, 1, False)
+    return embeds
+
+
+prompt_cache = PromptEmbeddingCache(encode_text, config.PROMPT_CACHE_SIZE)
+
+
+def get_prompt_embeds(area: str, injection_number: int):
+    """Returns cached (prompt_embeds, negative_prompt_embeds) for an area and dose."""
+    # Filler prompts don't mention units, so every dose shares one entry
+    units = injection_number if area in BOTOX_AREAS else 0
+    with timed("prompt_build"):
+        prompt_embeds = prompt_cache.get(
+            ("prompt", area, units), lambda: build_prompt(area, injection_number)[0]
+        )
+        negative_prompt_embeds = prompt_cache.get(
+            ("negative", area), lambda: build_negative_prompt(area), pinned=True
+        )
+    return prompt_embeds, negative_prompt_embeds
+
+
+def warmup_prompt_cache():
+    """Pre-encodes every area's negative prompt and its full-dose prompt."""
+    for area in base_prompts:
+        get_prompt_embeds(area, max_units.get(area, 0))
+    print(f"Prompt cache warmed: {prompt_cache.stats()}")
+
+
+model_manager.add_warmup(warmup_prompt_cache)
+
+
+def make_generator(seed: Optional[int] = None) -> torch.Generator:
+    """Returns a CPU noise generator, seeded when the request asked for one."""
+    generator = torch.Generator()
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+
+def generate_images_batch(images: List[Image.Image], areas: List[str],
+                          injection_numbers: List[int], strength: float,
+                          init_latents: Optional[List[Optional[torch.Tensor]]] = None,
+                          seeds: Optional[List[Optional[int]]] = None,
+                          tier: Optional[str] = None) -> List[Image.Image]:
+    """Runs several same-sized requests through a single pipeline call.
+
+    Requests that already carry init latents skip the VAE encode; the pipeline
+    treats a 4-channel image tensor as latents. Each request gets its own
+    noise generator, so a seeded request produces the same image regardless
+    of what it was batched with. The quality tier picks the scheduler, step
+    count and guidance scale (see config.QUALITY_TIERS).
+    """
+    settings = get_tier(tier)
+    embeds = [get_prompt_embeds(area, units) for area, units in zip(areas, injection_numbers)]
+    prompt_embeds = torch.cat([prompt for prompt, _ in embeds])
+    negative_prompt_embeds = torch.cat([negative for _, negative in embeds])
+
+    if init_latents is None:
+        init_latents = [None] * len(images)
+    latents = torch.cat([
+        image_latents if image_latents is not None else encode_image(image)
+        for image, image_latents in zip(images, init_latents)
+    ])
+
+    if seeds is None:
+        seeds = [None] * len(images)
+
+    print(f"Generating batch of {len(images)} ({', '.join(areas)}) at strength {strength}, "
+          f"{settings['steps']} steps...")
+    batch_size.observe(len(images), "generate")
+
+    pipeline = pipeline_for_tier(model_manager.get_pipeline(), tier)
+    width, height = images[0].size
+    policy = memory_manager.prepare(pipeline, width, height, len(images))
+
+    # Step callbacks split the call into denoising steps and the trailing VAE decode
+    started = last_step = time.perf_counter()
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        nonlocal last_step
+        now = time.perf_counter()
+        record_stage("denoise_step", now - last_step)
+        last_step = now
+        sample_peak_memory()
+        raise_if_cancelled()
+        publish_previews(step, getattr(pipe, "num_timesteps", None), callback_kwargs["latents"])
+        return callback_kwargs
+
+    def run():
+        nonlocal started, last_step
+        reset_peak_memory()
+        started = last_step = time.perf_counter()
+        return pipeline(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            image=latents,
+            strength=strength,
+            num_inference_steps=settings["steps"],
+            guidance_scale=settings["guidance_scale"],
+            # Fresh generators per attempt keep seeded results identical after a retry
+            generator=[make_generator(seed) for seed in seeds],
+            callback_on_step_end=on_step_end
+        ).images
+
+    try:
+        images = run()
+    except torch.cuda.OutOfMemoryError:
+        print("Out of memory, retrying with attention slicing and VAE tiling")
+        policy = memory_manager.recover(pipeline)
+        images = run()
+    finished = time.perf_counter()
+    record_stage("denoise", last_step - started)
+    record_stage("vae_decode", finished - last_step)
+    memory_manager.record(policy, record_peak_memory())
+    return images
+
+
 def generate_images(image: Image.Image, area: str, injection_number: int = 0):
     """Generates enhanced images based on treatment type and injection units."""
     results = []
     
-    prompt, strength, treatment_name = build_prompt(area, injection_number)
-
-    # Build negative prompt that protects all other areas
-    area_protection = get_protective_negative_prompt(area)
-    negative_prompt = f"{common_negative_prompt}, {area_protection}"
+    _, strength, treatment_name = build_prompt(area, injection_number)
 
     print(f"Generating {treatment_name} result"
           f"{' with ' + str(injection_number) + ' units' if area in BOTOX_AREAS else ''}...")
 
     try:
         # Generate the image using the pipeline
-        output_image = pipeline(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            image=image,
-            strength=strength,
-            guidance_scale=8.5  # Slightly higher for better prompt adherence
-        ).images[0]
-
-        # Save the result into a buffer
-        buffer = BytesIO()
-        output_image.save(buffer, format="JPEG")
-        buffer.seek(0)
+        output_image = generate_images_batch([image], [area], [injection_number], strength)[0]
 
         results.append({
             "area": treatment_name,
-            "image_bytes": buffer.getvalue()
+            "image_bytes": image_to_bytes(output_image)
         })
     except Exception as e:
         print(f"Error during image generation: {e}")
-    finally:
-        # Clear GPU memory after each execution
-        torch.cuda.empty_cache()
 
     return results
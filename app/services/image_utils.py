@@ -0,0 +1,148 @@
+import math
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+import config
+from services.metrics import timed
+
+
+def target_size(width: int, height: int, min_size=512, max_size=1024):
+    """Working size for an image: the long side is scaled into [min_size, max_size], keeping the aspect ratio."""
+    max_side = max(width, height)
+    if min_size <= max_side <= max_size:
+        return width, height
+    scale_factor = (max_size if max_side > max_size else min_size) / max_side
+    return int(width * scale_factor), int(height * scale_factor)
+
+
+def load_image(source) -> Image.Image:
+    """Decodes an uploaded photo (bytes or a file object) straight to the working range.
+
+    The pixel count is checked from the header before anything is decoded.
+    JPEGs are decoded at a reduced DCT scale close to the target size
+    (draft mode), other formats are shrunk by integer reduction before the
+    final LANCZOS pass, and the EXIF orientation is applied so phone photos
+    come out upright.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+
+    with timed("decode"):
+        image = Image.open(source)
+        width, height = image.size
+        if width * height > config.UPLOAD_MAX_PIXELS:
+            raise ValueError(
+                f"Image is {width}x{height}, larger than the {config.UPLOAD_MAX_PIXELS} pixel limit"
+            )
+
+        size = target_size(width, height, config.RESIZE_MIN_SIZE, config.RESIZE_MAX_SIZE)
+        if image.format == "JPEG":
+            # Picks the smallest 1/2, 1/4 or 1/8 scale that is still >= size
+            image.draft("RGB", size)
+        image = ImageOps.exif_transpose(image).convert("RGB")
+
+    with timed("resize"):
+        # Orientation may have swapped the axes since size was computed
+        size = target_size(*image.size, config.RESIZE_MIN_SIZE, config.RESIZE_MAX_SIZE)
+        if image.size == size:
+            return image
+        return image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+class Framing:
+    """Where a working-range image sits inside its resolution bucket.
+
+    source_box is the part of the image visible in the bucket and target_box
+    is where that part landed: padding shrinks target_box, cropping shrinks
+    source_box.
+    """
+
+    def __init__(self, bucket: Tuple[int, int], source_box: Tuple[int, int, int, int],
+                 target_box: Tuple[int, int, int, int]):
+        self.bucket = bucket
+        self.source_box = source_box
+        self.target_box = target_box
+
+
+def choose_bucket(width: int, height: int, buckets: List[Tuple[int, int]]) -> Tuple[int, int]:
+    """Picks the bucket whose aspect ratio is closest to the image's, among the largest that don't upscale it.
+
+    Buckets are grouped by their long side; the image goes to the largest
+    group whose long side fits within its own (the smallest group if none
+    does), so small photos don't pay for a 1024-class denoise.
+    """
+    long_side = max(width, height)
+    sides = sorted({max(bucket) for bucket in buckets})
+    fitting = [side for side in sides if side <= long_side]
+    group = fitting[-1] if fitting else sides[0]
+    aspect = math.log(width / height)
+    return min((bucket for bucket in buckets if max(bucket) == group),
+               key=lambda bucket: abs(math.log(bucket[0] / bucket[1]) - aspect))
+
+
+def bucket_image(image: Image.Image, buckets: List[Tuple[int, int]], fit: str = "pad"):
+    """Resizes an image into its bucket, returning the bucketed image and its Framing."""
+    width, height = image.size
+    bucket_width, bucket_height = choose_bucket(width, height, buckets)
+
+    if fit == "crop":
+        scale = max(bucket_width / width, bucket_height / height)
+        scaled_size = (max(round(width * scale), bucket_width), max(round(height * scale), bucket_height))
+    elif fit == "pad":
+        scale = min(bucket_width / width, bucket_height / height)
+        scaled_size = (min(round(width * scale), bucket_width), min(round(height * scale), bucket_height))
+    else:
+        raise ValueError(f"Unknown bucket fit: {fit}")
+
+    scaled = image if scaled_size == image.size else image.resize(scaled_size, Image.LANCZOS, reducing_gap=3.0)
+    left = abs(bucket_width - scaled_size[0]) // 2
+    top = abs(bucket_height - scaled_size[1]) // 2
+
+    if fit == "crop":
+        bucketed = scaled.crop((left, top, left + bucket_width, top + bucket_height))
+        source_box = (
+            round(left / scale), round(top / scale),
+            min(round((left + bucket_width) / scale), width), min(round((top + bucket_height) / scale), height),
+        )
+        target_box = (0, 0, bucket_width, bucket_height)
+    else:
+        # Mirror the photo into the padding so the model never sees hard borders
+        right, bottom = bucket_width - scaled_size[0] - left, bucket_height - scaled_size[1] - top
+        pixels = np.pad(np.asarray(scaled), ((top, bottom), (left, right), (0, 0)), mode="reflect")
+        bucketed = Image.fromarray(pixels)
+        source_box = (0, 0, width, height)
+        target_box = (left, top, left + scaled_size[0], top + scaled_size[1])
+
+    return bucketed, Framing((bucket_width, bucket_height), source_box, target_box)
+
+
+def restore_framing(output: Image.Image, original: Image.Image, framing: Framing) -> Image.Image:
+    """Maps a generated bucket-sized image back onto the original framing.
+
+    Padding is cut away; with cropping, the generated part is pasted over the
+    original so the cropped-off margins are kept as they were.
+    """
+    left, top, right, bottom = framing.source_box
+    content = output.crop(framing.target_box).resize((right - left, bottom - top), Image.LANCZOS)
+    if framing.source_box == (0, 0) + original.size:
+        return content
+    result = original.copy()
+    result.paste(content, (left, top))
+    return result
+
+
+def load_working_image(source) -> Tuple[Image.Image, Image.Image, Optional[Framing]]:
+    """Loads an upload for generation.
+
+    Returns (image to diffuse, working-range original, framing). The first two
+    are the same image unless RESIZE_MODE is "bucket".
+    """
+    image = load_image(source)
+    if config.RESIZE_MODE != "bucket":
+        return image, image, None
+    with timed("resize"):
+        bucketed, framing = bucket_image(image, config.RESIZE_BUCKETS, config.RESIZE_BUCKET_FIT)
+    return bucketed, image, framing
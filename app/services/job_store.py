@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+# Jobs that still need (or are getting) compute
+UNFINISHED = ("queued", "running")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    input_path TEXT,
+    result_path TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+
+class JobStore:
+    """Generation jobs in a local SQLite database, so they outlive the process."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _one(self, query: str, *args) -> Optional[dict]:
+        with self._lock:
+            row = self._connect().execute(query, args).fetchone()
+        return _job(row)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self._one("SELECT * FROM jobs WHERE id = ?", job_id)
+
+    def find(self, key: str) -> Optional[dict]:
+        """The newest job for a key that is pending or has a result."""
+        return self._one(
+            "SELECT * FROM jobs WHERE key = ? AND status != 'failed' ORDER BY created_at DESC LIMIT 1", key
+        )
+
+    def create(self, key: str, params: dict, image_id: str, input_path: Optional[str] = None,
+               job_id: Optional[str] = None) -> dict:
+        now = time.time()
+        job_id = job_id or uuid.uuid4().hex
+        with self._lock:
+            self._connect().execute(
+                "INSERT INTO jobs (id, key, status, params, image_id, input_path, created_at, updated_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?, ?)",
+                (job_id, key, json.dumps(params), image_id, input_path, now, now),
+            )
+        return self.get(job_id)
+
+    def update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._connect().execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def position(self, job: dict) -> Optional[int]:
+        """How many unfinished jobs were submitted before this one (None once it has finished)."""
+        if job["status"] not in UNFINISHED:
+            return None
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running') AND created_at < ?",
+                (job["created_at"],),
+            ).fetchone()
+        return row[0]
+
+    def unfinished(self) -> List[dict]:
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT * FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [_job(row) for row in rows]
+
+    def expire(self, older_than: float) -> List[dict]:
+        """Deletes finished jobs last updated before older_than and returns them."""
+        with self._lock:
+            db = self._connect()
+            rows = db.execute(
+                "SELECT * FROM jobs WHERE status NOT IN ('queued', 'running') AND updated_at < ?", (older_than,)
+            ).fetchall()
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in rows])
+        return [_job(row) for row in rows]
+
+
+def _job(row: Optional[sqlite3.Row]) -> Optional[dict]:
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    return job
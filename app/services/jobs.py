@@ -0,0 +1,203 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import AsyncIterator, Dict, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+import config
+from model.model_manager import model_manager
+from services.generation import generate_when_admitted
+from services.image_generator2 import image_to_bytes
+from services.job_store import UNFINISHED, JobStore
+from services.latent_cache import encode_upload, hash_upload, latent_cache, resize_settings
+
+
+def job_key(image_id: str, params: dict) -> str:
+    """Jobs with the same photo, parameters and model share one key, and so one render."""
+    keyed = dict(params, image_id=image_id, resize=resize_settings(), model_revision=model_manager.revision)
+    return hashlib.sha256(json.dumps(keyed, sort_keys=True).encode()).hexdigest()
+
+
+class JobManager:
+    """Runs /jobs/ submissions in the background and tracks them in a JobStore.
+
+    Each job keeps a copy of its input photo until it finishes, so jobs that
+    were queued or running when the process stopped are resumed on startup.
+    Results are files next to the store, served until JOB_TTL_HOURS after the
+    job finished; expired jobs are swept every JOB_EXPIRE_INTERVAL seconds.
+    """
+
+    def __init__(self, store: JobStore, directory: str, concurrency: int):
+        self.store = store
+        self.directory = directory
+        self.concurrency = concurrency
+        self._slots: asyncio.Semaphore = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._expiry: asyncio.Task = None
+        self._watchers: Dict[str, Set[asyncio.Queue]] = {}
+
+    def start(self):
+        """Called on app startup: drops expired jobs and resumes unfinished ones."""
+        if self._slots is not None:
+            return
+        self._slots = asyncio.Semaphore(self.concurrency)
+        os.makedirs(self.directory, exist_ok=True)
+        self.expire()
+        for job in self.store.unfinished():
+            self.store.update(job["id"], status="queued")
+            self._schedule(job["id"])
+        self._expiry = asyncio.get_running_loop().create_task(self._expire_periodically())
+
+    async def submit(self, params: dict, file=None, image_id: Optional[str] = None):
+        """Returns (job, deduplicated); a matching pending or finished job is reused."""
+        self.start()
+        if file is not None:
+            image_id = await hash_upload(file)
+        elif image_id is None:
+            raise ValueError("Either file or image_id is required")
+
+        entry = None
+        if file is None:
+            entry = latent_cache.get(image_id)
+
+        # No await between the lookup and the insert, so identical concurrent
+        # submissions can't both miss and render twice
+        key = job_key(image_id, params)
+        existing = self.store.find(key)
+        if existing is not None and (existing["status"] != "done" or os.path.exists(existing["result_path"] or "")):
+            return existing, True
+        if file is None and entry is None:
+            raise ValueError(f"Unknown or expired image_id {image_id}; upload the photo again")
+
+        job_id = uuid.uuid4().hex
+        input_path = os.path.join(self.directory, f"{job_id}.input")
+        job = self.store.create(key, params, image_id, input_path, job_id)
+        try:
+            if file is not None:
+                await self._save_upload(file, input_path)
+            else:
+                await run_in_threadpool(entry.original.save, input_path, format="PNG", compress_level=1)
+        except Exception as e:
+            self.store.update(job_id, status="failed", error=str(e), input_path=None)
+            _remove(input_path)
+            self._notify(job_id)
+            raise
+
+        self._schedule(job_id)
+        return job, False
+
+    def status(self, job_id: str) -> Optional[dict]:
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "position": self.store.position(job),
+            "error": job["error"],
+            "params": job["params"],
+            "created_at": job["created_at"],
+            "updated_at": job["updated_at"],
+            "result_url": f"/jobs/{job['id']}/result" if job["status"] == "done" else None,
+        }
+
+    async def events(self, job_id: str) -> AsyncIterator[dict]:
+        """Yields the job's status now and on every change, until it finishes."""
+        watcher: asyncio.Queue = asyncio.Queue()
+        self._watchers.setdefault(job_id, set()).add(watcher)
+        try:
+            status = self.status(job_id)
+            while status is not None:
+                yield status
+                if status["status"] not in UNFINISHED:
+                    return
+                try:
+                    await asyncio.wait_for(watcher.get(), config.JOB_EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    pass
+                status = self.status(job_id)
+        finally:
+            watchers = self._watchers.get(job_id)
+            if watchers is not None:
+                watchers.discard(watcher)
+                if not watchers:
+                    del self._watchers[job_id]
+
+    def expire(self):
+        for job in self.store.expire(time.time() - config.JOB_TTL_HOURS * 3600):
+            for path in (job["input_path"], job["result_path"]):
+                if path:
+                    _remove(path)
+
+    async def _expire_periodically(self):
+        while True:
+            await asyncio.sleep(config.JOB_EXPIRE_INTERVAL)
+            try:
+                await run_in_threadpool(self.expire)
+            except Exception as e:
+                print(f"Error while expiring jobs: {e}")
+
+    def _schedule(self, job_id: str):
+        task = asyncio.get_running_loop().create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    def _notify(self, job_id: str):
+        for watcher in self._watchers.get(job_id, ()):
+            watcher.put_nowait(job_id)
+
+    async def _save_upload(self, file, path: str):
+        await file.seek(0)
+        with open(path, "wb") as f:
+            while True:
+                chunk = await file.read(config.UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await run_in_threadpool(f.write, chunk)
+
+    async def _run(self, job_id: str):
+        async with self._slots:
+            job = self.store.get(job_id)
+            params = job["params"]
+            self.store.update(job_id, status="running")
+            self._notify(job_id)
+            try:
+                init_image = await encode_upload(job["image_id"], job["input_path"])
+                image = await generate_when_admitted(
+                    init_image, params["selected_area"], params["injection_number"],
+                    params["mode"], params["seed"], params["tier"]
+                )
+                data = await run_in_threadpool(image_to_bytes, image, params["output_format"], params["quality"])
+                result_path = os.path.join(self.directory, f"{job_id}.{params['output_format']}")
+                await run_in_threadpool(_write, result_path, data)
+                self.store.update(job_id, status="done", result_path=result_path, input_path=None)
+                _remove(job["input_path"])
+            except Exception as e:
+                print(f"Error during job {job_id}: {e}")
+                # Failed jobs are never retried from their input, so don't keep it
+                self.store.update(job_id, status="failed", error=str(e), input_path=None)
+                _remove(job["input_path"])
+            finally:
+                self._notify(job_id)
+
+
+def _write(path: str, data: bytes):
+    # Write then rename, so a crash never leaves a truncated result behind
+    partial = f"{path}.partial"
+    with open(partial, "wb") as f:
+        f.write(data)
+    os.replace(partial, path)
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+job_manager = JobManager(JobStore(config.JOB_DB_PATH), config.JOB_DIR, config.JOB_CONCURRENCY)
@@ -0,0 +1,273 @@
+import asyncio
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import cv2
+import mediapipe as mp
+import numpy as np
+
+import config
+from services.face_landmarks import INJECTION_POINTS
+
+# Every (area, landmark) pair sent to clients, flattened in INJECTION_POINTS order
+AREA_NAMES = [name for name, indices in INJECTION_POINTS.items() for _ in indices]
+AREA_INDICES = np.array([idx for indices in INJECTION_POINTS.values() for idx in indices])
+# Each landmark is read from MediaPipe once even when several areas share it
+UNIQUE_INDICES, UNIQUE_INVERSE = np.unique(AREA_INDICES, return_inverse=True)
+
+# Binary protocol: one packet per frame with a fixed header followed by one
+# (x, y) pair per entry of AREA_INDICES, in pixels of the received frame.
+# count is 0 when no face was found.
+PACKET_HEADER = struct.Struct("<IfH")  # frame sequence, processing ms, point count
+PACKET_POINT = "<hh"
+
+# FaceMesh releases the GIL while running its graph, so threads scale across cores
+executor = ThreadPoolExecutor(max_workers=config.WS_WORKERS, thread_name_prefix="facemesh")
+
+
+class StreamOptions:
+    """Per-connection protocol settings negotiated by an optional first text message.
+
+    Clients that start sending frames right away get the legacy protocol (JSON
+    landmarks plus an annotated JPEG per frame). A client can instead open with
+    e.g. {"protocol": "binary", "render": false} to receive packed landmarks
+    only and draw the overlay itself.
+    """
+
+    def __init__(self, protocol: str = "legacy", render: bool = None,
+                 jpeg_quality: int = config.WS_JPEG_QUALITY, scale: float = config.WS_FRAME_SCALE,
+                 ingest: str = config.WS_INGEST_MODE, max_fps: float = config.WS_MAX_FPS,
+                 detect_every: int = config.WS_DETECT_EVERY):
+        if protocol not in ("legacy", "binary"):
+            raise ValueError(f"Unknown protocol: {protocol}")
+        if ingest not in ("latest", "ordered"):
+            raise ValueError(f"Unknown ingest mode: {ingest}")
+        self.protocol = protocol
+        # Binary clients draw their own overlay unless they ask for frames
+        self.render = protocol == "legacy" if render is None else bool(render)
+        self.jpeg_quality = max(1, min(int(jpeg_quality), 100))
+        self.scale = min(max(float(scale), 0.05), 1.0)
+        self.ingest = ingest
+        self.max_fps = max(float(max_fps), 0.0)
+        self.detect_every = max(int(detect_every), 1)
+
+    @classmethod
+    def from_message(cls, message: dict) -> "StreamOptions":
+        return cls(
+            protocol=message.get("protocol", "legacy"),
+            render=message.get("render"),
+            jpeg_quality=message.get("jpeg_quality", config.WS_JPEG_QUALITY),
+            scale=message.get("scale", config.WS_FRAME_SCALE),
+            ingest=message.get("ingest", config.WS_INGEST_MODE),
+            max_fps=message.get("max_fps", config.WS_MAX_FPS),
+            detect_every=message.get("detect_every", config.WS_DETECT_EVERY),
+        )
+
+    def handshake(self) -> dict:
+        """Describes the binary layout; area names are sent once here instead of per frame.
+
+        Landmarks are always in pixel coordinates of the frame the client sent;
+        only the returned JPEG is resized by ``scale``.
+        """
+        return {
+            "protocol": self.protocol,
+            "render": self.render,
+            "scale": self.scale,
+            "ingest": self.ingest,
+            "max_fps": self.max_fps,
+            "detect_every": self.detect_every,
+            "header": PACKET_HEADER.format,
+            "point": PACKET_POINT,
+            "names": AREA_NAMES,
+            "indices": AREA_INDICES.tolist(),
+        }
+
+
+class StreamStats:
+    """Frame counters across every /ws connection, exposed at /ws/stats."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        self.frames_tracked = 0
+        self._latencies = deque(maxlen=1000)
+
+    def record(self, latency_ms: float, tracked: bool):
+        with self._lock:
+            self.frames_processed += 1
+            self.frames_tracked += int(tracked)
+            self._latencies.append(latency_ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {
+                "connections": self.connections,
+                "frames_received": self.frames_received,
+                "frames_processed": self.frames_processed,
+                "frames_dropped": self.frames_dropped,
+                "frames_tracked": self.frames_tracked,
+                "latency_ms_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+                "latency_ms_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            }
+
+
+stream_stats = StreamStats()
+
+
+class FrameSlot:
+    """Frames received on one connection but not yet processed.
+
+    In "latest" mode only the newest frame is kept and anything older is
+    dropped, so latency stays bounded when the client sends faster than we
+    can process. "ordered" mode keeps every frame.
+    """
+
+    def __init__(self, latest_only: bool = True):
+        self.latest_only = latest_only
+        self.dropped = 0
+        self.closed = False
+        self._frames = deque()
+        self._event = asyncio.Event()
+
+    def put(self, data: bytes):
+        stream_stats.frames_received += 1
+        if self.latest_only and self._frames:
+            self.dropped += len(self._frames)
+            stream_stats.frames_dropped += len(self._frames)
+            self._frames.clear()
+        self._frames.append((data, time.perf_counter()))
+        self._event.set()
+
+    async def get(self) -> Optional[Tuple[bytes, float]]:
+        """Returns (frame, receive time), or None once the socket closed and nothing is left."""
+        while not self._frames:
+            if self.closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        return self._frames.popleft()
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+
+
+class LandmarkStream:
+    """FaceMesh tracking and landmark smoothing state for one /ws connection."""
+
+    def __init__(self, smoothing: float = config.LANDMARK_SMOOTHING):
+        self.smoothing = smoothing
+        self.face_mesh = mp.solutions.face_mesh.FaceMesh(
+            static_image_mode=False,
+            max_num_faces=1,
+            min_detection_confidence=0.5,
+            min_tracking_confidence=0.5
+        )
+        self.previous: Optional[np.ndarray] = None
+        # Optical-flow tracking state between full detections
+        self._raw: Optional[np.ndarray] = None
+        self._gray: Optional[np.ndarray] = None
+        self._frames_since_detect = 0
+        self.last_tracked = False
+
+    def _detect(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """Runs FaceMesh; returns float pixel coordinates of UNIQUE_INDICES or None."""
+        result = self.face_mesh.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        if not result.multi_face_landmarks:
+            return None
+
+        h, w, _ = frame.shape
+        landmarks = result.multi_face_landmarks[0].landmark
+        unique = np.array([(landmarks[idx].x, landmarks[idx].y) for idx in UNIQUE_INDICES],
+                          dtype=np.float32)
+        return unique * np.array((w, h), dtype=np.float32)
+
+    def _track(self, gray: np.ndarray) -> Optional[np.ndarray]:
+        """Follows the last landmarks with pyramidal Lucas-Kanade optical flow."""
+        if self._raw is None or self._gray is None or self._gray.shape != gray.shape:
+            return None
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self._gray, gray, self._raw.reshape(-1, 1, 2), None, winSize=(21, 21), maxLevel=3
+        )
+        # Fall back to a full detection as soon as any point is lost
+        if points is None or not status.all():
+            return None
+        return points.reshape(-1, 2)
+
+    def detect(self, frame: np.ndarray, detect_every: int = 1) -> Optional[np.ndarray]:
+        """Returns smoothed (K, 2) pixel coordinates for AREA_INDICES, or None without a face."""
+        raw = None
+        self.last_tracked = False
+        if detect_every > 1:
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if self._frames_since_detect < detect_every - 1:
+                raw = self._track(gray)
+                self.last_tracked = raw is not None
+            self._gray = gray
+
+        if raw is None:
+            raw = self._detect(frame)
+            self._frames_since_detect = 0
+        else:
+            self._frames_since_detect += 1
+        self._raw = raw
+        if raw is None:
+            return None
+
+        points = raw[UNIQUE_INVERSE].astype(np.int32)
+
+        # Exponential moving average against this connection's previous frame
+        if self.previous is not None:
+            points = (self.previous * self.smoothing + points * (1 - self.smoothing)).astype(np.int32)
+        self.previous = points
+        return points
+
+    def process(self, data: bytes, options: StreamOptions):
+        """Decodes a frame and detects landmarks.
+
+        Returns (points, annotated JPEG or None, ms); the JPEG is only produced
+        when the client asked for rendered frames.
+        """
+        started = time.perf_counter()
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        points = self.detect(frame, options.detect_every)
+
+        frame_bytes = None
+        if options.render:
+            if points is not None:
+                for x, y in points:
+                    cv2.circle(frame, (int(x), int(y)), 3, (0, 255, 0), -1)
+            if options.scale < 1.0:
+                frame = cv2.resize(frame, None, fx=options.scale, fy=options.scale,
+                                   interpolation=cv2.INTER_AREA)
+            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, options.jpeg_quality])
+            frame_bytes = buffer.tobytes()
+
+        processing_ms = (time.perf_counter() - started) * 1000
+        return points, frame_bytes, processing_ms
+
+    def close(self):
+        self.face_mesh.close()
+
+
+def to_landmark_list(points: np.ndarray) -> List[dict]:
+    return [
+        {"name": name, "index": int(idx), "x": int(x), "y": int(y)}
+        for name, idx, (x, y) in zip(AREA_NAMES, AREA_INDICES, points.tolist())
+    ]
+
+
+def pack_landmarks(sequence: int, processing_ms: float, points: Optional[np.ndarray]) -> bytes:
+    """Packs one frame's landmarks for the binary protocol."""
+    if points is None:
+        return PACKET_HEADER.pack(sequence & 0xFFFFFFFF, processing_ms, 0)
+    header = PACKET_HEADER.pack(sequence & 0xFFFFFFFF, processing_ms, len(points))
+    return header + points.astype("<i2").tobytes()
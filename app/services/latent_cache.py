@@ -0,0 +1,173 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+import config
+from services.batch_scheduler import scheduler
+from services.image_generator2 import encode_image
+from services.image_utils import Framing, load_working_image
+from services.metrics import timed
+
+
+class CachedImage:
+    """A resized upload together with its VAE init latents."""
+
+    def __init__(self, image_id: str, image: Image.Image, latents: torch.Tensor,
+                 original: Optional[Image.Image] = None, framing: Optional[Framing] = None):
+        self.image_id = image_id
+        self.image = image
+        self.latents = latents
+        # With bucketed resizing, image is the bucket-shaped copy of original
+        # and framing maps results back onto it
+        self.original = original or image
+        self.framing = framing
+        # Filled in on first use by region-cropped generation
+        self.landmarks = None
+        self.landmarks_detected = False
+        # Filled in on first use by low-resolution generation: (image, latents)
+        self.lowres = None
+        width, height = image.size
+        self.nbytes = width * height * 3 + latents.element_size() * latents.nelement()
+        if self.original is not image:
+            original_width, original_height = self.original.size
+            self.nbytes += original_width * original_height * 3
+
+
+def resize_settings() -> Tuple:
+    """Every setting that changes the working image derived from an upload."""
+    if config.RESIZE_MODE != "bucket":
+        return (config.RESIZE_MIN_SIZE, config.RESIZE_MAX_SIZE)
+    return (config.RESIZE_MIN_SIZE, config.RESIZE_MAX_SIZE, config.RESIZE_BUCKET_FIT, tuple(config.RESIZE_BUCKETS))
+
+
+class LatentCache:
+    """Content-addressed LRU of decoded uploads, bounded by a memory budget."""
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._entries: "OrderedDict[Tuple, CachedImage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(image_id: str) -> Tuple:
+        # The same bytes resized differently give different latents
+        return (image_id,) + resize_settings()
+
+    def get(self, image_id: str) -> Optional[CachedImage]:
+        key = self.key(image_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, entry: CachedImage):
+        key = self.key(entry.image_id)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+            self._entries[key] = entry
+            self.nbytes += entry.nbytes
+            self._evict()
+
+    def attach_lowres(self, entry: CachedImage, image: Image.Image, latents: torch.Tensor):
+        """Stores an entry's low-resolution copy and adds its size to the budget."""
+        nbytes = 0
+        if image is not entry.image:
+            width, height = image.size
+            nbytes = width * height * 3 + latents.element_size() * latents.nelement()
+        with self._lock:
+            if entry.lowres is not None:
+                return
+            entry.lowres = (image, latents)
+            entry.nbytes += nbytes
+            # Entries already evicted no longer count against the budget
+            key = self.key(entry.image_id)
+            if self._entries.get(key) is entry:
+                self._entries.move_to_end(key)
+                self.nbytes += nbytes
+                self._evict()
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while self.nbytes > self.budget_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_bytes": self.nbytes,
+                "budget_bytes": self.budget_bytes,
+            }
+
+
+latent_cache = LatentCache(int(config.LATENT_CACHE_BUDGET_MB * 1024 * 1024))
+
+
+async def hash_upload(file) -> str:
+    """Hashes an upload in chunks, enforcing the size limit, and rewinds it for decoding."""
+    digest = hashlib.sha256()
+    limit = int(config.UPLOAD_MAX_MB * 1024 * 1024)
+    size = 0
+    while True:
+        chunk = await file.read(config.UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise ValueError(f"Upload is larger than the {config.UPLOAD_MAX_MB:g} MB limit")
+        digest.update(chunk)
+    await file.seek(0)
+    return digest.hexdigest()
+
+
+async def encode_upload(image_id: str, source) -> CachedImage:
+    """Returns the cached entry for image_id, decoding and encoding source on a miss."""
+    entry = latent_cache.get(image_id)
+    if entry is None:
+        image, original, framing = await run_in_threadpool(load_working_image, source)
+        latents = await scheduler.run(encode_image, image)
+        entry = CachedImage(image_id, image, latents, original, framing)
+        latent_cache.put(entry)
+    return entry
+
+
+async def resolve_image(file=None, image_id: Optional[str] = None) -> CachedImage:
+    """Returns the init image for a request from either an upload or an image_id.
+
+    Uploads are never read into one bytes object: they are hashed chunk by
+    chunk and, on a cache miss, decoded straight from the spooled file.
+    """
+    if file is not None:
+        with timed("upload_read"):
+            upload_id = await hash_upload(file)
+        return await encode_upload(upload_id, file.file)
+    if not image_id:
+        raise ValueError("Either file or image_id is required")
+    entry = latent_cache.get(image_id)
+    if entry is None:
+        raise ValueError(f"Unknown or expired image_id {image_id}; upload the photo again")
+    return entry
@@ -0,0 +1,257 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence
+
+import torch
+from starlette.datastructures import Headers, MutableHeaders
+
+import config
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MEMORY_BUCKETS = tuple(mb * 1024 * 1024 for mb in (256, 512, 1024, 2048, 4096, 8192, 16384, 32768))
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+
+class Histogram:
+    """Minimal Prometheus histogram with one label."""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], label: str):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._lock = threading.Lock()
+        self._series: Dict[str, list] = {}
+
+    def observe(self, value: float, label_value: str = ""):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Per-bucket counts, then +Inf count and sum
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self) -> Dict[str, list]:
+        with self._lock:
+            return {label_value: list(series) for label_value, series in self._series.items()}
+
+    def merge(self, series_by_label: Dict[str, list]):
+        """Adds observations recorded elsewhere, e.g. in an inference worker process."""
+        with self._lock:
+            for label_value, other in series_by_label.items():
+                series = self._series.setdefault(label_value, [0] * (len(self.buckets) + 1) + [0.0])
+                for i, value in enumerate(other):
+                    series[i] += value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-2]}')
+                lines.append(f"{self.name}_count{{{label}}} {series[-2]}")
+                lines.append(f"{self.name}_sum{{{label}}} {series[-1]}")
+        return "\n".join(lines)
+
+
+stage_seconds = Histogram("sdig_stage_seconds", "Time spent in each request stage.", STAGE_BUCKETS, "stage")
+request_seconds = Histogram("sdig_request_seconds", "End-to-end HTTP request latency.", STAGE_BUCKETS, "path")
+peak_memory_bytes = Histogram("sdig_peak_memory_bytes", "Peak memory during a generation batch.",
+                              MEMORY_BUCKETS, "device")
+batch_size = Histogram("sdig_batch_size", "Requests per pipeline call.", BATCH_BUCKETS, "kind")
+
+HISTOGRAMS = (stage_seconds, request_seconds, peak_memory_bytes, batch_size)
+
+
+class RequestTimings:
+    """Stage durations (and peak memory) accumulated for one request or batch."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages: Dict[str, float] = {}
+        self.peak_memory_bytes: Optional[int] = None
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def merge(self, other: "RequestTimings"):
+        for stage, seconds in list(other.stages.items()):
+            self.add(stage, seconds)
+        if other.peak_memory_bytes is not None:
+            self.peak_memory_bytes = max(self.peak_memory_bytes or 0, other.peak_memory_bytes)
+
+    def server_timing(self) -> str:
+        with self._lock:
+            entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        if self.peak_memory_bytes is not None:
+            entries.append(f'peak_memory;desc="{self.peak_memory_bytes}"')
+        return ", ".join(entries)
+
+
+# Timings of the request (or scheduler batch) the current code runs for; the
+# context is copied into run_in_threadpool workers and the pipeline thread
+current_timings: contextvars.ContextVar = contextvars.ContextVar("current_timings", default=None)
+
+
+def record_stage(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+
+# CPU has no allocator peak counter, so RSS is sampled during each call
+_rss_peak: Optional[int] = None
+
+
+def reset_peak_memory():
+    global _rss_peak
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        _rss_peak = current_rss_bytes()
+
+
+def sample_peak_memory():
+    """Samples RSS on CPU (e.g. between denoising steps); CUDA tracks its peak itself."""
+    global _rss_peak
+    if not torch.cuda.is_available():
+        rss = current_rss_bytes()
+        if rss is not None:
+            _rss_peak = max(_rss_peak or 0, rss)
+
+
+def record_peak_memory() -> Optional[int]:
+    """Records peak CUDA allocation, or peak sampled RSS on CPU, since the last reset."""
+    if torch.cuda.is_available():
+        device, value = "cuda", torch.cuda.max_memory_allocated()
+    else:
+        sample_peak_memory()
+        device, value = "cpu", _rss_peak
+    if value is None:
+        return None
+    peak_memory_bytes.observe(value, device)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.peak_memory_bytes = max(timings.peak_memory_bytes or 0, value)
+    return value
+
+
+def current_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def histogram_snapshot() -> dict:
+    return {histogram.name: histogram.snapshot() for histogram in HISTOGRAMS}
+
+
+def histogram_changes(before: dict) -> dict:
+    """Observations made since histogram_snapshot() returned before."""
+    changes = {}
+    for histogram in HISTOGRAMS:
+        previous = before.get(histogram.name, {})
+        for label_value, series in histogram.snapshot().items():
+            last = previous.get(label_value)
+            delta = series if last is None else [now - then for now, then in zip(series, last)]
+            if delta[-2]:
+                changes.setdefault(histogram.name, {})[label_value] = delta
+    return changes
+
+
+def merge_histograms(changes: dict):
+    for histogram in HISTOGRAMS:
+        if histogram.name in changes:
+            histogram.merge(changes[histogram.name])
+
+
+def render_metrics() -> str:
+    return "\n".join(histogram.render() for histogram in HISTOGRAMS) + "\n"
+
+
+class TimingMiddleware:
+    """Times each HTTP request and optionally reports its stages in Server-Timing.
+
+    A plain ASGI middleware, so the clock stops at the last body chunk rather
+    than when the headers go out: streaming routes (SSE, NDJSON, zip) record
+    their full duration. Stages that finish after the headers, as in a stream,
+    are sent as a Server-Timing trailer when the server supports trailers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        started = time.perf_counter()
+        finished = False
+        report = config.METRICS_TIMING_HEADER or Headers(scope=scope).get("x-timing") == "1"
+        trailers = report and "http.response.trailers" in scope.get("extensions", {})
+
+        def finish():
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            elapsed = time.perf_counter() - started
+            # Label by route template so ids in paths don't create new series
+            route = scope.get("route")
+            request_seconds.observe(elapsed, getattr(route, "path", "unmatched"))
+            timings.add("total", elapsed)
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start" and report:
+                message = dict(message, headers=list(message.get("headers", [])))
+                headers = MutableHeaders(scope=message)
+                if trailers:
+                    message["trailers"] = True
+                    headers.append("Trailer", "Server-Timing")
+                else:
+                    stages = RequestTimings()
+                    stages.merge(timings)
+                    stages.add("total", time.perf_counter() - started)
+                    headers.append("Server-Timing", stages.server_timing())
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
+                if trailers:
+                    await send(message)
+                    message = {
+                        "type": "http.response.trailers",
+                        "headers": [(b"server-timing", timings.server_timing().encode("latin-1"))],
+                        "more_trailers": False,
+                    }
+            await send(message)
+
+        token = current_timings.set(timings)
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            current_timings.reset(token)
+            # Errors and client disconnects never send a final body
+            finish()
@@ -0,0 +1,66 @@
+import contextvars
+from io import BytesIO
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+import config
+
+# Linear map from SD 1.x latent channels to RGB. Good enough to show the
+# composition and colour of a half-denoised image for the cost of a matmul,
+# instead of a full VAE decode.
+LATENT_RGB_FACTORS = torch.tensor([
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+])
+
+# Set by a streaming request: called on the event loop with (step, steps,
+# jpeg_bytes) for each preview of its image
+current_preview_listener: contextvars.ContextVar = contextvars.ContextVar("current_preview_listener", default=None)
+
+# Set around a pipeline call that has listeners: a (sink, wanted) pair, where
+# sink is called from the pipeline thread (or a worker replica) with (step,
+# steps, one JPEG per batch item) and wanted says which items are streamed;
+# the others get None instead of an encoded preview
+current_preview_sink: contextvars.ContextVar = contextvars.ContextVar("current_preview_sink", default=None)
+
+
+def latents_to_previews(latents: torch.Tensor) -> List[Image.Image]:
+    """Approximate RGB images of a batch of latents, PREVIEW_SIZE on the long side."""
+    rgb = torch.einsum("bchw,cr->bhwr", latents.detach().float().cpu(), LATENT_RGB_FACTORS)
+    pixels = ((rgb + 1) * 127.5).clamp(0, 255).to(torch.uint8).numpy()
+
+    previews = []
+    for item in pixels:
+        image = Image.fromarray(np.ascontiguousarray(item))
+        scale = config.PREVIEW_SIZE / max(image.size)
+        previews.append(image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR))
+    return previews
+
+
+def preview_jpeg(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=config.PREVIEW_JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def publish_previews(step: int, steps: Optional[int], latents: torch.Tensor):
+    """Called after each denoising step; sends previews every PREVIEW_EVERY_STEPS steps.
+
+    Does nothing unless a request in the batch is streaming, and skips the
+    last step, whose decoded image follows right after. Only the streamed
+    items of the batch are converted and encoded.
+    """
+    preview_sink: Optional[Tuple[Callable, List[bool]]] = current_preview_sink.get()
+    if preview_sink is None or (step + 1) % config.PREVIEW_EVERY_STEPS or (steps and step + 1 >= steps):
+        return
+    sink, wanted = preview_sink
+    indices = [i for i, streamed in enumerate(wanted) if streamed]
+    images: List[Optional[bytes]] = [None] * len(wanted)
+    for i, image in zip(indices, latents_to_previews(latents[indices])):
+        images[i] = preview_jpeg(image)
+    sink(step + 1, steps, images)
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable
+
+import torch
+
+
+class PromptEmbeddingCache:
+    """LRU cache of text-encoder outputs.
+
+    Entries added with ``pinned=True`` (the per-area negative prompts) are kept
+    for the life of the process; everything else is evicted least recently used
+    once ``max_entries`` is reached.
+    """
+
+    def __init__(self, encode: Callable[[str], torch.Tensor], max_entries: int = 256):
+        self.encode = encode
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+        self._pinned: Dict[Hashable, torch.Tensor] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, text: Callable[[], str], pinned: bool = False) -> torch.Tensor:
+        """Returns the embeddings for ``key``, encoding ``text()`` on a miss.
+
+        ``text`` is a callable so prompt strings are only built when needed.
+        """
+        with self._lock:
+            embeds = self._pinned.get(key)
+            if embeds is None:
+                embeds = self._entries.get(key)
+                if embeds is not None:
+                    self._entries.move_to_end(key)
+            if embeds is not None:
+                self.hits += 1
+                return embeds
+            self.misses += 1
+
+        embeds = self.encode(text())
+
+        with self._lock:
+            if pinned:
+                self._pinned[key] = embeds
+            else:
+                self._entries[key] = embeds
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return embeds
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            tensors = list(self._entries.values()) + list(self._pinned.values())
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "pinned_entries": len(self._pinned),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "memory_bytes": sum(t.element_size() * t.nelement() for t in tensors),
+            }
@@ -0,0 +1,78 @@
+from typing import Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import config
+
+
+def region_settings() -> Tuple:
+    """Every setting that changes a region-mode result, for result-cache keys."""
+    return (config.REGION_PADDING, config.REGION_MIN_SIZE, config.REGION_WORKING_SIZE, config.REGION_FEATHER)
+
+
+def region_box(points: np.ndarray, image_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """Returns a padded square (left, top, right, bottom) box around the area's landmarks.
+
+    A square crop means every region request is diffused at the same working
+    size, so the scheduler can batch them together.
+    """
+    width, height = image_size
+    left, top = points.min(axis=0)
+    right, bottom = points.max(axis=0)
+
+    side = max(right - left, bottom - top)
+    side = max(int(side * (1 + 2 * config.REGION_PADDING)), config.REGION_MIN_SIZE)
+    side = min(side - side % 8, width - width % 8, height - height % 8)
+
+    center_x, center_y = (left + right) / 2, (top + bottom) / 2
+    box_left = int(min(max(center_x - side / 2, 0), width - side))
+    box_top = int(min(max(center_y - side / 2, 0), height - side))
+    return box_left, box_top, box_left + side, box_top + side
+
+
+def region_mask(points: np.ndarray, box: Tuple[int, int, int, int]) -> Image.Image:
+    """Builds a feathered blend mask covering the area's landmarks inside the crop."""
+    left, top, right, bottom = box
+    side = right - left
+    mask = np.zeros((bottom - top, side), dtype=np.uint8)
+
+    local = (points - (left, top)).astype(np.int32)
+    cv2.fillConvexPoly(mask, cv2.convexHull(local), 255)
+
+    # Grow the hull so the edit covers the skin around the injection points,
+    # then blur it so the blended edge is invisible
+    grow = max(int(side * config.REGION_PADDING / (1 + 2 * config.REGION_PADDING)) // 2, 1)
+    mask = cv2.dilate(mask, np.ones((2 * grow + 1, 2 * grow + 1), np.uint8))
+    feather = config.REGION_FEATHER * 2 + 1
+    mask = cv2.GaussianBlur(mask, (feather, feather), 0)
+
+    # Keep the crop border untouched so the seam always lands on original pixels
+    mask[:2, :] = mask[-2:, :] = 0
+    mask[:, :2] = mask[:, -2:] = 0
+    return Image.fromarray(mask, mode="L")
+
+
+def crop_region(image: Image.Image, points: np.ndarray):
+    """Crops the working region for an area.
+
+    Returns the crop resized to the working size, its box in the original image
+    and the blend mask.
+    """
+    box = region_box(points, image.size)
+    crop = image.crop(box)
+    size = config.REGION_WORKING_SIZE
+    return crop.resize((size, size), Image.LANCZOS), box, region_mask(points, box)
+
+
+def blend_region(image: Image.Image, generated_crop: Image.Image,
+                 box: Tuple[int, int, int, int], mask: Image.Image) -> Image.Image:
+    """Blends a generated crop back into the photo; pixels outside the mask stay identical."""
+    left, top, right, bottom = box
+    original_crop = image.crop(box)
+    generated_crop = generated_crop.resize(original_crop.size, Image.LANCZOS)
+
+    result = image.copy()
+    result.paste(Image.composite(generated_crop, original_crop, mask), (left, top))
+    return result
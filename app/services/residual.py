@@ -0,0 +1,41 @@
+from typing import Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import config
+
+
+def lowres_settings() -> Tuple:
+    """Every setting that changes a lowres-mode result, for result-cache keys."""
+    return (config.LOWRES_SIZE, config.LOWRES_DELTA_BLUR)
+
+
+def lowres_size(width: int, height: int) -> Tuple[int, int]:
+    """The working size for low-resolution generation: LOWRES_SIZE on the long side, multiples of 8."""
+    scale = min(config.LOWRES_SIZE / max(width, height), 1.0)
+    return max(round(width * scale) // 8 * 8, 8), max(round(height * scale) // 8 * 8, 8)
+
+
+def downsample(image: Image.Image) -> Image.Image:
+    size = lowres_size(*image.size)
+    if size == image.size:
+        return image
+    return image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+
+def transfer_residual(image: Image.Image, small: Image.Image, generated: Image.Image) -> Image.Image:
+    """Applies the edit made to a downsampled copy onto the full-resolution photo.
+
+    Only the low-frequency change (generated minus its input, blurred) is
+    upsampled and added, so the photo's own skin texture and sharpness are
+    kept at full resolution.
+    """
+    delta = np.asarray(generated, dtype=np.float32) - np.asarray(small, dtype=np.float32)
+    if config.LOWRES_DELTA_BLUR > 0:
+        delta = cv2.GaussianBlur(delta, (0, 0), config.LOWRES_DELTA_BLUR)
+    delta = cv2.resize(delta, image.size, interpolation=cv2.INTER_CUBIC)
+
+    result = np.asarray(image, dtype=np.float32) + delta
+    return Image.fromarray(np.clip(result + 0.5, 0, 255).astype(np.uint8))
@@ -0,0 +1,60 @@
+from typing import Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+OUTPUT_MEDIA_TYPES = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+def parse_accept(accept: Optional[str]) -> dict:
+    """Parses an Accept header into {media_type: q}."""
+    preferences = {}
+    for part in (accept or "").split(","):
+        media_type, _, params = part.strip().partition(";")
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        preferences[media_type.strip().lower()] = q
+    return preferences
+
+
+def negotiate_output(accept: Optional[str], output_format: Optional[str] = None) -> Tuple[str, bool]:
+    """Picks the output format and whether to answer with raw image bytes.
+
+    Clients that ask for image/jpeg or image/webp get the raw image; anything
+    else (including no Accept header or */*) keeps the base64-in-JSON response.
+    An explicit output_format always decides the encoding.
+    """
+    if output_format is not None and output_format.lower() not in OUTPUT_MEDIA_TYPES:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+    preferences = parse_accept(accept)
+    json_q = max(preferences.get("application/json", 0.0), preferences.get("*/*", 0.0))
+    image_q = {fmt: preferences.get(media_type, preferences.get("image/*", 0.0))
+               for fmt, media_type in OUTPUT_MEDIA_TYPES.items()}
+
+    fmt = output_format.lower() if output_format else max(image_q, key=lambda k: (image_q[k], k == "jpeg"))
+    raw = image_q[fmt] > 0 and image_q[fmt] >= json_q
+    return fmt, raw
+
+
+def image_response(image_bytes: bytes, fmt: str, filename: str = "result") -> StreamingResponse:
+    """Streams encoded image bytes as-is, without base64 or another buffer copy."""
+    extension = "jpg" if fmt == "jpeg" else fmt
+    return StreamingResponse(
+        iter((image_bytes,)),
+        media_type=OUTPUT_MEDIA_TYPES[fmt],
+        headers={
+            "Content-Length": str(len(image_bytes)),
+            "Content-Disposition": f"inline; filename={filename}.{extension}",
+        },
+    )
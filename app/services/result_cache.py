@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+
+import config
+
+
+class ResultCache:
+    """Deterministic generation results on local disk, with an in-memory hot tier.
+
+    An in-memory index of the files (least recently used first, built once
+    from the directory) drives eviction: once the files grow past
+    ``max_bytes``, the oldest are removed down to RESULT_CACHE_LOW_WATER of
+    it. Disk reads, PNG decoding and encoding happen outside the lock.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, hot_entries: int,
+                 low_water: float = config.RESULT_CACHE_LOW_WATER):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hot_entries = hot_entries
+        self.low_water = low_water
+        self._hot: "OrderedDict[str, Image.Image]" = OrderedDict()
+        self._index: "OrderedDict[str, int]" = None
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(**params) -> str:
+        """Hashes every input that affects the output image."""
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    def _scan(self):
+        # Lazily index the files already on disk from previous runs, oldest first
+        if self._index is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".png"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+        self._index = OrderedDict((key, size) for _, key, size in sorted(files))
+        self._nbytes = sum(self._index.values())
+
+    def _remember(self, key: str, image: Image.Image):
+        self._hot[key] = image
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_entries:
+            self._hot.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        with self._lock:
+            self._scan()
+            image = self._hot.get(key)
+            if image is not None:
+                self._hot.move_to_end(key)
+                if key in self._index:
+                    self._index.move_to_end(key)
+                self.hits += 1
+                return image.copy()
+            if key not in self._index:
+                self.misses += 1
+                return None
+
+        path = self._path(key)
+        try:
+            with Image.open(path) as cached:
+                image = cached.convert("RGB")
+            # Keeps the LRU order across restarts
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            if key in self._index:
+                self._index.move_to_end(key)
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, image)
+        return image.copy()
+
+    def put(self, key: str, image: Image.Image):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Lossless so a hit is identical to regenerating; level 1 keeps writes fast
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format="PNG", compress_level=1)
+        size = os.path.getsize(tmp_path)
+
+        with self._lock:
+            self._scan()
+            os.replace(tmp_path, path)
+            self._forget(key)
+            self._index[key] = size
+            self._nbytes += size
+            self._remember(key, image.copy())
+            evicted = self._evict()
+
+        for evicted_key in evicted:
+            try:
+                os.remove(self._path(evicted_key))
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._nbytes -= size
+        self._hot.pop(key, None)
+
+    def _evict(self):
+        """Drops the oldest entries from the index down to the low-water mark; returns their keys."""
+        if self._nbytes <= self.max_bytes:
+            return []
+        target = self.max_bytes * self.low_water
+        evicted = []
+        while self._nbytes > target and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._nbytes -= size
+            self._hot.pop(key, None)
+            evicted.append(key)
+        return evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hot_entries": len(self._hot),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "disk_entries": len(self._index or ()),
+                "disk_bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+result_cache = ResultCache(
+    config.RESULT_CACHE_DIR,
+    int(config.RESULT_CACHE_MAX_MB * 1024 * 1024),
+    config.RESULT_CACHE_HOT_ENTRIES,
+)
@@ -0,0 +1,256 @@
+import asyncio
+import itertools
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import torch
+import torch.multiprocessing as mp
+
+import config
+from services.admission import current_cancel_check
+from services.metrics import RequestTimings, current_timings, histogram_changes, histogram_snapshot, merge_histograms
+from services.previews import current_preview_sink
+
+
+def _worker_main(index: int, threads: int, cpus: Optional[List[int]], requests, responses, cancelled):
+    """Replica process: loads its own model, then runs calls until it receives None."""
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+
+    # Importing the generator registers its warmup hooks with this process's model manager
+    import services.image_generator2  # noqa: F401
+    from model.model_manager import model_manager
+
+    try:
+        model_manager.get_pipeline()
+    except Exception as e:
+        responses.put((None, index, False, str(e), None))
+        return
+    responses.put((None, index, True, None, None))
+
+    for call_id, fn, args, preview_mask in iter(requests.get, None):
+        timings = RequestTimings()
+        token = current_timings.set(timings)
+        # The API process writes a call's id here to stop it between denoising steps
+        cancel_token = current_cancel_check.set(lambda: cancelled[index] == call_id)
+        # Step previews travel back as messages with ok=None
+        preview_sink = None
+        if preview_mask is not None:
+            def sink(step, steps, images, call_id=call_id):
+                responses.put((call_id, index, None, (step, steps, images), None))
+            preview_sink = (sink, preview_mask)
+        preview_token = current_preview_sink.set(preview_sink)
+        before = histogram_snapshot()
+        try:
+            # Tensors go back through the queue on the CPU: CUDA tensors would
+            # need this process to keep them alive for the receiver (CUDA IPC)
+            ok, payload = True, _to_cpu(fn(*args))
+        except Exception as e:
+            ok, payload = False, f"{type(e).__name__}: {e}"
+        finally:
+            current_preview_sink.reset(preview_token)
+            current_cancel_check.reset(cancel_token)
+            current_timings.reset(token)
+        metrics = (timings.stages, timings.peak_memory_bytes, histogram_changes(before))
+        responses.put((call_id, index, ok, payload, metrics))
+
+
+class WorkerPool:
+    """Runs pipeline calls in replica processes, each holding its own copy of the model.
+
+    Replicas load weights from memory-mapped safetensors (see
+    model/shared_weights.py), so they share one copy in the page cache. Each
+    call goes to the replica with the fewest calls in flight; stage timings and
+    histogram observations made in the replica are merged back into this
+    process.
+    """
+
+    def __init__(self, replicas: int, threads: int = 0, pin_cpus: bool = False):
+        self.replicas = replicas
+        self.threads = threads or max((os.cpu_count() or 1) // replicas, 1)
+        self.pin_cpus = pin_cpus
+        self._context = mp.get_context("spawn")
+        self._processes = []
+        self._requests = []
+        self._responses = None
+        self._cancelled = None
+        self._listener = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._calls: Dict[int, tuple] = {}
+        self._in_flight = [0] * replicas
+        self._ready = set()
+        self._failed: Dict[int, str] = {}
+
+    @property
+    def started(self) -> bool:
+        return self._listener is not None
+
+    @property
+    def ready(self) -> bool:
+        return bool(self._ready)
+
+    def start(self):
+        if self.started:
+            return
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        self._responses = self._context.Queue()
+        self._cancelled = self._context.Array("q", self.replicas, lock=False)
+        for index in range(self.replicas):
+            cpus = cores[index * self.threads:(index + 1) * self.threads] if self.pin_cpus else None
+            requests = self._context.Queue()
+            process = self._context.Process(
+                target=_worker_main,
+                args=(index, self.threads, cpus, requests, self._responses, self._cancelled),
+                name=f"inference-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._requests.append(requests)
+            self._processes.append(process)
+        self._listener = threading.Thread(target=self._listen, name="worker-pool", daemon=True)
+        self._listener.start()
+        print(f"Started {self.replicas} inference workers with {self.threads} threads each")
+
+    def stop(self):
+        if not self.started:
+            return
+        for requests in self._requests:
+            requests.put(None)
+        self._responses.put(None)
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    async def run(self, fn: Callable, *args, timings: Optional[RequestTimings] = None,
+                  cancel_check: Optional[Callable[[], bool]] = None,
+                  on_preview: Optional[Callable] = None, preview_mask: Optional[List[bool]] = None):
+        """Runs fn(*args) on the least busy replica; fn must be importable by name.
+
+        cancel_check is polled while the call runs; once it returns True the
+        replica is told to stop the call at its next cancellation point.
+        on_preview is called from the listener thread with the step previews
+        the call publishes, for the batch items set in preview_mask.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        if timings is None:
+            timings = current_timings.get()
+
+        with self._lock:
+            serving = self._ready or set(range(self.replicas)) - set(self._failed)
+            if not serving:
+                raise RuntimeError(f"All inference workers failed: {self._failed}")
+            index = min(serving, key=lambda i: self._in_flight[i])
+            self._in_flight[index] += 1
+            call_id = next(self._ids)
+            self._calls[call_id] = (index, future, timings, on_preview)
+        self._requests[index].put((call_id, fn, args, preview_mask if on_preview is not None else None))
+
+        if cancel_check is not None:
+            while not future.done():
+                await asyncio.wait({future}, timeout=config.DISCONNECT_POLL_SECONDS)
+                if not future.done() and cancel_check():
+                    self._cancelled[index] = call_id
+                    break
+        return await future
+
+    def status(self) -> dict:
+        with self._lock:
+            if self._ready:
+                state = "ready"
+            elif len(self._failed) == self.replicas:
+                state = "failed"
+            else:
+                state = "loading"
+            return {
+                "state": state,
+                "replicas": self.replicas,
+                "ready_replicas": len(self._ready),
+                "threads_per_replica": self.threads,
+                "in_flight": list(self._in_flight),
+                "errors": dict(self._failed),
+            }
+
+    def _listen(self):
+        last_check = time.monotonic()
+        while True:
+            # Checked on a timer, not only when the queue is idle: under steady
+            # traffic from other replicas the get() below may never time out
+            if time.monotonic() - last_check >= 1.0:
+                self._check_processes()
+                last_check = time.monotonic()
+            try:
+                message = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if message is None:
+                return
+
+            call_id, index, ok, payload, metrics = message
+            if call_id is None:
+                with self._lock:
+                    if ok:
+                        self._ready.add(index)
+                    else:
+                        self._failed[index] = payload
+                print(f"Inference worker {index} {'ready' if ok else 'failed: ' + payload}")
+                continue
+
+            if ok is None:
+                with self._lock:
+                    call = self._calls.get(call_id)
+                if call is not None and call[3] is not None:
+                    call[3](*payload)
+                continue
+
+            with self._lock:
+                self._in_flight[index] -= 1
+                _, future, timings, _ = self._calls.pop(call_id)
+            stages, peak_memory, changes = metrics
+            merge_histograms(changes)
+            if timings is not None:
+                for stage, seconds in stages.items():
+                    timings.add(stage, seconds)
+                if peak_memory is not None:
+                    timings.peak_memory_bytes = max(timings.peak_memory_bytes or 0, peak_memory)
+            future.get_loop().call_soon_threadsafe(_settle, future, ok, payload)
+
+    def _check_processes(self):
+        """Fails the calls of replicas that died so their callers don't wait forever."""
+        for index, process in enumerate(self._processes):
+            if process.is_alive() or index in self._failed:
+                continue
+            with self._lock:
+                self._failed[index] = f"exited with code {process.exitcode}"
+                self._ready.discard(index)
+                lost = [call_id for call_id, call in self._calls.items() if call[0] == index]
+                calls = [self._calls.pop(call_id) for call_id in lost]
+                self._in_flight[index] = 0
+            for _, future, _, _ in calls:
+                future.get_loop().call_soon_threadsafe(
+                    _settle, future, False, f"Inference worker {index} {self._failed[index]}"
+                )
+
+
+def _to_cpu(result):
+    if isinstance(result, torch.Tensor):
+        return result.cpu()
+    if isinstance(result, (list, tuple)):
+        return type(result)(_to_cpu(item) for item in result)
+    return result
+
+
+def _settle(future: asyncio.Future, ok: bool, payload):
+    # The caller may have been cancelled while the replica was working
+    if future.done():
+        return
+    if ok:
+        future.set_result(payload)
+    else:
+        future.set_exception(RuntimeError(payload))
@@ -0,0 +1,295 @@
+"""Offline latency/throughput benchmark for the generation service.
+
+Swaps the shared pipeline for a tiny random stand-in (see tests/tiny_pipeline.py)
+and drives /generate/ and /ws through in-process ASGI clients, so it runs on
+a laptop CPU without the SD-1.5 download. Results are written as JSON so
+runs can be diffed between commits:
+
+    python benchmarks/run_benchmark.py --concurrency 1 4 --sizes 512x512 768x1024 \
+        --output bench_output.json
+
+--backends runs the same /generate/ scenarios on each inference backend
+(see app/model/backends.py) and reports p50 speedups against the first:
+
+    python benchmarks/run_benchmark.py --backends pytorch cpu --ws-frames 0
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+# For the tiny random pipeline shared with the tests
+sys.path.insert(0, ROOT)
+
+# Must be set before the app's config module is imported
+os.environ.setdefault("MODEL_LOAD_MODE", "lazy")
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+
+import httpx  # noqa: E402
+import numpy as np  # noqa: E402
+import torch  # noqa: E402
+from PIL import Image  # noqa: E402
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "latency_ms": {
+            "mean": statistics.fmean(latencies_ms) if latencies_ms else None,
+            "p50": percentile(latencies_ms, 50),
+            "p95": percentile(latencies_ms, 95),
+            "p99": percentile(latencies_ms, 99),
+        },
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else None,
+    }
+
+
+def memory_snapshot():
+    snapshot = {"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if torch.cuda.is_available():
+        snapshot["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return snapshot
+
+
+def make_jpeg(width, height, seed):
+    """A random photo stand-in; distinct seeds defeat the upload cache."""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def bench_generate(app, size, areas, concurrency, requests, unique_images, injection_number, tier,
+                         warmup=0):
+    width, height = size
+    shared_image = make_jpeg(width, height, 0)
+    latencies, errors = [], 0
+    counter = iter(range(requests))
+    data = {"injection_number": str(injection_number), **({"tier": tier} if tier else {})}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        # Unmeasured requests first, so compiling backends are timed after compilation.
+        # The concurrent round repeats an already-encoded photo, so its requests reach
+        # the scheduler together and the batched shapes get compiled too
+        for i in range(warmup):
+            form = {**data, "selected_area": areas[i % len(areas)]}
+            files = {"file": ("warmup.jpg", make_jpeg(width, height, requests + i + 1), "image/jpeg")}
+            await client.post("/generate/", data=form, files=files)
+            if concurrency > 1:
+                await asyncio.gather(*(client.post("/generate/", data=form, files=files)
+                                       for _ in range(concurrency)))
+
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                image = make_jpeg(width, height, i + 1) if unique_images else shared_image
+                started = time.perf_counter()
+                response = await client.post(
+                    "/generate/",
+                    data={**data, "selected_area": areas[i % len(areas)]},
+                    files={"file": ("bench.jpg", image, "image/jpeg")},
+                )
+                elapsed = time.perf_counter() - started
+                if response.status_code != 200 or "error" in response.json():
+                    errors += 1
+                    print(f"  request failed: {response.status_code} {response.text[:200]}")
+                else:
+                    latencies.append(elapsed)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return summarize(latencies, elapsed, errors)
+
+
+def bench_ws(app, size, concurrency, frames, frame_path):
+    from starlette.testclient import TestClient
+
+    if frame_path:
+        with open(frame_path, "rb") as f:
+            frame = f.read()
+    else:
+        frame = make_jpeg(*size, 0)
+
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def connection():
+        nonlocal errors
+        client = TestClient(app)
+        try:
+            with client.websocket_connect("/ws") as websocket:
+                websocket.send_text(json.dumps({"protocol": "binary", "render": False, "ingest": "ordered"}))
+                websocket.receive_json()
+                for _ in range(frames):
+                    started = time.perf_counter()
+                    websocket.send_bytes(frame)
+                    websocket.receive_bytes()
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            print(f"  websocket failed: {e}")
+            with lock:
+                errors += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=connection) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, elapsed, errors)
+
+
+async def bench_generate_scenarios(app, args, backends, build_pipeline):
+    """Runs every /generate/ scenario in one event loop.
+
+    The scheduler's queue and dispatch task belong to the loop they were
+    started on, so the scenarios must not each get a fresh loop.
+    """
+    from model.model_manager import model_manager
+    from services.batch_scheduler import scheduler
+    from services.image_generator2 import prompt_cache
+    from services.latent_cache import latent_cache
+
+    scenarios = []
+    try:
+        for index, backend in enumerate(backends):
+            # Same weights and inputs for every backend; nothing cached from the previous one
+            if index:
+                model_manager.set_pipeline(build_pipeline(), backend)
+            prompt_cache.clear()
+            latent_cache.clear()
+            for size in args.sizes:
+                for concurrency in args.concurrency:
+                    name = f"generate {backend} {size[0]}x{size[1]} c={concurrency}"
+                    print(f"Running {name}...")
+                    result = await bench_generate(
+                        app, size, args.areas, concurrency, args.requests,
+                        not args.shared_image, args.injection_number, args.tier, args.warmup
+                    )
+                    result.update({"name": name, "kind": "generate", "backend": backend, "size": list(size),
+                                   "concurrency": concurrency, **memory_snapshot()})
+                    scenarios.append(result)
+                    print(f"  {json.dumps(result['latency_ms'])} {result['throughput_rps']} req/s")
+    finally:
+        # httpx.ASGITransport doesn't run the app's lifespan, so nothing else stops it
+        await scheduler.stop()
+    return scenarios
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def speedups(scenarios):
+    """p50 latency of the first backend divided by each other backend's, per scenario."""
+    baseline, results = {}, {}
+    for scenario in scenarios:
+        if scenario["kind"] != "generate":
+            continue
+        key = (tuple(scenario["size"]), scenario["concurrency"])
+        p50 = scenario["latency_ms"]["p50"]
+        if key not in baseline:
+            baseline[key] = (scenario["backend"], p50)
+        elif p50 and baseline[key][1]:
+            results[scenario["name"]] = {"baseline": baseline[key][0], "p50_speedup": baseline[key][1] / p50}
+    return results
+
+
+def parse_size(value):
+    width, _, height = value.lower().partition("x")
+    return int(width), int(height or width)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--app", choices=("main2", "main"), default="main2")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--sizes", type=parse_size, nargs="+", default=[(512, 512)])
+    parser.add_argument("--areas", nargs="+", default=["forehead_lines_botox", "lip_filler"])
+    parser.add_argument("--injection-number", type=int, default=20)
+    parser.add_argument("--tier", help="quality tier for /generate/ (defaults to the server default)")
+    parser.add_argument("--requests", type=int, default=16, help="/generate/ requests per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured /generate/ rounds per scenario")
+    parser.add_argument("--backends", nargs="+", help="inference backends to compare (defaults to the configured one)")
+    parser.add_argument("--shared-image", action="store_true",
+                        help="send the same photo every time (exercises the upload cache)")
+    parser.add_argument("--ws-frames", type=int, default=50, help="frames per /ws connection, 0 to skip")
+    parser.add_argument("--ws-frame", help="JPEG to stream to /ws (defaults to random noise, i.e. no face)")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args()
+
+    from tests.tiny_pipeline import build_tiny_pipeline
+    from model.backends import get_backend
+    from model.model_manager import model_manager
+
+    backends = args.backends or [get_backend()]
+    model_manager.set_pipeline(build_tiny_pipeline(), backends[0])
+    if args.app == "main2":
+        import main2 as app_module
+    else:
+        sys.path.insert(0, ROOT)
+        import main as app_module
+    app = app_module.app
+
+    scenarios = asyncio.run(bench_generate_scenarios(app, args, backends, build_tiny_pipeline))
+
+    if args.ws_frames and args.app == "main2":
+        for concurrency in args.concurrency:
+            size = args.sizes[0]
+            name = f"ws {size[0]}x{size[1]} c={concurrency}"
+            print(f"Running {name}...")
+            result = bench_ws(app, size, concurrency, args.ws_frames, args.ws_frame)
+            result.update({"name": name, "kind": "ws", "size": list(size),
+                           "concurrency": concurrency, **memory_snapshot()})
+            scenarios.append(result)
+            print(f"  {json.dumps(result['latency_ms'])} {result['throughput_rps']} frames/s")
+
+    report = {
+        "meta": {
+            "git_revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "device": "cuda" if torch.cuda.is_available() else "cpu",
+            "args": {key: value for key, value in vars(args).items()},
+        },
+        "memory": model_manager.status()["memory"],
+        "scenarios": scenarios,
+        "speedups": speedups(scenarios),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,73 +1,139 @@
-from fastapi import FastAPI, File, UploadFile, Form
-from fastapi.responses import StreamingResponse
-from typing import List
-from app.services.image_generator2 import generate_images
-from PIL import Image
-from io import BytesIO
-import zipfile
+from fastapi import FastAPI, File, UploadFile, Form, Header, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from typing import List, Optional
 import os 
+import sys
 import base64
+
+# Modules under app/ import each other relative to app/ (as when app/main2.py is
+# served); importing them the same way here keeps a single shared model manager
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+
+from services.image_generator2 import image_to_bytes
+from services.batch_scheduler import scheduler
+from model.model_manager import model_manager
+from services.latent_cache import resolve_image
+from services.generation import generate
+from services.bulk import BulkPlan, archive_sources, generate_bulk, stream_bulk_zip, upload_sources
+from services.responses import image_response, negotiate_output
+from services.admission import admission_response, guard_request
+from services.metrics import TimingMiddleware, render_metrics, timed
+
 app = FastAPI()
 
+# Per-request stage timings for /metrics and the optional Server-Timing header
+app.add_middleware(TimingMiddleware)
+
+@app.on_event("startup")
+async def start_scheduler():
+    scheduler.start()
+    # With worker replicas the model lives in the workers, not in this process
+    if scheduler.pool is None:
+        model_manager.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+
+@app.post("/images/")
+async def upload_image_api(file: UploadFile = File(...)):
+    try:
+        entry = await resolve_image(file)
+        return {"image_id": entry.image_id}
+    except Exception as e:
+        print(e)
+        return {"error": str(e)}
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    engine = scheduler.pool or model_manager
+    return JSONResponse(engine.status(), status_code=200 if engine.ready else 503)
+
 @app.post("/generate/")
 async def generate_images_api(
+    request: Request,
     injection_number: int = Form(...),
     selected_area: str = Form(...),
-    file: UploadFile = File(...)
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None),
+    accept: Optional[str] = Header(None)
 ):
     try:
-        image = Image.open(BytesIO(await file.read())).convert("RGB")
-        image = resize_image_dynamic(image)
-        result_image = generate_images(image, selected_area, injection_number)[0]
+        # Accept: image/jpeg or image/webp returns the raw image instead of base64 JSON
+        fmt, raw = negotiate_output(accept, output_format)
+
+        # Decoding, generation and encoding all run off the event loop; repeated
+        # uploads of the same photo reuse its cached init latents
+        init_image = await resolve_image(file, image_id)
+        output_image = await guard_request(
+            request, generate(init_image, selected_area, injection_number, mode, seed, tier)
+        )
 
-        if not result_image:
+        if not output_image:
             return {"error": "No generated image found"}
 
-        result_image_bytes = result_image["image_bytes"]
+        result_image_bytes = await run_in_threadpool(image_to_bytes, output_image, fmt, quality)
+        if raw:
+            return image_response(result_image_bytes, fmt, f"{selected_area}-inj{injection_number}")
 
         # Base64 encode the image bytes
-        encoded_image = base64.b64encode(result_image_bytes).decode('utf-8')
+        with timed("base64"):
+            encoded_image = base64.b64encode(result_image_bytes).decode('utf-8')
 
         return {"image": encoded_image}
     except Exception as e:
+        response = admission_response(e)
+        if response is not None:
+            return response
         print(e)
-        return e
-
-from PIL import Image
-
-def resize_image_dynamic(image: Image.Image, min_size=512, max_size=1024):
-    width, height = image.size
-
-    # Find the longer side and scale factor
-    max_side = max(width, height)
-    min_side = min(width, height)
-
-    # If already within desired range, skip resizing
-    if min_size <= max_side <= max_size:
-        return image
-
-    # Compute new size while preserving aspect ratio
-    if max_side > max_size:
-        scale_factor = max_size / max_side
-    else:
-        scale_factor = min_size / max_side
-
-    new_width = int(width * scale_factor)
-    new_height = int(height * scale_factor)
-
-    resized_image = image.resize((new_width, new_height), Image.LANCZOS)
-    return resized_image
-
-
-    # Create filename like originalname-inj3.jpg
-    # original_filename = os.path.splitext(file.filename)[0]
-    # extension = os.path.splitext(file.filename)[1] or ".jpg"
-    # new_filename = f"{original_filename}-inj{injection_number}{extension}"
+        return {"error": str(e)}
+
+
+@app.post("/generate/bulk/")
+async def generate_bulk_api(
+    archive: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+    selected_area: Optional[str] = Form(None),
+    injection_number: Optional[int] = Form(None),
+    spec: Optional[str] = Form(None),
+    mode: str = Form("full"),
+    seed: Optional[int] = Form(None),
+    tier: Optional[str] = Form(None),
+    output_format: Optional[str] = Form(None),
+    quality: Optional[int] = Form(None)
+):
+    """Renders a zip (archive) or a list (files) of photos, streaming a zip of results as they finish.
 
-    # Prepare image for streaming
-    # buffer = BytesIO(result["image_bytes"])
-    # buffer.seek(0)
+    Results are named originalname-inj{N}.jpg; spec (JSON) can set the area
+    and dose per photo, and a manifest.json at the end lists every render.
+    """
+    try:
+        fmt, _ = negotiate_output(None, output_format)
+        plan = BulkPlan(selected_area, injection_number, spec)
+        if archive is not None:
+            sources = await archive_sources(archive)
+        elif files:
+            sources = await upload_sources(files)
+        else:
+            raise ValueError("Upload a zip as archive or photos as files")
+    except Exception as e:
+        print(e)
+        return {"error": str(e)}
 
-    # return StreamingResponse(buffer, media_type="image/jpeg", headers={
-    #     "Content-Disposition": f"attachment; filename={new_filename}"
-    # })
+    results = generate_bulk(sources, plan, mode, seed, tier, fmt, quality)
+    return StreamingResponse(stream_bulk_zip(results), media_type="application/zip",
+                             headers={"Content-Disposition": "attachment; filename=results.zip"})
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+# Must be set before the app's config module is imported: no model download,
+# and nothing written under the user's cache directory
+_cache = tempfile.mkdtemp(prefix="sdig-tests-")
+os.environ.setdefault("MODEL_LOAD_MODE", "lazy")
+os.environ.setdefault("WORKER_REPLICAS", "0")
+os.environ.setdefault("RESULT_CACHE_ENABLED", "0")
+os.environ.setdefault("RESULT_CACHE_DIR", os.path.join(_cache, "results"))
+os.environ.setdefault("BACKEND_CACHE_DIR", os.path.join(_cache, "backends"))
+os.environ.setdefault("JOB_DB_PATH", os.path.join(_cache, "jobs.sqlite3"))
+os.environ.setdefault("JOB_DIR", os.path.join(_cache, "jobs"))
+
+
+@pytest.fixture
+def tiny_pipeline():
+    """A few-MB random SD-1.5-shaped pipeline that runs on CPU (see tiny_pipeline.py)."""
+    from .tiny_pipeline import build_tiny_pipeline
+
+    return build_tiny_pipeline()
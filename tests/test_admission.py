@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+from PIL import Image
+
+import config
+import services.batch_scheduler as batch_scheduler
+from services.admission import (ClientDisconnected, DeadlineExceeded, GenerationCancelled, Overloaded,
+                                admission_response, current_cancel_check, raise_if_cancelled, request_timeout)
+from services.batch_scheduler import BatchScheduler
+
+
+class FakeRequest:
+    def __init__(self, **headers):
+        self.headers = headers
+
+
+def test_request_timeout_is_capped_by_the_server(monkeypatch):
+    monkeypatch.setattr(config, "REQUEST_TIMEOUT", 60)
+    assert request_timeout(FakeRequest()) == 60
+    assert request_timeout(FakeRequest(**{"x-request-timeout": "5"})) == 5
+    assert request_timeout(FakeRequest(**{"x-request-timeout": "600"})) == 60
+
+    monkeypatch.setattr(config, "REQUEST_TIMEOUT", 0)
+    assert request_timeout(FakeRequest()) is None
+    assert request_timeout(FakeRequest(**{"x-request-timeout": "600"})) == 600
+    with pytest.raises(ValueError):
+        request_timeout(FakeRequest(**{"x-request-timeout": "soon"}))
+
+
+def test_admission_response_status_codes():
+    overloaded = admission_response(Overloaded(7))
+    assert overloaded.status_code == 429
+    assert overloaded.headers["retry-after"] == "7"
+    assert admission_response(DeadlineExceeded("late")).status_code == 504
+    assert admission_response(ClientDisconnected("gone")).status_code == 499
+    assert admission_response(ValueError("other")) is None
+
+
+def test_raise_if_cancelled_follows_the_check():
+    raise_if_cancelled()
+    token = current_cancel_check.set(lambda: True)
+    try:
+        with pytest.raises(GenerationCancelled):
+            raise_if_cancelled()
+    finally:
+        current_cancel_check.reset(token)
+
+
+def test_scheduler_rejects_a_full_queue(monkeypatch):
+    monkeypatch.setattr(batch_scheduler, "generate_images_batch", lambda images, *args: [image.copy() for image in images])
+
+    async def scenario():
+        scheduler = BatchScheduler(max_batch_size=2, replicas=0, max_queue=1)
+        scheduler.batch_seconds = 3.0
+        try:
+            first = asyncio.ensure_future(scheduler.submit(Image.new("RGB", (64, 64)), "lip_filler", 1))
+            await asyncio.sleep(0)
+            with pytest.raises(Overloaded) as error:
+                await scheduler.submit(Image.new("RGB", (64, 64)), "lip_filler", 2)
+            await first
+            return error.value
+        finally:
+            await scheduler.stop()
+
+    # One pending request, two per batch, three seconds per batch
+    assert asyncio.run(scenario()).retry_after == 2
+
+
+def test_retry_after_scales_with_backlog():
+    scheduler = BatchScheduler(max_batch_size=4, replicas=0)
+    scheduler.batch_seconds = 2.0
+    assert scheduler.retry_after() == 1
+
+    scheduler._queue = asyncio.Queue()
+    for _ in range(10):
+        scheduler._queue.put_nowait(object())
+    assert scheduler.retry_after() == 5
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from diffusers import UNet2DConditionModel
+from safetensors.torch import save_file
+
+import config
+from model.backends import apply_backend, autocast, backend_device, get_backend
+from model.shared_weights import is_mmap_loaded, load_mmap_component
+
+
+@pytest.fixture
+def eager(monkeypatch):
+    """The CPU backend without torch.compile, which would take minutes."""
+    monkeypatch.setattr(config, "BACKEND_COMPILE", False)
+    monkeypatch.setattr(config, "BACKEND_BF16", True)
+    monkeypatch.setattr(config, "BACKEND_CHANNELS_LAST", True)
+    monkeypatch.setattr(config, "WORKER_REPLICAS", 0)
+
+
+def conv_weight(module):
+    return next(p for p in module.parameters() if p.dim() == 4)
+
+
+def test_backend_names():
+    assert get_backend("cpu") == "cpu"
+    assert backend_device("openvino") == "cpu"
+    with pytest.raises(ValueError, match="Unknown inference backend"):
+        get_backend("tensorrt")
+
+
+def test_autocast_calls_hand_back_float32():
+    def call(x):
+        return x @ x, "meta"
+
+    output, meta = autocast(call, torch.bfloat16)(torch.ones(2, 2))
+    assert output.dtype == torch.float32 and meta == "meta"
+
+
+def test_cpu_backend_wraps_the_heavy_calls(eager, tiny_pipeline):
+    apply_backend(tiny_pipeline, "cpu")
+
+    assert conv_weight(tiny_pipeline.unet).is_contiguous(memory_format=torch.channels_last)
+    # Instance attributes, so scheduler views built from the components run them too
+    assert hasattr(vars(tiny_pipeline.unet)["forward"], "__wrapped__")
+    # The VAE encode keeps float32 for the cached init latents
+    assert not hasattr(vars(tiny_pipeline.vae)["encode"], "__wrapped__")
+    assert hasattr(vars(tiny_pipeline.vae)["decode"], "__wrapped__")
+
+
+def test_mapped_weights_stay_shared_across_replicas(eager, monkeypatch, tiny_pipeline, tmp_path):
+    path = str(tmp_path / "unet.safetensors")
+    save_file(tiny_pipeline.unet.state_dict(), path)
+    unet = load_mmap_component(lambda: UNet2DConditionModel.from_config(tiny_pipeline.unet.config), path,
+                               torch.float32)
+    assert is_mmap_loaded(unet) and not is_mmap_loaded(tiny_pipeline.vae)
+    mapped = conv_weight(unet).data_ptr()
+
+    monkeypatch.setattr(config, "WORKER_REPLICAS", 2)
+    pipeline = SimpleNamespace(unet=unet, vae=tiny_pipeline.vae, text_encoder=tiny_pipeline.text_encoder)
+    apply_backend(pipeline, "cpu")
+
+    # Converting to channels_last would copy the weights out of the mapping
+    assert conv_weight(unet).data_ptr() == mapped
+    assert conv_weight(pipeline.vae).is_contiguous(memory_format=torch.channels_last)
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import pytest
+from PIL import Image
+
+import services.batch_scheduler as batch_scheduler
+from services.batch_scheduler import BatchScheduler
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Replaces the pipeline call with a stub that records each batch."""
+    calls = []
+
+    def generate_images_batch(images, areas, injection_numbers, strength, init_latents, seeds, tier):
+        calls.append((time.monotonic(), list(injection_numbers)))
+        return [image.copy() for image in images]
+
+    monkeypatch.setattr(batch_scheduler, "generate_images_batch", generate_images_batch)
+    return calls
+
+
+def run(scenario):
+    async def main():
+        scheduler = BatchScheduler(max_batch_size=2, max_wait_ms=100, replicas=0, max_queue=0)
+        try:
+            return await scenario(scheduler)
+        finally:
+            await scheduler.stop()
+    return asyncio.run(main())
+
+
+def test_compatible_requests_share_a_batch(calls):
+    image = Image.new("RGB", (64, 64))
+
+    async def scenario(scheduler):
+        return await asyncio.gather(
+            *(scheduler.submit(image, "lip_filler", units, tier="preview") for units in (1, 2, 3))
+        )
+
+    results = run(scenario)
+    assert [result.size for result in results] == [(64, 64)] * 3
+    assert [units for _, units in calls] == [[1, 2], [3]]
+
+
+def test_incompatible_requests_are_grouped_apart(calls):
+    async def scenario(scheduler):
+        return await asyncio.gather(
+            scheduler.submit(Image.new("RGB", (64, 64)), "lip_filler", 1, tier="preview"),
+            scheduler.submit(Image.new("RGB", (64, 128)), "lip_filler", 2, tier="preview"),
+            scheduler.submit(Image.new("RGB", (64, 64)), "lip_filler", 3, tier="final"),
+        )
+
+    run(scenario)
+    assert sorted(units for _, units in calls) == [[1], [2], [3]]
+
+
+def test_partial_batch_dispatches_after_max_wait(calls):
+    async def scenario(scheduler):
+        started = time.monotonic()
+        await scheduler.submit(Image.new("RGB", (64, 64)), "lip_filler", 1, tier="preview")
+        return started
+
+    started = run(scenario)
+    dispatched, units = calls[0]
+    assert units == [1]
+    assert 0.09 <= dispatched - started < 1.0
@@ -0,0 +1,41 @@
+import json
+
+import pytest
+
+from services.bulk import BulkPlan, output_name, unique_name
+
+
+def test_bulk_plan_defaults_and_overrides():
+    spec = {
+        "a.jpg": {"injection_number": 5},
+        "photos/b.jpg": [{"selected_area": "lip_filler"}, {"selected_area": "crows_feet_botox", "injection_number": 8}],
+    }
+    plan = BulkPlan("forehead_lines_botox", 20, json.dumps(spec))
+
+    assert plan.multiple
+    assert plan.renders("c.jpg") == [("forehead_lines_botox", 20)]
+    assert plan.renders("nested/a.jpg") == [("forehead_lines_botox", 5)]
+    assert plan.renders("photos/b.jpg") == [("lip_filler", 20), ("crows_feet_botox", 8)]
+
+
+def test_bulk_plan_needs_an_area_and_dose():
+    plan = BulkPlan(None, 10, None)
+    assert not plan.multiple
+    with pytest.raises(ValueError):
+        plan.renders("a.jpg")
+    with pytest.raises(ValueError):
+        BulkPlan("lip_filler", 1, json.dumps(["a.jpg"]))
+
+
+def test_output_name():
+    assert output_name("photos/face.png", "lip_filler", 2, "jpeg", False) == "photos/face-inj2.jpg"
+    assert output_name("face.png", "lip_filler", 2, "webp", True) == "face-lip_filler-inj2.webp"
+    assert output_name("dir\\face.jpg", "lip_filler", 2, "jpeg", False) == "dir/face-inj2.jpg"
+
+
+def test_unique_name():
+    used = {"manifest.json"}
+    assert unique_name("face-inj2.jpg", used) == "face-inj2.jpg"
+    assert unique_name("face-inj2.jpg", used) == "face-inj2-2.jpg"
+    assert unique_name("face-inj2.jpg", used) == "face-inj2-3.jpg"
+    assert unique_name("manifest.json", used) == "manifest-2.json"
@@ -0,0 +1,23 @@
+import pytest
+
+import config
+from services.generation import plan_dose_sweep
+
+
+def test_plan_dose_sweep_collapses_identical_renders():
+    # Filler prompts don't mention the units, so every dose is the same render
+    frames = plan_dose_sweep("lip_filler", [1, 2, 3])
+    assert len(frames) == 1
+    assert frames[0]["injection_number"] == 1
+    assert frames[0]["units"] == [1, 2, 3]
+
+
+def test_plan_dose_sweep_keeps_distinct_doses():
+    frames = plan_dose_sweep("forehead_lines_botox", [10, 20, 10])
+    assert [frame["units"] for frame in frames] == [[10, 10], [20]]
+
+
+def test_plan_dose_sweep_limits_frames(monkeypatch):
+    monkeypatch.setattr(config, "SWEEP_MAX_FRAMES", 2)
+    with pytest.raises(ValueError):
+        plan_dose_sweep("forehead_lines_botox", [5, 10, 15])
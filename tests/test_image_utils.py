@@ -0,0 +1,93 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import config
+from services.image_utils import bucket_image, choose_bucket, load_image, restore_framing, target_size
+
+BUCKETS = [(1024, 1024), (1024, 640), (640, 1024), (512, 512), (512, 320), (320, 512)]
+
+
+def gradient(width, height):
+    x = np.linspace(0, 255, width, dtype=np.uint8)
+    y = np.linspace(0, 255, height, dtype=np.uint8)
+    pixels = np.stack([np.tile(x, (height, 1)), np.tile(y[:, None], (1, width)), np.full((height, width), 128, np.uint8)], -1)
+    return Image.fromarray(pixels)
+
+
+def jpeg(width, height, **save_options):
+    buffer = BytesIO()
+    Image.new("RGB", (width, height), (90, 120, 150)).save(buffer, format="JPEG", **save_options)
+    return buffer.getvalue()
+
+
+def test_target_size_scales_into_range():
+    assert target_size(2000, 1000) == (1024, 512)
+    assert target_size(256, 128) == (512, 256)
+    assert target_size(800, 600) == (800, 600)
+
+
+def test_load_image_downscales_large_jpegs():
+    image = load_image(jpeg(4000, 3000))
+    assert image.size == (1024, 768)
+    assert image.mode == "RGB"
+
+
+def test_load_image_applies_exif_orientation():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotated 90 degrees clockwise
+    assert load_image(jpeg(600, 400, exif=exif)).size == (400, 600)
+
+
+def test_load_image_rejects_too_many_pixels(monkeypatch):
+    monkeypatch.setattr(config, "UPLOAD_MAX_PIXELS", 1000 * 1000)
+    with pytest.raises(ValueError):
+        load_image(BytesIO(jpeg(1200, 1000)))
+
+
+def test_choose_bucket_does_not_upscale():
+    assert choose_bucket(1000, 600, BUCKETS) == (512, 320)
+    assert choose_bucket(1200, 720, BUCKETS) == (1024, 640)
+    assert choose_bucket(700, 1100, BUCKETS) == (640, 1024)
+    # Smaller than every bucket: the smallest group
+    assert choose_bucket(300, 300, BUCKETS) == (512, 512)
+
+
+@pytest.mark.parametrize("fit", ["pad", "crop"])
+def test_bucket_image_round_trips(fit):
+    original = gradient(1200, 700)
+    bucketed, framing = bucket_image(original, BUCKETS, fit)
+
+    assert bucketed.size == framing.bucket == (1024, 640)
+    restored = restore_framing(bucketed, original, framing)
+    assert restored.size == original.size
+    difference = np.abs(np.asarray(restored, np.int16) - np.asarray(original, np.int16))
+    assert difference.mean() < 4
+
+
+def test_bucket_image_pads_symmetrically():
+    _, framing = bucket_image(gradient(1200, 700), BUCKETS, "pad")
+    left, top, right, bottom = framing.target_box
+    assert (left, right) == (0, 1024)
+    assert abs(top - (640 - bottom)) <= 1
+    assert framing.source_box == (0, 0, 1200, 700)
+
+
+def test_bucket_image_crop_keeps_margins():
+    original = gradient(1200, 700)
+    _, framing = bucket_image(original, BUCKETS, "crop")
+    left, top, right, bottom = framing.source_box
+    assert (top, bottom) == (0, 700)
+    assert 0 < left and right < 1200
+
+    # The cropped-off margins come back untouched
+    restored = restore_framing(Image.new("RGB", framing.bucket), original, framing)
+    assert restored.getpixel((0, 350)) == original.getpixel((0, 350))
+    assert restored.getpixel((600, 350)) == (0, 0, 0)
+
+
+def test_bucket_image_rejects_unknown_fit():
+    with pytest.raises(ValueError):
+        bucket_image(gradient(600, 600), BUCKETS, "stretch")
@@ -0,0 +1,46 @@
+import pytest
+
+from services.job_store import JobStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_find_reuses_pending_and_finished_jobs(store):
+    job = store.create("key", {"units": 1}, "image")
+    assert store.find("key")["id"] == job["id"]
+    assert store.find("other") is None
+
+    store.update(job["id"], status="done", result_path="result.jpg")
+    assert store.find("key")["result_path"] == "result.jpg"
+
+
+def test_find_skips_failed_jobs(store):
+    failed = store.create("key", {}, "image")
+    store.update(failed["id"], status="failed", error="boom")
+    assert store.find("key") is None
+
+    retried = store.create("key", {}, "image")
+    assert store.find("key")["id"] == retried["id"]
+
+
+def test_position_counts_earlier_unfinished_jobs(store):
+    jobs = [store.create(f"key{i}", {}, "image") for i in range(3)]
+    assert [store.position(job) for job in jobs] == [0, 1, 2]
+
+    store.update(jobs[0]["id"], status="done")
+    assert store.position(store.get(jobs[0]["id"])) is None
+    assert store.position(jobs[2]) == 1
+
+
+def test_expire_only_removes_finished_jobs(store):
+    done = store.create("a", {}, "image")
+    store.update(done["id"], status="done")
+    queued = store.create("b", {}, "image")
+
+    expired = store.expire(float("inf"))
+    assert [job["id"] for job in expired] == [done["id"]]
+    assert store.get(done["id"]) is None
+    assert [job["id"] for job in store.unfinished()] == [queued["id"]]
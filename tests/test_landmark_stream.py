@@ -0,0 +1,134 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import services.landmark_stream as landmark_stream
+from services.landmark_stream import (AREA_INDICES, AREA_NAMES, PACKET_HEADER, UNIQUE_INDICES, FrameSlot,
+                                      LandmarkStream, StreamOptions, pack_landmarks, to_landmark_list)
+
+
+class FakeFaceMesh:
+    def __init__(self, **options):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(autouse=True)
+def face_mesh(monkeypatch):
+    """No MediaPipe graph: every test replaces _detect with fixed points."""
+    solutions = SimpleNamespace(face_mesh=SimpleNamespace(FaceMesh=FakeFaceMesh))
+    monkeypatch.setattr(landmark_stream, "mp", SimpleNamespace(solutions=solutions))
+
+
+def fake_detect(points):
+    """Stands in for FaceMesh: the same raw pixel coordinates for every frame."""
+    return lambda frame: np.asarray(points, dtype=np.float32)
+
+
+def test_detect_maps_unique_landmarks_to_every_area():
+    stream = LandmarkStream(smoothing=0.0)
+    raw = np.stack([UNIQUE_INDICES, UNIQUE_INDICES + 1], axis=1)
+    stream._detect = fake_detect(raw)
+    try:
+        points = stream.detect(np.zeros((8, 8, 3), np.uint8))
+    finally:
+        stream.close()
+
+    assert points.shape == (len(AREA_INDICES), 2)
+    assert points[:, 0].tolist() == AREA_INDICES.tolist()
+
+    landmarks = to_landmark_list(points)
+    assert [landmark["name"] for landmark in landmarks] == AREA_NAMES
+    assert landmarks[0] == {"name": AREA_NAMES[0], "index": int(AREA_INDICES[0]),
+                            "x": int(AREA_INDICES[0]), "y": int(AREA_INDICES[0]) + 1}
+
+
+def test_smoothing_is_per_connection():
+    frame = np.zeros((8, 8, 3), np.uint8)
+    first, second = LandmarkStream(smoothing=0.5), LandmarkStream(smoothing=0.5)
+    try:
+        first._detect = fake_detect(np.zeros((len(UNIQUE_INDICES), 2)))
+        first.detect(frame)
+        first._detect = fake_detect(np.full((len(UNIQUE_INDICES), 2), 100))
+        second._detect = fake_detect(np.full((len(UNIQUE_INDICES), 2), 100))
+
+        # Halfway towards the new position on the connection that saw the old one
+        assert (first.detect(frame) == 50).all()
+        assert (second.detect(frame) == 100).all()
+    finally:
+        first.close()
+        second.close()
+
+
+def test_no_face_returns_none():
+    stream = LandmarkStream()
+    stream._detect = lambda frame: None
+    try:
+        assert stream.detect(np.zeros((8, 8, 3), np.uint8)) is None
+    finally:
+        stream.close()
+
+
+def test_pack_landmarks_layout():
+    points = np.arange(len(AREA_INDICES) * 2, dtype=np.int32).reshape(-1, 2)
+    packet = pack_landmarks(7, 12.5, points)
+
+    sequence, processing_ms, count = PACKET_HEADER.unpack_from(packet)
+    assert (sequence, processing_ms, count) == (7, 12.5, len(AREA_INDICES))
+    body = np.frombuffer(packet[PACKET_HEADER.size:], dtype="<i2")
+    assert body.reshape(-1, 2).tolist() == points.tolist()
+
+
+def test_pack_landmarks_without_a_face():
+    packet = pack_landmarks(2 ** 32 + 1, 1.0, None)
+    assert len(packet) == PACKET_HEADER.size
+    assert PACKET_HEADER.unpack(packet)[::2] == (1, 0)
+
+
+def test_stream_options_validate_the_handshake():
+    options = StreamOptions.from_message({"protocol": "binary", "scale": 5, "jpeg_quality": 0})
+    assert (options.render, options.scale, options.jpeg_quality) == (False, 1.0, 1)
+    assert options.handshake()["scale"] == 1.0
+    with pytest.raises(ValueError):
+        StreamOptions(protocol="msgpack")
+
+
+def test_frame_slot_latest_only_drops_stale_frames():
+    async def scenario():
+        slot = FrameSlot(latest_only=True)
+        for frame in (b"1", b"2", b"3"):
+            slot.put(frame)
+        data, _ = await slot.get()
+        slot.close()
+        return data, slot.dropped, await slot.get()
+
+    assert asyncio.run(scenario()) == (b"3", 2, None)
+
+
+def test_frame_slot_ordered_keeps_every_frame():
+    async def scenario():
+        slot = FrameSlot(latest_only=False)
+        for frame in (b"1", b"2"):
+            slot.put(frame)
+        slot.close()
+        frames = []
+        while (frame := await slot.get()) is not None:
+            frames.append(frame[0])
+        return frames, slot.dropped
+
+    assert asyncio.run(scenario()) == ([b"1", b"2"], 0)
+
+
+def test_frame_slot_wakes_a_waiting_reader():
+    async def scenario():
+        slot = FrameSlot()
+        reader = asyncio.ensure_future(slot.get())
+        await asyncio.sleep(0)
+        slot.put(b"frame")
+        return (await reader)[0]
+
+    assert asyncio.run(scenario()) == b"frame"
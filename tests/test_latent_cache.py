@@ -0,0 +1,30 @@
+import torch
+from PIL import Image
+
+from services.latent_cache import CachedImage, LatentCache
+
+
+def entry(image_id, size=8):
+    return CachedImage(image_id, Image.new("RGB", (size, size)), torch.zeros(1, 4, size // 8, size // 8))
+
+
+def test_latent_cache_evicts_to_budget():
+    first = entry("a")
+    cache = LatentCache(budget_bytes=first.nbytes * 2)
+    cache.put(first)
+    cache.put(entry("b"))
+    cache.get("a")
+    cache.put(entry("c"))
+
+    assert cache.get("b") is None
+    assert cache.get("a") is first
+    assert cache.nbytes == first.nbytes * 2
+
+
+def test_latent_cache_keeps_newest_entry_over_budget():
+    cache = LatentCache(budget_bytes=1)
+    cache.put(entry("a"))
+    cache.put(entry("b"))
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
@@ -0,0 +1,23 @@
+import asyncio
+import os
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import app  # noqa: E402
+
+
+def post(path, **kwargs):
+    async def request():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(path, **kwargs)
+    return asyncio.run(request())
+
+
+def test_generate_errors_are_json():
+    response = post("/generate/", data={"injection_number": "10", "selected_area": "lip_filler", "image_id": "missing"})
+    assert response.status_code == 200
+    assert "Unknown or expired image_id" in response.json()["error"]
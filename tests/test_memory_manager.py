@@ -0,0 +1,53 @@
+import torch
+
+import config
+from model.memory_manager import MemoryManager, available_bytes
+
+
+def manager(budget_bytes):
+    memory = MemoryManager()
+    memory.device = "cpu"
+    memory.placement = "resident"
+    memory.budget_bytes = budget_bytes
+    return memory
+
+
+def memory_for(side):
+    """A budget that fits one side x side call without memory savers, and nothing larger."""
+    return MemoryManager().call_bytes(side, side, 1)
+
+
+def savers(pipeline):
+    processor = next(iter(pipeline.unet.attn_processors.values()))
+    return type(processor).__name__, pipeline.vae.use_tiling
+
+
+def test_prepare_switches_savers_per_call(tiny_pipeline):
+    memory = manager(budget_bytes=memory_for(512))
+    assert memory.prepare(tiny_pipeline, 1024, 1024, 4) == "resident+attention_slicing+vae_tiling"
+    sliced = savers(tiny_pipeline)
+    assert memory.prepare(tiny_pipeline, 256, 256, 1) == "resident"
+    assert savers(tiny_pipeline) != sliced
+
+
+def test_frozen_savers_stay_put(tiny_pipeline):
+    memory = manager(budget_bytes=memory_for(512))
+    policy = memory.freeze(tiny_pipeline)
+    assert policy == "resident+attention_slicing+vae_tiling"
+    frozen = savers(tiny_pipeline)
+
+    # Compiled calls must see the same attention processors and VAE every time
+    assert memory.prepare(tiny_pipeline, 256, 256, 1) == policy
+    assert savers(tiny_pipeline) == frozen
+
+
+def test_cuda_budget_is_free_memory_split_across_replicas(monkeypatch):
+    gib = 1024 ** 3
+    monkeypatch.setattr(torch.cuda, "mem_get_info", lambda: (10 * gib, 24 * gib))
+    monkeypatch.setattr(torch.cuda, "memory_reserved", lambda: 2 * gib)
+    monkeypatch.setattr(config, "WORKER_REPLICAS", 0)
+    # Another process holds the rest of the card; our own reserved blocks are reusable
+    assert available_bytes("cuda") == 12 * gib
+
+    monkeypatch.setattr(config, "WORKER_REPLICAS", 3)
+    assert available_bytes("cuda") == 4 * gib
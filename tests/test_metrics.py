@@ -0,0 +1,114 @@
+import asyncio
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from services.metrics import (Histogram, TimingMiddleware, histogram_changes, histogram_snapshot,
+                              merge_histograms, request_seconds, stage_seconds, timed)
+
+app = FastAPI()
+app.add_middleware(TimingMiddleware)
+
+
+@app.get("/plain/{item}")
+async def plain(item: str):
+    with timed("prepare"):
+        pass
+    return {"item": item}
+
+
+@app.get("/stream")
+async def stream():
+    async def chunks():
+        yield b"first"
+        # Runs after the headers have gone out
+        with timed("encode"):
+            await asyncio.sleep(0.05)
+        yield b"last"
+    return StreamingResponse(chunks())
+
+
+def get(path, **kwargs):
+    async def request():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path, **kwargs)
+    return asyncio.run(request())
+
+
+def observed(path):
+    series = request_seconds.snapshot().get(path)
+    return (series[-2], series[-1]) if series else (0, 0.0)
+
+
+def test_server_timing_reports_stages_by_route_template():
+    before = observed("/plain/{item}")
+    response = get("/plain/abc", headers={"x-timing": "1"})
+
+    assert response.json() == {"item": "abc"}
+    assert "prepare;dur=" in response.headers["Server-Timing"]
+    assert "total;dur=" in response.headers["Server-Timing"]
+    assert observed("/plain/{item}")[0] == before[0] + 1
+    assert "Server-Timing" not in get("/plain/abc").headers
+
+
+def test_streaming_requests_are_timed_to_the_last_chunk():
+    count, total = observed("/stream")
+    response = get("/stream")
+
+    assert response.content == b"firstlast"
+    after_count, after_total = observed("/stream")
+    assert after_count == count + 1
+    assert after_total - total >= 0.05
+
+
+def test_streaming_stages_go_out_as_a_trailer():
+    messages = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # The response listens for a disconnect that never comes
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/stream", "raw_path": b"/stream", "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"test"), (b"x-timing", b"1")], "server": ("test", 80), "client": None,
+        "extensions": {"http.response.trailers": {}},
+    }
+    asyncio.run(app(scope, receive, send))
+
+    start, trailer = messages[0], messages[-1]
+    assert start["trailers"] is True
+    assert (b"trailer", b"Server-Timing") in start["headers"]
+    assert trailer["type"] == "http.response.trailers"
+    server_timing = dict(trailer["headers"])[b"server-timing"].decode()
+    assert "encode;dur=" in server_timing and "total;dur=" in server_timing
+
+
+def test_histogram_changes_merge_back():
+    histogram = Histogram("test_seconds", "Test.", (0.1, 1), "stage")
+    histogram.observe(0.05, "a")
+    histogram.observe(0.5, "a")
+    assert histogram.snapshot() == {"a": [1, 2, 2, 0.55]}
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 2' in histogram.render()
+
+    before = histogram_snapshot()
+    started = time.perf_counter()
+    with timed("merge_test"):
+        pass
+    changes = histogram_changes(before)
+    assert list(changes) == [stage_seconds.name]
+    assert changes[stage_seconds.name]["merge_test"][-2] == 1
+
+    # As if a worker process had made the same observation
+    merge_histograms(changes)
+    assert stage_seconds.snapshot()["merge_test"][-2] == 2
+    assert stage_seconds.snapshot()["merge_test"][-1] <= 2 * (time.perf_counter() - started)
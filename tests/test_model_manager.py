@@ -0,0 +1,55 @@
+import pytest
+
+import config
+from model.model_manager import ModelManager
+
+
+class FakePipeline:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(config, "MODEL_WARMUP", True)
+    monkeypatch.setattr(config, "MODEL_WARMUP_SIZE", 8)
+    return ModelManager(loader=lambda path: FakePipeline())
+
+
+def test_model_manager_is_ready_after_warmup(manager):
+    warmed = []
+    manager.add_warmup(lambda: warmed.append(manager.get_pipeline()))
+
+    pipeline = manager.get_pipeline()
+    assert pipeline.calls[0]["num_inference_steps"] == 2
+    # Hooks run on the loader thread and see the pipeline before it is ready
+    assert warmed == [pipeline]
+    assert manager.ready
+    assert manager.status()["state"] == "ready"
+
+
+def test_model_manager_is_degraded_when_warmup_fails(manager):
+    def fail():
+        raise RuntimeError("out of memory")
+    manager.add_warmup(fail)
+
+    # Requests can still use the loaded pipeline...
+    assert isinstance(manager.get_pipeline(), FakePipeline)
+    # ...but readiness stays false
+    assert not manager.ready
+    assert manager.status()["state"] == "degraded"
+    assert manager.status()["error"] == "out of memory"
+
+
+def test_model_manager_reports_failed_load():
+    def loader(path):
+        raise OSError("no such model")
+    manager = ModelManager(loader=loader)
+
+    with pytest.raises(RuntimeError, match="no such model"):
+        manager.get_pipeline()
+    assert not manager.ready
+    assert manager.state == "failed"
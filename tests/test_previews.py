@@ -0,0 +1,77 @@
+import asyncio
+from io import BytesIO
+
+import pytest
+import torch
+from PIL import Image
+
+import config
+import services.batch_scheduler as batch_scheduler
+from services.batch_scheduler import BatchScheduler
+from services.previews import current_preview_listener, current_preview_sink, latents_to_previews, publish_previews
+
+
+@pytest.fixture(autouse=True)
+def every_step(monkeypatch):
+    monkeypatch.setattr(config, "PREVIEW_EVERY_STEPS", 1)
+
+
+def publish(step, steps, wanted, batch=2):
+    published = []
+    token = current_preview_sink.set((lambda *preview: published.append(preview), wanted))
+    try:
+        publish_previews(step, steps, torch.randn(batch, 4, 8, 16))
+    finally:
+        current_preview_sink.reset(token)
+    return published
+
+
+def test_previews_keep_the_aspect_ratio(monkeypatch):
+    monkeypatch.setattr(config, "PREVIEW_SIZE", 64)
+    preview, = latents_to_previews(torch.randn(1, 4, 8, 16))
+    assert preview.size == (64, 32)
+
+
+def test_only_streamed_items_are_encoded():
+    (step, steps, images), = publish(0, 4, [False, True])
+    assert (step, steps) == (1, 4)
+    assert images[0] is None
+    assert Image.open(BytesIO(images[1])).format == "JPEG"
+
+
+def test_previews_follow_the_step_schedule(monkeypatch):
+    # The last step's image is decoded right after, so it gets no preview
+    assert publish(3, 4, [True, True]) == []
+    monkeypatch.setattr(config, "PREVIEW_EVERY_STEPS", 2)
+    assert publish(0, 4, [True, True]) == []
+    assert len(publish(1, 4, [True, True])) == 1
+    # Nothing to do without a streaming request in the batch
+    publish_previews(0, 4, torch.randn(1, 4, 8, 8))
+
+
+def test_scheduler_sends_previews_only_to_streaming_requests(monkeypatch):
+    masks = []
+
+    def generate_images_batch(images, areas, injection_numbers, strength, init_latents, seeds, tier):
+        masks.append(current_preview_sink.get()[1])
+        publish_previews(0, 4, torch.randn(len(images), 4, 8, 8))
+        return [image.copy() for image in images]
+
+    monkeypatch.setattr(batch_scheduler, "generate_images_batch", generate_images_batch)
+    image = Image.new("RGB", (64, 64))
+    previews = []
+
+    async def streaming(scheduler):
+        current_preview_listener.set(lambda step, steps, jpeg: previews.append((step, steps, jpeg[:2])))
+        return await scheduler.submit(image, "lip_filler", 1, tier="preview")
+
+    async def main():
+        scheduler = BatchScheduler(max_batch_size=2, max_wait_ms=100, replicas=0, max_queue=0)
+        try:
+            await asyncio.gather(scheduler.submit(image, "lip_filler", 2, tier="preview"), streaming(scheduler))
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(main())
+    assert masks == [[False, True]]
+    assert previews == [(1, 4, b"\xff\xd8")]
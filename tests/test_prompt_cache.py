@@ -0,0 +1,33 @@
+import torch
+
+from services.prompt_cache import PromptEmbeddingCache
+
+
+def test_prompt_cache_evicts_least_recently_used():
+    encoded = []
+
+    def encode(text):
+        encoded.append(text)
+        return torch.zeros(1, 4)
+
+    cache = PromptEmbeddingCache(encode, max_entries=2)
+    cache.get("a", lambda: "a")
+    cache.get("b", lambda: "b")
+    cache.get("a", lambda: "a")
+    cache.get("c", lambda: "c")
+    cache.get("a", lambda: "a")
+    cache.get("b", lambda: "b")
+
+    assert encoded == ["a", "b", "c", "b"]
+    assert cache.stats()["entries"] == 2
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_prompt_cache_keeps_pinned_entries():
+    cache = PromptEmbeddingCache(lambda text: torch.zeros(1), max_entries=1)
+    pinned = cache.get("negative", lambda: "negative", pinned=True)
+    for key in "abc":
+        cache.get(key, lambda: key)
+
+    assert cache.get("negative", lambda: "negative") is pinned
+    assert cache.stats()["pinned_entries"] == 1
@@ -0,0 +1,47 @@
+import numpy as np
+from PIL import Image
+
+import config
+from services.region import blend_region, region_box, region_mask
+
+POINTS = np.array([[200, 300], [260, 300], [230, 320], [215, 310]], dtype=np.float32)
+
+
+def test_region_box_is_a_padded_square_around_the_points():
+    left, top, right, bottom = region_box(POINTS, (512, 512))
+    side = right - left
+    assert side == bottom - top
+    assert side % 8 == 0 and side >= config.REGION_MIN_SIZE - 8
+    assert left <= 200 and right >= 260 and top <= 300 and bottom >= 320
+
+
+def test_region_box_stays_inside_the_image():
+    points = np.array([[2, 3], [40, 30]], dtype=np.float32)
+    assert region_box(points, (300, 200))[:2] == (0, 0)
+
+    box = region_box(points + (250, 160), (300, 200))
+    assert box[2] <= 300 and box[3] <= 200
+    assert box[2] - box[0] <= 200
+
+
+def test_region_mask_covers_the_points_and_spares_the_border():
+    box = region_box(POINTS, (512, 512))
+    mask = np.asarray(region_mask(POINTS, box))
+    assert mask.shape == (box[3] - box[1], box[2] - box[0])
+
+    center = (POINTS.mean(axis=0) - box[:2]).astype(int)
+    assert mask[center[1], center[0]] == 255
+    assert not mask[:2].any() and not mask[-2:].any()
+    assert not mask[:, :2].any() and not mask[:, -2:].any()
+
+
+def test_blend_region_only_changes_the_masked_area():
+    image = Image.new("RGB", (512, 512), (10, 20, 30))
+    box = region_box(POINTS, image.size)
+    mask = region_mask(POINTS, box)
+    generated = Image.new("RGB", (config.REGION_WORKING_SIZE,) * 2, (250, 250, 250))
+
+    result = blend_region(image, generated, box, mask)
+    assert result.getpixel((0, 0)) == (10, 20, 30)
+    assert result.getpixel((box[0], box[1])) == (10, 20, 30)
+    assert result.getpixel((230, 310)) == (250, 250, 250)
@@ -0,0 +1,37 @@
+import numpy as np
+import torch
+from PIL import Image
+
+import config
+from services.latent_cache import CachedImage, LatentCache
+from services.residual import lowres_size, transfer_residual
+
+
+def test_lowres_size(monkeypatch):
+    monkeypatch.setattr(config, "LOWRES_SIZE", 512)
+    assert lowres_size(1024, 768) == (512, 384)
+    assert lowres_size(1000, 333) == (512, 168)
+    # Never upscales, always multiples of 8
+    assert lowres_size(300, 203) == (296, 200)
+    assert lowres_size(4000, 4) == (512, 8)
+
+
+def test_transfer_residual_adds_the_low_resolution_edit():
+    image = Image.new("RGB", (64, 64), (100, 100, 100))
+    small = Image.new("RGB", (32, 32), (100, 100, 100))
+    generated = Image.new("RGB", (32, 32), (110, 90, 100))
+
+    result = np.asarray(transfer_residual(image, small, generated))
+    assert result.shape == (64, 64, 3)
+    assert (np.abs(result.astype(int) - (110, 90, 100)) <= 1).all()
+
+
+def test_latent_cache_counts_lowres_copies():
+    cache = LatentCache(budget_bytes=10 ** 6)
+    cached = CachedImage("a", Image.new("RGB", (64, 64)), torch.zeros(1, 4, 8, 8))
+    cache.put(cached)
+    before = cache.nbytes
+
+    cache.attach_lowres(cached, Image.new("RGB", (32, 32)), torch.zeros(1, 4, 4, 4))
+    assert cache.nbytes == before + 32 * 32 * 3 + 4 * 4 * 4 * 4
+    assert cached.nbytes == cache.nbytes
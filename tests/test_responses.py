@@ -0,0 +1,32 @@
+import pytest
+
+from services.responses import negotiate_output, parse_accept
+
+
+def test_parse_accept_reads_quality_values():
+    assert parse_accept("image/webp;q=0.8, Application/JSON, image/*;q=bad") == {
+        "image/webp": 0.8, "application/json": 1.0, "image/*": 0.0,
+    }
+    assert parse_accept(None) == {}
+
+
+@pytest.mark.parametrize("accept, output_format, expected", [
+    (None, None, ("jpeg", False)),
+    ("*/*", None, ("jpeg", False)),
+    ("application/json", None, ("jpeg", False)),
+    ("image/jpeg", None, ("jpeg", True)),
+    ("image/webp", None, ("webp", True)),
+    ("image/*", None, ("jpeg", True)),
+    ("image/webp;q=0.9, image/jpeg;q=0.5", None, ("webp", True)),
+    ("image/jpeg;q=0.5, application/json", None, ("jpeg", False)),
+    (None, "WEBP", ("webp", False)),
+    ("image/jpeg", "webp", ("webp", False)),
+    ("image/*", "webp", ("webp", True)),
+])
+def test_negotiate_output(accept, output_format, expected):
+    assert negotiate_output(accept, output_format) == expected
+
+
+def test_negotiate_output_rejects_unknown_formats():
+    with pytest.raises(ValueError):
+        negotiate_output("image/png", "png")
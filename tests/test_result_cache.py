@@ -0,0 +1,34 @@
+import os
+
+from PIL import Image
+
+from services.result_cache import ResultCache
+
+
+def test_result_cache_evicts_oldest_files(tmp_path):
+    image = Image.new("RGB", (16, 16), (200, 10, 10))
+    probe = ResultCache(str(tmp_path / "probe"), max_bytes=10 ** 6, hot_entries=0)
+    probe.put("probe", image)
+    size = probe.stats()["disk_bytes"]
+
+    cache = ResultCache(str(tmp_path / "results"), max_bytes=size * 3, hot_entries=1, low_water=0.5)
+    for key in ("k1", "k2", "k3"):
+        cache.put(key, image)
+    assert cache.stats()["disk_entries"] == 3
+
+    cache.put("k4", image)
+    # Over the limit: down to half of it, oldest first
+    assert cache.stats()["disk_entries"] == 1
+    assert cache.get("k1") is None
+    assert not os.path.exists(cache._path("k1"))
+    assert cache.get("k4").getpixel((0, 0)) == (200, 10, 10)
+
+
+def test_result_cache_reads_back_from_disk(tmp_path):
+    ResultCache(str(tmp_path), max_bytes=10 ** 6, hot_entries=1).put("key", Image.new("RGB", (8, 8), (1, 2, 3)))
+
+    # A new instance (e.g. after a restart) indexes the existing files
+    cache = ResultCache(str(tmp_path), max_bytes=10 ** 6, hot_entries=1)
+    assert cache.get("key").getpixel((0, 0)) == (1, 2, 3)
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.get("missing") is None
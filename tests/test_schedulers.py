@@ -0,0 +1,46 @@
+import pytest
+import torch
+from PIL import Image
+
+from model.schedulers import pipeline_for_tier
+
+accelerate = pytest.importorskip("accelerate")
+
+
+@pytest.fixture
+def offloaded(tiny_pipeline):
+    tiny_pipeline.enable_model_cpu_offload()
+    return tiny_pipeline
+
+
+def test_tier_view_shares_components(offloaded):
+    view = pipeline_for_tier(offloaded, "preview")
+    assert view is not offloaded
+    assert view.unet is offloaded.unet and view.vae is offloaded.vae
+    assert view.scheduler is not offloaded.scheduler
+    assert pipeline_for_tier(offloaded, "preview") is view
+
+
+def test_model_offloaded_view_keeps_the_offload_state(offloaded):
+    view = pipeline_for_tier(offloaded, "preview")
+    assert view._all_hooks is offloaded._all_hooks
+    assert view._offload_gpu_id == offloaded._offload_gpu_id
+    assert view._execution_device == offloaded._execution_device == torch.device("cuda:0")
+
+
+def test_model_offloaded_view_offloads_after_a_call(offloaded):
+    offloads = []
+    for hook in offloaded._all_hooks:
+        # Run on the CPU, as if it were the accelerator, and record each offload
+        hook.hook.execution_device = torch.device("cpu")
+        hook.offload = lambda hook=hook, offload=hook.offload: (offloads.append(hook.model), offload())
+
+    view = pipeline_for_tier(offloaded, "preview")
+    assert view._execution_device == torch.device("cpu")
+    view(prompt="a face", image=Image.new("RGB", (64, 64)), strength=0.5, num_inference_steps=2, output_type="np")
+
+    # Every model went back to the CPU at the end of the call (maybe_free_model_hooks)...
+    assert {id(model) for model in offloads} == {id(offloaded.unet), id(offloaded.vae), id(offloaded.text_encoder)}
+    # ...and the hooks were put back for the next one
+    assert hasattr(view.unet, "_hf_hook")
+    assert view.unet.device == torch.device("cpu")
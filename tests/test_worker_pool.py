@@ -0,0 +1,117 @@
+import asyncio
+import queue
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import config
+from model.model_manager import model_manager
+from services.admission import current_cancel_check
+from services.metrics import RequestTimings, timed
+from services.previews import publish_previews
+from services.worker_pool import WorkerPool, _to_cpu, _worker_main
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """A pool whose replicas run _worker_main in threads of this process, with a stand-in model."""
+    monkeypatch.setattr(model_manager, "get_pipeline", lambda: None)
+    monkeypatch.setattr(torch, "set_num_threads", lambda threads: None)
+    pool = WorkerPool(2, threads=1)
+    pool._responses = queue.Queue()
+    pool._cancelled = [0, 0]
+    for index in range(2):
+        requests = queue.Queue()
+        replica = threading.Thread(
+            target=_worker_main, args=(index, 1, None, requests, pool._responses, pool._cancelled), daemon=True
+        )
+        replica.start()
+        pool._requests.append(requests)
+        pool._processes.append(replica)
+    pool._listener = threading.Thread(target=pool._listen, daemon=True)
+    pool._listener.start()
+    yield pool
+    pool.stop()
+
+
+def double(value):
+    with timed("double"):
+        return [torch.tensor([value * 2])]
+
+
+def fail():
+    raise ValueError("bad input")
+
+
+def wait_for_cancel():
+    while not current_cancel_check.get()():
+        pass
+    return "stopped"
+
+
+def stream_previews():
+    publish_previews(0, 4, torch.zeros(2, 4, 8, 8))
+    return "done"
+
+
+def test_calls_run_on_replicas_and_report_their_stages(pool):
+    timings = RequestTimings()
+
+    async def main():
+        return await asyncio.gather(*(pool.run(double, value, timings=timings) for value in range(4)))
+
+    results = asyncio.run(main())
+    assert [result[0].item() for result in results] == [0, 2, 4, 6]
+    assert "double" in timings.stages
+    assert pool.status()["state"] == "ready"
+    assert pool.status()["in_flight"] == [0, 0]
+
+
+def test_failed_calls_raise_in_the_caller(pool):
+    with pytest.raises(RuntimeError, match="ValueError: bad input"):
+        asyncio.run(pool.run(fail))
+
+
+def test_cancelled_calls_stop_in_the_replica(pool, monkeypatch):
+    monkeypatch.setattr(config, "DISCONNECT_POLL_SECONDS", 0.01)
+    assert asyncio.run(pool.run(wait_for_cancel, cancel_check=lambda: True)) == "stopped"
+
+
+def test_previews_come_back_for_the_masked_items(pool, monkeypatch):
+    monkeypatch.setattr(config, "PREVIEW_EVERY_STEPS", 1)
+    previews = []
+
+    async def main():
+        return await pool.run(stream_previews, on_preview=lambda *preview: previews.append(preview),
+                              preview_mask=[False, True])
+
+    assert asyncio.run(main()) == "done"
+    (step, steps, images), = previews
+    assert (step, steps) == (1, 4)
+    assert images[0] is None and images[1][:2] == b"\xff\xd8"
+
+
+def test_calls_on_a_dead_replica_fail():
+    pool = WorkerPool(1, threads=1)
+    pool._requests = [queue.Queue()]
+    pool._cancelled = [0]
+    pool._processes = [SimpleNamespace(is_alive=lambda: False, exitcode=-9)]
+    pool._listener = object()
+
+    async def main():
+        call = asyncio.ensure_future(pool.run(double, 1))
+        await asyncio.sleep(0)
+        pool._check_processes()
+        return await call
+
+    with pytest.raises(RuntimeError, match="exited with code -9"):
+        asyncio.run(main())
+    assert pool.status()["state"] == "failed"
+
+
+def test_results_go_back_on_the_cpu():
+    result = _to_cpu(([torch.ones(1)], "text"))
+    assert isinstance(result, tuple) and result[1] == "text"
+    assert result[0][0].device.type == "cpu"
@@ -0,0 +1,84 @@
+"""A tiny, randomly initialized StableDiffusionImg2ImgPipeline for offline tests and benchmarks.
+
+It has the same components and call signature as SD-1.5 (VAE with an 8x
+downsampling factor, UNet with cross-attention, CLIP text encoder), so every
+code path in the service runs, but it fits in a few MB and runs on CPU with
+no download. Output images are noise; only timings are meaningful.
+"""
+import json
+import os
+import tempfile
+
+import torch
+from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionImg2ImgPipeline, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+
+def build_tokenizer(directory: str) -> CLIPTokenizer:
+    """Writes a character-level CLIP vocabulary (no BPE merges) and loads it."""
+    characters = list(bytes_to_unicode().values())
+    tokens = ["<|startoftext|>", "<|endoftext|>"] + characters + [f"{c}</w>" for c in characters]
+    vocab_file = os.path.join(directory, "vocab.json")
+    merges_file = os.path.join(directory, "merges.txt")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(merges_file, "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def build_tiny_pipeline(seed: int = 0) -> StableDiffusionImg2ImgPipeline:
+    torch.manual_seed(seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        tokenizer = build_tokenizer(directory)
+
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        max_position_embeddings=77,
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+    ))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=64,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 32, 32),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=1,
+        # SD-1.5's tile size, so VAE tiling (see memory_manager) splits images the same way
+        sample_size=512,
+    )
+    scheduler = PNDMScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", skip_prk_steps=True
+    )
+
+    pipeline = StableDiffusionImg2ImgPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline